@@ -0,0 +1,30 @@
+import asyncio
+import time
+from typing import Optional
+
+
+# 締め切りまでに応答できなかったときにユーザーへ返すメッセージ
+TIMEOUT_MESSAGE = "時間内に応答できませんでした。少し時間をおいてもう一度お試しください。"
+
+
+class Deadline:
+    """1件のリクエストに許された残り時間
+
+    on_message / ask の受付時に作り、履歴の読み込み・画像の取得・モデルの呼び出しまで
+    同じものを渡していく。どこで時間を使っても、全体として seconds 秒を超えない。
+    """
+
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+
+def within(deadline: Optional[Deadline]) -> asyncio.Timeout:
+    """締め切りを過ぎたら TimeoutError にする async with 用のスコープ（None なら無制限）"""
+    return asyncio.timeout(deadline.remaining() if deadline is not None else None)
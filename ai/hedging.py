@@ -0,0 +1,112 @@
+import asyncio
+import math
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Tuple, TypeVar
+
+from config import Config
+
+T = TypeVar("T")
+
+
+class HedgePolicy:
+    """遅いリクエストの複製（ヘッジ）をいつ出すかを決め、最初に返った方を使う
+
+    直近の応答時間の percentile を超えても返ってこなければ、同じリクエスト
+    （HEDGE_FALLBACK_MODEL があればそのモデル）をもう1本出し、先に成功した方を採って
+    もう一方はキャンセルする。尾の遅延を、少しの追加リクエストで削る。
+    OpenAIのレート制限を食いつぶさないよう、ヘッジは全体の max_ratio までに抑える。
+    """
+
+    def __init__(
+        self,
+        percentile: float = Config.HEDGE_PERCENTILE,
+        min_delay: float = Config.HEDGE_MIN_DELAY,
+        max_ratio: float = Config.HEDGE_MAX_RATIO,
+        window: int = 200,
+        min_samples: int = 20,
+    ):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_ratio = max_ratio
+        self.window = window
+        self.min_samples = min_samples
+        self._samples: Dict[str, Deque[float]] = {}
+
+        # 統計情報
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def observe(self, key: str, seconds: float) -> None:
+        """応答時間（ストリーミングは最初のトークンまで）を記録する"""
+        samples = self._samples.get(key)
+        if samples is None:
+            samples = self._samples[key] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def delay(self, key: str) -> Optional[float]:
+        """ヘッジを出すまでの秒数（サンプル不足・上限超えなら None）"""
+        samples = self._samples.get(key)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        if self.hedged >= self.max_ratio * self.requests:
+            return None
+        ordered = sorted(samples)
+        index = max(0, math.ceil(self.percentile / 100 * len(ordered)) - 1)
+        return max(self.min_delay, ordered[index])
+
+    async def run(
+        self,
+        key: str,
+        primary: Callable[[], Awaitable[T]],
+        hedge: Callable[[], Awaitable[T]],
+        discard: Callable[[T], Awaitable[None]],
+    ) -> T:
+        """primary を実行し、遅ければ hedge も出して先に成功した方の結果を返す
+
+        負けた方はキャンセルし、すでに結果が出ていれば discard で片付ける。
+        """
+        self.requests += 1
+
+        async def timed(factory: Callable[[], Awaitable[T]]) -> Tuple[T, float]:
+            start = time.monotonic()
+            result = await factory()
+            return result, time.monotonic() - start
+
+        first = asyncio.create_task(timed(primary))
+        tasks = [first]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.delay(key))
+            if not done:
+                self.hedged += 1
+                tasks.append(asyncio.create_task(timed(hedge)))
+
+            pending = set(tasks)
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # 同時に終わったら primary を優先する
+                for task in sorted(done, key=tasks.index):
+                    if task.exception() is None:
+                        result, seconds = task.result()
+                        self.observe(key, seconds)
+                        if task is not first:
+                            self.hedge_wins += 1
+                        tasks.remove(task)
+                        return result
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+            for outcome in await asyncio.gather(*tasks, return_exceptions=True):
+                if not isinstance(outcome, BaseException):
+                    await discard(outcome[0])
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+        }
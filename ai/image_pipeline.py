@@ -0,0 +1,172 @@
+import asyncio
+import base64
+import hashlib
+import io
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+import aiohttp
+
+from config import Config
+
+try:
+    from PIL import Image
+except ImportError:  # Pillowがない場合は縮小・再圧縮せずにそのまま送る
+    Image = None
+
+
+# OpenAIがそのまま取得できるDiscordのCDNホスト
+DISCORD_CDN_HOSTS = ("cdn.discordapp.com", "media.discordapp.net")
+
+# これより大きい画像は解像度が上限以下でも再圧縮する
+RECOMPRESS_THRESHOLD = 1024 * 1024
+
+
+class ImageTooLargeError(Exception):
+    """画像がサイズ上限を超えている"""
+
+
+class ImagePipeline:
+    """画像添付をチャットリクエスト用のimage_urlに変換する
+
+    モード:
+        url    : 画像URLをそのままモデルに渡す（ダウンロードしない）
+        inline : ダウンロードして縮小・再圧縮し、data URLとして埋め込む
+        auto   : DiscordのCDN URLはそのまま渡し、それ以外は埋め込む
+    """
+
+    def __init__(self):
+        self.mode = Config.IMAGE_MODE
+        self.max_bytes = Config.IMAGE_MAX_BYTES
+        self.max_dimension = Config.IMAGE_MAX_DIMENSION
+        self.jpeg_quality = Config.IMAGE_JPEG_QUALITY
+
+        # 画像ダウンロード用のセッション（初回使用時に作成して使い回す）
+        self._http_session: Optional[aiohttp.ClientSession] = None
+        self._semaphore = asyncio.Semaphore(Config.IMAGE_FETCH_CONCURRENCY)
+
+        # 画像内容のハッシュ -> data URL（同じ画像を再エンコードしない）
+        self._encoded: "OrderedDict[str, str]" = OrderedDict()
+        self._cache_size = Config.IMAGE_CACHE_MAX_ENTRIES
+
+    async def build_image_parts(self, image_urls: List[str]) -> List[Dict]:
+        """画像URLのリストからimage_urlコンテンツを作成（順番は維持）"""
+        results = await asyncio.gather(*(self._resolve(url) for url in image_urls))
+        return [
+            {"type": "image_url", "image_url": {"url": image_url}}
+            for image_url in results
+            if image_url
+        ]
+
+    def _should_pass_through(self, url: str) -> bool:
+        if self.mode == "url":
+            return True
+        if self.mode == "auto":
+            return urlparse(url).hostname in DISCORD_CDN_HOSTS
+        return False
+
+    async def _resolve(self, url: str) -> Optional[str]:
+        """1枚の画像をモデルに渡すURLに変換する（失敗時はNone）"""
+        if self._should_pass_through(url):
+            return url
+
+        try:
+            async with self._semaphore:
+                fetched = await self._download(url)
+            if fetched is None:
+                return None
+            data, content_type = fetched
+
+            key = hashlib.sha256(data).hexdigest()
+            cached = self._encoded.get(key)
+            if cached is not None:
+                self._encoded.move_to_end(key)
+                return cached
+
+            # 縮小・再圧縮はCPU処理なのでイベントループの外で行う
+            data_url = await asyncio.to_thread(self._encode, data, content_type)
+            self._encoded[key] = data_url
+            while len(self._encoded) > self._cache_size:
+                self._encoded.popitem(last=False)
+            return data_url
+        except Exception as e:
+            print(f"Failed to fetch image {url}: {e}")
+            return None
+
+    def _get_http_session(self) -> aiohttp.ClientSession:
+        """keep-alive付きの共有セッションを返す"""
+        if self._http_session is None or self._http_session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=Config.IMAGE_FETCH_CONCURRENCY,
+                ttl_dns_cache=300,
+                keepalive_timeout=60,
+            )
+            self._http_session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=Config.IMAGE_FETCH_TIMEOUT),
+            )
+        return self._http_session
+
+    async def _download(self, url: str) -> Optional[tuple]:
+        """画像をダウンロードする（サイズ上限を超えたら途中で打ち切る）"""
+        session = self._get_http_session()
+        async with session.get(url) as resp:
+            if resp.status != 200:
+                return None
+
+            if resp.content_length is not None and resp.content_length > self.max_bytes:
+                raise ImageTooLargeError(f"{resp.content_length} bytes")
+
+            buf = bytearray()
+            async for chunk in resp.content.iter_chunked(64 * 1024):
+                buf.extend(chunk)
+                if len(buf) > self.max_bytes:
+                    raise ImageTooLargeError(f"over {self.max_bytes} bytes")
+
+            content_type = resp.headers.get("Content-Type", "image/png")
+            return bytes(buf), content_type
+
+    def _encode(self, data: bytes, content_type: str) -> str:
+        """必要なら縮小・再圧縮してdata URLにする"""
+        data, content_type = shrink_image(
+            data, content_type, self.max_dimension, self.jpeg_quality
+        )
+        b64 = base64.b64encode(data).decode("ascii")
+        return f"data:{content_type};base64,{b64}"
+
+    async def close(self) -> None:
+        if self._http_session is not None:
+            await self._http_session.close()
+
+
+def shrink_image(
+    data: bytes, content_type: str, max_dimension: int, jpeg_quality: int
+) -> tuple:
+    """大きな画像を長辺max_dimension以下に縮小してJPEGに再圧縮する
+
+    Pillowがない、または読めない形式の場合は元のデータを返す。
+    縮小後のほうが大きくなる場合も元のデータを使う。
+    """
+    if Image is None:
+        return data, content_type
+
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            if max(img.size) <= max_dimension and len(data) <= RECOMPRESS_THRESHOLD:
+                return data, content_type
+            # アニメーションGIFなどは1フレーム目だけを使う
+            img.seek(0)
+            img.thumbnail((max_dimension, max_dimension))
+            if img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+
+            out = io.BytesIO()
+            img.save(out, format="JPEG", quality=jpeg_quality, optimize=True)
+    except Exception:
+        return data, content_type
+
+    shrunk = out.getvalue()
+    if len(shrunk) >= len(data):
+        return data, content_type
+    return shrunk, "image/jpeg"
@@ -0,0 +1,148 @@
+import json
+import os
+import time
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+# これ以下のキーワード数なら線形スキャンのほうが速い（benchmarks/bench_keyword_matcher.py）。
+# 1文字ずつ進めるPythonのループより、キーワードごとの `in`（C実装）を並べたほうが安い
+LINEAR_SCAN_MAX_KEYWORDS = 200
+
+
+class KeywordMatcher:
+    """Aho-Corasick法で多数のキーワードを1回の走査で探す
+
+    キーワード数に関係なく、メッセージの長さに比例した時間で判定できる。
+    キーワードが linear_threshold 個以下のときは、キーワードごとに `in` で探す。
+    """
+
+    def __init__(
+        self,
+        keywords: Iterable[Tuple[str, str]],
+        linear_threshold: int = LINEAR_SCAN_MAX_KEYWORDS,
+    ):
+        """
+        Args:
+            keywords: (キーワード, カテゴリ) のペア
+            linear_threshold: これ以下のキーワード数なら線形スキャンで探す
+        """
+        pairs = [(keyword, category) for keyword, category in keywords if keyword]
+        # 線形スキャンで使うキーワード（Aho-Corasickを使うときは None）
+        self._linear: Optional[List[Tuple[str, str]]] = None
+        if len(pairs) <= linear_threshold:
+            self._linear = pairs
+            return
+
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        # 状態ごとに、その状態で見つかるキーワードの (キーワード, カテゴリ)
+        self._output: List[Optional[Tuple[str, str]]] = [None]
+
+        for keyword, category in pairs:
+            self._add(keyword, category)
+        self._build_failure_links()
+
+    def _add(self, keyword: str, category: str) -> None:
+        state = 0
+        for ch in keyword:
+            nxt = self._goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(None)
+            state = nxt
+        if self._output[state] is None:
+            self._output[state] = (keyword, category)
+
+    def _build_failure_links(self) -> None:
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                f = self._fail[state]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                target = self._goto[f].get(ch, 0)
+                self._fail[nxt] = target if target != nxt else 0
+                # 接尾辞として含まれるキーワードも拾えるようにする
+                if self._output[nxt] is None:
+                    self._output[nxt] = self._output[self._fail[nxt]]
+
+    def search(self, text: str) -> Optional[Tuple[str, str]]:
+        """最初に見つかったキーワードの (キーワード, カテゴリ) を返す
+
+        線形スキャンでは登録順で最初のもの、Aho-Corasickでは本文で最初に現れるもの。
+        """
+        if self._linear is not None:
+            for pair in self._linear:
+                if pair[0] in text:
+                    return pair
+            return None
+
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state] is not None:
+                return output[state]
+        return None
+
+
+class SearchKeywordRouter:
+    """Web検索を使うかを決めるキーワード判定
+
+    キーワードはカテゴリごとにJSONファイルから読み込み、ファイルが更新されたら
+    再起動なしで読み直す（更新の確認は reload_interval 秒に1回まで）。
+    """
+
+    def __init__(self, path: str, reload_interval: float = 5.0):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._matcher = KeywordMatcher([])
+        self._mtime: Optional[float] = None
+        self._checked_at = 0.0
+        self._reload()
+
+    @staticmethod
+    def load_keywords(path: str) -> List[Tuple[str, str]]:
+        """{カテゴリ: [キーワード, ...]} 形式のJSONを読み込む
+
+        判定は小文字にしたメッセージで行うので、キーワードも小文字にそろえる。
+        """
+        with open(path, encoding="utf-8") as f:
+            categories = json.load(f)
+        return [
+            (keyword.lower(), category)
+            for category, keywords in categories.items()
+            for keyword in keywords
+        ]
+
+    def _reload(self) -> None:
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime == self._mtime:
+                return
+            self._matcher = KeywordMatcher(self.load_keywords(self.path))
+            self._mtime = mtime
+            print(f"Loaded search keywords from {self.path}")
+        except Exception as e:
+            # 読み込みに失敗したら前回のキーワードを使い続ける
+            print(f"Failed to load search keywords: {e}")
+
+    def match(self, text: str) -> Optional[str]:
+        """キーワードが含まれていればそのカテゴリを返す"""
+        now = time.monotonic()
+        if now - self._checked_at >= self.reload_interval:
+            self._checked_at = now
+            self._reload()
+
+        found = self._matcher.search(text)
+        return found[1] if found else None
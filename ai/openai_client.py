@@ -1,17 +1,92 @@
-import base64
-from typing import Optional, List, Dict
-import aiohttp
-from openai import AsyncOpenAI
+import asyncio
+import importlib
+import logging
+import time
+from typing import TYPE_CHECKING, Any, AsyncIterator, Optional, List, Dict, Tuple
 
+from ai.deadline import Deadline, within
+from ai.hedging import HedgePolicy
+from ai.image_pipeline import ImagePipeline
+from ai.keyword_matcher import SearchKeywordRouter
+from ai.response_cache import LeaderCancelled, ResponseCache
+from ai.retry import OpenAIRetrier
+from ai.router import ModelRouter, question_part
+from ai.tokens import ensure_encoding, fit_history, stable_history_start
+from ai.usage import UsageTracker
 from config import Config
+from metrics import OPENAI_ROUTES, OPENAI_SECONDS, STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+
+async def _discard_response(result) -> None:
+    """ヘッジで負けた応答（ストリーミングでないもの）は捨てるだけ"""
+
+
+async def _with_idle_timeout(chunks: List, iterator: AsyncIterator) -> AsyncIterator:
+    """読み済みのチャンクに続けて、残りを次のチャンクの待ち時間に上限を付けて返す"""
+    for chunk in chunks:
+        yield chunk
+    while True:
+        try:
+            async with asyncio.timeout(Config.OPENAI_STREAM_IDLE_TIMEOUT):
+                chunk = await anext(iterator)
+        except StopAsyncIteration:
+            return
+        yield chunk
 
 
 class OpenAIClient:
     def __init__(self):
-        self.client = AsyncOpenAI(api_key=Config.OPENAI_API_KEY)
+        self._client: Optional["AsyncOpenAI"] = None
+        self.retrier = OpenAIRetrier(lambda: self.client)
+        self.usage = UsageTracker()
         self.model = Config.AI_MODEL
         self.model_search = Config.AI_MODEL_SEARCH
+        self.model_fast = Config.AI_MODEL_FAST
         self.web_search_enabled = Config.WEB_SEARCH_ENABLED
+        self.images = ImagePipeline()
+        self.search_keywords = SearchKeywordRouter(
+            Config.SEARCH_KEYWORDS_PATH, Config.SEARCH_KEYWORDS_RELOAD_INTERVAL
+        )
+        # 遅いリクエストの複製（オプション）
+        self.hedge: Optional[HedgePolicy] = HedgePolicy() if Config.HEDGE_ENABLED else None
+        # 短いやり取りを軽いモデルに回す（オプション）
+        self.router: Optional[ModelRouter] = None
+        if Config.ROUTING_ENABLED:
+            self.router = ModelRouter(Config.ROUTE_RULES_PATH, Config.SEARCH_KEYWORDS_RELOAD_INTERVAL)
+
+        # 定型的な短いやり取りの応答キャッシュ（オプション）
+        self.response_cache: Optional[ResponseCache] = None
+        if Config.RESPONSE_CACHE_ENABLED:
+            self.response_cache = ResponseCache(
+                max_entries=Config.RESPONSE_CACHE_MAX_ENTRIES,
+                ttl=Config.RESPONSE_CACHE_TTL,
+                search_ttl=Config.RESPONSE_CACHE_SEARCH_TTL,
+                history_turns=Config.RESPONSE_CACHE_HISTORY_TURNS,
+            )
+
+    @property
+    def client(self) -> "AsyncOpenAI":
+        """OpenAIのSDKクライアント（読み込みが重いので、初めて使うときに作る）"""
+        if self._client is None:
+            from openai import AsyncOpenAI
+
+            # 再試行は OpenAIRetrier で行うので、SDK自体の再試行は無効にする
+            self._client = AsyncOpenAI(api_key=Config.OPENAI_API_KEY, max_retries=0)
+        return self._client
+
+    async def warm_up(self) -> None:
+        """SDKとトークナイザーの読み込み、TLS接続を済ませておき、最初のリクエストを速くする"""
+        if self._client is None:
+            # import はイベントループを止めないよう別スレッドで行う
+            await asyncio.to_thread(importlib.import_module, "openai")
+        # 履歴のトークン数を数えるエンコーディングも（初回はダウンロードを含む）
+        await ensure_encoding(self.model)
+        await self.client.models.retrieve(self.model)
 
     async def chat(
         self,
@@ -19,6 +94,8 @@ class OpenAIClient:
         history: Optional[List[Dict]] = None,
         image_urls: Optional[List[str]] = None,
         use_web_search: Optional[bool] = None,
+        summary: Optional[str] = None,
+        deadline: Optional[Deadline] = None,
     ) -> str:
         """
         AIとチャットする
@@ -28,23 +105,294 @@ class OpenAIClient:
             history: 会話履歴 [{"role": "user/assistant", "content": "..."}]
             image_urls: 画像URLのリスト（画像認識用）
             use_web_search: Web検索を使用するか（Noneの場合は自動判定）
+            summary: 履歴から外れた古い会話の要約
+            deadline: リクエスト全体の締め切り（過ぎたら TimeoutError、Noneなら無制限）
 
         Returns:
             AIの応答テキスト
         """
+        request, route = await self._build_request(
+            user_message, history, image_urls, use_web_search, summary, deadline
+        )
+
+        key = self._cache_key(request, user_message, history, image_urls)
+        if key is None:
+            return await self._complete(request, route, deadline)
+
+        ttl = self.response_cache.ttl_for("web_search_options" in request)
+        return await self.response_cache.get_or_create(
+            key, ttl, lambda: self._complete(request, route, deadline)
+        )
+
+    async def _complete(self, request: Dict, route: str, deadline: Optional[Deadline] = None) -> str:
+        try:
+            with OPENAI_SECONDS.time(**self._metric_labels(request, route, stream=False)):
+                async with within(deadline):
+                    response, used = await self._create(request, route, deadline)
+        except Exception as e:
+            fallback = self._search_fallback(request, route, e, deadline)
+            if fallback is None:
+                raise
+            return await self._complete(fallback, "full", deadline)
+        self._record_usage(used, route, response.usage)
+        return response.choices[0].message.content or ""
+
+    async def _create(self, request: Dict, route: str, deadline: Optional[Deadline]) -> Tuple[Any, Dict]:
+        """（遅ければヘッジして）応答を取得し、(応答, 実際に使ったリクエスト) を返す"""
+        async def call(req: Dict) -> Tuple[Any, Dict]:
+            return await self.retrier.create(deadline=deadline, **req), req
+
+        if self.hedge is None or route == "summary":
+            return await call(request)
+        return await self.hedge.run(
+            self._hedge_key(request, stream=False),
+            lambda: call(request),
+            lambda: call(self._hedge_request(request, route)),
+            discard=_discard_response,
+        )
+
+    async def chat_stream(
+        self,
+        user_message: str,
+        history: Optional[List[Dict]] = None,
+        image_urls: Optional[List[str]] = None,
+        use_web_search: Optional[bool] = None,
+        summary: Optional[str] = None,
+        deadline: Optional[Deadline] = None,
+    ) -> AsyncIterator[str]:
+        """
+        AIとチャットし、応答を生成された順に少しずつ返す
+
+        引数は chat() と同じ。応答テキストの差分を順にyieldする。
+        締め切りは最初のトークンが届くまでに適用し、その後はトークンの間隔だけを見る。
+        """
+        request, route = await self._build_request(
+            user_message, history, image_urls, use_web_search, summary, deadline
+        )
+
+        key = self._cache_key(request, user_message, history, image_urls)
+        if key is None:
+            async for delta in self._stream(request, route, deadline):
+                yield delta
+            return
+
+        # キャッシュ済み、または同じリクエストが実行中ならその結果をまとめて返す
+        while True:
+            future = self.response_cache.join(key)
+            if future is None:
+                break
+            try:
+                async with within(deadline):
+                    response = await asyncio.shield(future)
+            except LeaderCancelled:
+                # 実行役が取り消された。自分が実行役になるか、次の実行役を待つ
+                continue
+            yield response
+            return
+
+        ttl = self.response_cache.ttl_for("web_search_options" in request)
+        parts = []
+        try:
+            async for delta in self._stream(request, route, deadline):
+                parts.append(delta)
+                yield delta
+        except BaseException as e:
+            self.response_cache.finish(key, ttl, error=e)
+            raise
+        self.response_cache.finish(key, ttl, value="".join(parts))
+
+    async def _stream(
+        self, request: Dict, route: str, deadline: Optional[Deadline] = None
+    ) -> AsyncIterator[str]:
+        start = time.monotonic()
+        consumer_time = 0.0  # yield先（Discordの編集など）で使った時間は除く
+        try:
+            async with within(deadline):
+                stream, chunks, iterator, used = await self._open_stream(request, route, deadline)
+        except Exception as e:
+            # まだ何も表示していないので、検索モデルの失敗なら通常モデルで出し直せる
+            fallback = self._search_fallback(request, route, e, deadline)
+            if fallback is None:
+                raise
+            async for delta in self._stream(fallback, "full", deadline):
+                yield delta
+            return
+
+        try:
+            async for chunk in _with_idle_timeout(chunks, iterator):
+                # 使用量は最後のチャンク（choicesが空）に入っている
+                if chunk.usage is not None:
+                    self._record_usage(used, route, chunk.usage)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    paused = time.monotonic()
+                    yield delta
+                    consumer_time += time.monotonic() - paused
+        finally:
+            await stream.close()
+
+        OPENAI_SECONDS.observe(
+            time.monotonic() - start - consumer_time,
+            **self._metric_labels(request, route, stream=True),
+        )
+
+    async def _open_stream(self, request: Dict, route: str, deadline: Optional[Deadline]):
+        """ストリームを開いて最初のトークンまで読む（遅ければヘッジする）
+
+        Returns:
+            (ストリーム, 読んだチャンク, 続きのイテレーター, 実際に使ったリクエスト)
+        """
+        async def open_one(req: Dict):
+            stream = await self.retrier.create(
+                deadline=deadline, stream=True, stream_options={"include_usage": True}, **req
+            )
+            iterator = aiter(stream)
+            chunks = []
+            try:
+                async for chunk in iterator:
+                    chunks.append(chunk)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        break
+            except BaseException:
+                await stream.close()
+                raise
+            return stream, chunks, iterator, req
+
+        if self.hedge is None:
+            return await open_one(request)
+        return await self.hedge.run(
+            self._hedge_key(request, stream=True),
+            lambda: open_one(request),
+            lambda: open_one(self._hedge_request(request, route)),
+            discard=lambda opened: opened[0].close(),
+        )
+
+    @staticmethod
+    def _hedge_key(request: Dict, stream: bool) -> str:
+        return f"{request['model']}:{'stream' if stream else 'complete'}"
+
+    def _hedge_request(self, request: Dict, route: str) -> Dict:
+        """ヘッジで出すリクエスト（代わりのモデルがあればそちらへ、検索はそのまま）"""
+        if Config.HEDGE_FALLBACK_MODEL and route != "search":
+            return dict(request, model=Config.HEDGE_FALLBACK_MODEL)
+        return request
+
+    def _search_fallback(
+        self, request: Dict, route: str, error: Exception, deadline: Optional[Deadline]
+    ) -> Optional[Dict]:
+        """検索モデルが失敗したときに、検索なしの通常モデルで出し直すリクエスト（出し直さないならNone）"""
+        if route != "search" or (deadline is not None and deadline.expired):
+            return None
+        print(f"Search model failed ({type(error).__name__}: {error}), falling back to {self.model}")
+        OPENAI_ROUTES.inc(route="full", reason="search_failed")
+        fallback = {k: v for k, v in request.items() if k != "web_search_options"}
+        fallback["model"] = self.model
+        return fallback
+
+    @staticmethod
+    def _metric_labels(request: Dict, route: str, stream: bool) -> Dict[str, str]:
+        return {
+            "model": request["model"],
+            "route": route,
+            "search": str("web_search_options" in request).lower(),
+            "stream": str(stream).lower(),
+        }
+
+    def _record_usage(self, request: Dict, route: str, usage) -> None:
+        """リクエストごとのトークン使用量を記録する"""
+        if usage is None:
+            return
+        tokens = self.usage.record(request["model"], route, usage)
+        # 集計は定期的な usage.report() で出すので、1件ごとはデバッグ用
+        logger.debug(
+            "Tokens used: prompt=%d cached=%d completion=%d (model=%s, route=%s)",
+            tokens["prompt"], tokens["cached"], tokens["completion"], request["model"], route,
+        )
+
+    async def summarize(self, previous_summary: str, messages: List[Dict]) -> str:
+        """古い会話を既存の要約に畳み込んだ新しい要約を作る"""
+        transcript = "\n".join(
+            f"{'ユーザー' if m.get('role') == 'user' else 'アシスタント'}: {m.get('content', '')}"
+            for m in messages
+        )
+        prompt = (
+            "以下の「これまでの要約」と「追加の会話」を合わせて、今後の会話に必要な事実"
+            "（相手の状況・悩み・決めたこと・好み）を箇条書きで簡潔にまとめてください。\n\n"
+            f"【これまでの要約】\n{previous_summary or 'なし'}\n\n"
+            f"【追加の会話】\n{transcript}"
+        )
+        request = {
+            "model": Config.SUMMARY_MODEL,
+            "messages": [{"role": "user", "content": prompt}],
+            "max_tokens": Config.HISTORY_SUMMARY_MAX_TOKENS,
+        }
+        return await self._complete(request, "summary")
+
+    def _cache_key(
+        self,
+        request: Dict,
+        user_message: str,
+        history: Optional[List[Dict]],
+        image_urls: Optional[List[str]],
+    ) -> Optional[str]:
+        """応答キャッシュのキーを返す（キャッシュしないリクエストはNone）
+
+        メンションの発言の前には毎回変わるチャンネルの文脈が付くので、
+        キーは今回の発言（QUESTION_HEADER の後）と会話履歴から作る。
+        """
+        if self.response_cache is None or image_urls:
+            return None
+        return self.response_cache.make_key(
+            question_part(user_message), request["model"], "web_search_options" in request, history
+        )
+
+    async def _build_request(
+        self,
+        user_message: str,
+        history: Optional[List[Dict]],
+        image_urls: Optional[List[str]],
+        use_web_search: Optional[bool],
+        summary: Optional[str] = None,
+        deadline: Optional[Deadline] = None,
+    ) -> Tuple[Dict, str]:
+        """chat.completions.create に渡す引数と、使うモデルの経路（fast / full / search）を組み立てる"""
         # Web検索を使用するかを判定
-        should_use_search = self._should_use_web_search(user_message, use_web_search, image_urls)
+        should_use_search, reason = self._search_decision(user_message, use_web_search, image_urls)
+        if should_use_search:
+            logger.debug("Web search enabled (%s)", reason)
 
+        # OpenAIのプロンプトキャッシュは先頭が一致する部分にしか効かないので、
+        # 変わりにくい順（共通のシステムプロンプト → 要約 → 履歴 → 今回の発言）に並べる。
+        # チャンネルの文脈や画像など毎回変わるものは最後のユーザーメッセージに入れる
         messages = [{"role": "system", "content": Config.SYSTEM_PROMPT}]
 
-        # 会話履歴を追加
+        # 履歴から外れた古い会話の要約
+        if summary:
+            messages.append(
+                {"role": "system", "content": f"【これまでの会話の要約】\n{summary}"}
+            )
+
+        # 会話履歴を追加（トークン予算に収まる分だけ）
         if history:
-            messages.extend(history)
+            # warm-up が終わる前のリクエストでも、トークナイザーの読み込みでループを止めない
+            await ensure_encoding(self.model)
+            fitted = fit_history(history, Config.HISTORY_TOKEN_BUDGET, self.model)
+            # 古い往復が毎回1つずつ消えていく間は、先頭がずれ続けないようにする
+            # （要約が有効なら、件数の上限で消える前に要約に畳み込まれる）
+            at_count_limit = (
+                not Config.HISTORY_SUMMARY_ENABLED and len(history) >= Config.MAX_HISTORY_LENGTH * 2
+            )
+            if len(fitted) < len(history) or at_count_limit:
+                fitted = stable_history_start(fitted, Config.PROMPT_CACHE_ANCHOR_TURNS)
+            messages.extend(fitted)
 
         # ユーザーメッセージを構築
         if image_urls:
             # 画像付きメッセージ（Web検索は画像と併用不可）
-            content = await self._build_image_content(user_message, image_urls)
+            async with within(deadline):
+                content = await self._build_image_content(user_message, image_urls)
             messages.append({"role": "user", "content": content})
             should_use_search = False  # 画像があるときはWeb検索を無効化
         else:
@@ -52,21 +400,50 @@ class OpenAIClient:
 
         if should_use_search:
             # Web検索付きのリクエスト
-            response = await self.client.chat.completions.create(
-                model=self.model_search,
-                messages=messages,
-                max_tokens=2000,
-                web_search_options={},
-            )
-        else:
-            # 通常のリクエスト
-            response = await self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                max_tokens=2000,
-            )
+            OPENAI_ROUTES.inc(route="search", reason=reason)
+            return {
+                "model": self.model_search,
+                "messages": messages,
+                "max_tokens": 2000,
+                "web_search_options": {},
+            }, "search"
 
-        return response.choices[0].message.content or ""
+        route, reason = self._route_decision(user_message, image_urls, history)
+        OPENAI_ROUTES.inc(route=route, reason=reason)
+        if route == "fast":
+            # 挨拶などの短いやり取りは軽いモデルで短く返す
+            return {
+                "model": self.model_fast,
+                "messages": messages,
+                "max_tokens": Config.AI_FAST_MAX_TOKENS,
+            }, "fast"
+
+        # 通常のリクエスト
+        return {
+            "model": self.model,
+            "messages": messages,
+            "max_tokens": 2000,
+        }, "full"
+
+    async def close(self) -> None:
+        """HTTP接続プールを閉じる"""
+        await self.images.close()
+        if self._client is not None:
+            await self._client.close()
+        if self.usage.stats():
+            print(self.usage.report())
+
+    def _route_decision(
+        self,
+        message: str,
+        image_urls: Optional[List[str]],
+        history: Optional[List[Dict]],
+    ) -> Tuple[str, str]:
+        """軽いモデル（fast）と通常のモデル（full）のどちらを使うかと、その理由を返す"""
+        if self.router is None:
+            return "full", "disabled"
+        # チャンネルの文脈を除いた、今回の発言だけで判定する
+        return self.router.route(question_part(message), image_urls, history)
 
     def _should_use_web_search(
         self,
@@ -75,67 +452,38 @@ class OpenAIClient:
         has_images: Optional[List[str]]
     ) -> bool:
         """Web検索を使用するかを判定する"""
+        use_search, _ = self._search_decision(message, explicit_setting, has_images)
+        return use_search
+
+    def _search_decision(
+        self,
+        message: str,
+        explicit_setting: Optional[bool],
+        has_images: Optional[List[str]]
+    ) -> Tuple[bool, str]:
+        """Web検索を使用するかと、その理由（キーワードのカテゴリなど）を返す"""
         # 明示的に指定されている場合はそれを使用
         if explicit_setting is not None:
-            return explicit_setting
+            return explicit_setting, "explicit"
 
         # Web検索が無効化されている場合
         if not self.web_search_enabled:
-            return False
+            return False, "disabled"
 
         # 画像がある場合は検索を使わない
         if has_images:
-            return False
+            return False, "image"
 
         # 短いメッセージ（挨拶など）は検索しない
         if len(message) < 10:
-            return False
+            return False, "short"
 
         # 検索が必要そうなキーワードをチェック
-        search_keywords = [
-            # 時事・ニュース系
-            "最新", "今日", "昨日", "今週", "今月", "今年",
-            "ニュース", "速報", "現在", "リアルタイム",
-            "どうなった", "どうなってる", "何があった",
-            "最近", "トレンド", "流行",
-            # 検索指示
-            "検索", "調べて",
-            # 金融・天気
-            "株価", "天気", "為替", "レート",
-            # イベント
-            "イベント", "開催", "発売", "リリース",
-            # 就活・キャリア系
-            "年収", "給料", "給与", "平均年収", "初任給", "ボーナス", "賞与",
-            "就活", "就職", "転職", "採用", "内定", "退職", "離職率",
-            "企業", "会社", "業界", "職種", "職業",
-            "面接", "ES", "エントリーシート", "履歴書", "職務経歴書",
-            "インターン", "説明会", "選考", "SPI", "適性検査",
-            "求人", "募集", "倍率", "求人倍率",
-            "福利厚生", "残業", "ワークライフバランス", "有給",
-            "昇給", "昇進", "キャリアパス", "スキル",
-            # 業界名
-            "IT業界", "金融業界", "商社", "メーカー", "コンサル",
-            "広告", "マスコミ", "不動産", "建設", "医療", "製薬",
-            "食品", "アパレル", "小売", "サービス業", "公務員",
-            "ベンチャー", "スタートアップ", "外資", "大手",
-            # 年齢・世代系
-            "20代", "30代", "40代", "50代",
-            "新卒", "第二新卒", "中途", "既卒", "未経験",
-            "社会人", "フリーター", "ニート",
-            "年齢", "世代", "Z世代", "ミレニアル",
-            # 恋愛系
-            "恋愛", "彼氏", "彼女", "デート", "告白", "片思い",
-            "マッチングアプリ", "出会い", "婚活", "結婚",
-            "モテ", "脈あり", "脈なし", "好きな人",
-            "付き合う", "別れ", "復縁", "浮気",
-        ]
-
-        message_lower = message.lower()
-        for keyword in search_keywords:
-            if keyword in message_lower:
-                return True
-
-        return False
+        category = self.search_keywords.match(message.lower())
+        if category:
+            return True, category
+
+        return False, "no_keyword"
 
     async def _build_image_content(
         self, text: str, image_urls: List[str]
@@ -148,31 +496,7 @@ class OpenAIClient:
             content.append({"type": "text", "text": text})
 
         # 画像部分
-        for url in image_urls:
-            image_data = await self._fetch_image_as_base64(url)
-            if image_data:
-                content.append(
-                    {
-                        "type": "image_url",
-                        "image_url": {"url": image_data},
-                    }
-                )
+        with STAGE_SECONDS.time(stage="image_fetch"):
+            content.extend(await self.images.build_image_parts(image_urls))
 
         return content
-
-    async def _fetch_image_as_base64(self, url: str) -> Optional[str]:
-        """画像をダウンロードしてbase64エンコードする"""
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, timeout=aiohttp.ClientTimeout(total=30)) as resp:
-                    if resp.status != 200:
-                        return None
-
-                    content_type = resp.headers.get("Content-Type", "image/png")
-                    data = await resp.read()
-                    b64 = base64.b64encode(data).decode("utf-8")
-
-                    # data URL形式で返す
-                    return f"data:{content_type};base64,{b64}"
-        except Exception:
-            return None
@@ -0,0 +1,159 @@
+import asyncio
+import hashlib
+import json
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+class LeaderCancelled(Exception):
+    """実行役のリクエストが取り消された（待っていた側は join() からやり直す）"""
+
+
+def normalize_prompt(text: str) -> str:
+    """全角/半角・大文字/小文字・空白の違いを吸収する"""
+    text = unicodedata.normalize("NFKC", text)
+    return _WHITESPACE.sub(" ", text).strip().lower()
+
+
+class ResponseCache:
+    """同じような短いプロンプトへの応答を使い回すキャッシュ
+
+    TTLとLRUで古いものから捨てる。同じキーのリクエストが同時に来た場合は
+    最初の1件だけをOpenAIに送り、残りはその結果を待つ（single-flight）。
+    実行役が取り消されたら、待っていた側の1件が新しい実行役になる。
+    """
+
+    def __init__(self, max_entries: int, ttl: float, search_ttl: float, history_turns: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.search_ttl = search_ttl  # 検索結果は古くなりやすいので別に設定（0で保存しない）
+        self.history_turns = history_turns
+
+        # キー -> (応答, 有効期限)
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+        # 統計情報
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def make_key(
+        self, user_message: str, model: str, use_search: bool, history: Optional[List[Dict]]
+    ) -> str:
+        """プロンプト・モデル・検索有無・直近の履歴からキーを作る"""
+        recent = (history or [])[-self.history_turns * 2 :] if self.history_turns > 0 else []
+        payload = json.dumps(
+            [normalize_prompt(user_message), model, use_search, recent],
+            ensure_ascii=False,
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def ttl_for(self, use_search: bool) -> float:
+        return self.search_ttl if use_search else self.ttl
+
+    def get(self, key: str) -> Optional[str]:
+        """有効なキャッシュがあれば返す"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: str, value: str, ttl: float) -> None:
+        if ttl <= 0 or not value:
+            return
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def join(self, key: str) -> Optional[asyncio.Future]:
+        """同じキーで実行中のリクエストがあればその完了を待つFutureを返す
+
+        実行中のものがなければ、呼び出し元が実行役になり None を返す。
+        実行役は終わったら必ず finish() を呼ぶこと。
+        Futureが LeaderCancelled で終わったら、もう一度 join() からやり直すこと。
+        """
+        cached = self.get(key)
+        if cached is not None:
+            self.hits += 1
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(cached)
+            return future
+
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return future
+
+        self.misses += 1
+        self._inflight[key] = asyncio.get_running_loop().create_future()
+        return None
+
+    def finish(
+        self,
+        key: str,
+        ttl: float,
+        value: Optional[str] = None,
+        error: Optional[BaseException] = None,
+    ) -> None:
+        """実行役の結果を保存し、待っているリクエストに渡す"""
+        future = self._inflight.pop(key, None)
+        if error is None and value is not None:
+            self.put(key, value, ttl)
+
+        if future is None or future.done():
+            return
+        if isinstance(error, (asyncio.CancelledError, GeneratorExit)):
+            # 取り消されたのは実行役だけなので、待っている側には取り消しを伝えずやり直させる
+            error = LeaderCancelled()
+        if error is not None:
+            future.set_exception(error)
+            # 誰も待っていなくても警告を出さないようにする
+            future.exception()
+        else:
+            future.set_result(value or "")
+
+    async def get_or_create(
+        self, key: str, ttl: float, factory: Callable[[], Awaitable[str]]
+    ) -> str:
+        """キャッシュか実行中のリクエストの結果を使い、なければfactoryを実行する"""
+        while True:
+            future = self.join(key)
+            if future is None:
+                break
+            try:
+                return await asyncio.shield(future)
+            except LeaderCancelled:
+                continue
+
+        try:
+            value = await factory()
+        except BaseException as e:
+            self.finish(key, ttl, error=e)
+            raise
+        self.finish(key, ttl, value=value)
+        return value
+
+    def stats(self) -> Dict[str, float]:
+        """キャッシュの統計情報"""
+        total = self.hits + self.misses + self.coalesced
+        return {
+            "entries": len(self._entries),
+            "inflight": len(self._inflight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": (self.hits + self.coalesced) / total if total else 0.0,
+        }
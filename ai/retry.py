@@ -0,0 +1,270 @@
+import asyncio
+import random
+import re
+import time
+from typing import TYPE_CHECKING, AsyncIterator, Awaitable, Callable, Dict, Mapping, Optional
+
+from config import Config
+
+if TYPE_CHECKING:
+    import openai
+
+    from ai.deadline import Deadline
+
+
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_UNIT_SECONDS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_reset(value: Optional[str]) -> Optional[float]:
+    """「6m0s」「20ms」形式のリセット時間を秒に変換する"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION.findall(value)
+    if not parts:
+        return None
+    return sum(float(n) * _UNIT_SECONDS[unit] for n, unit in parts)
+
+
+def _to_int(value: Optional[str]) -> Optional[int]:
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class AdaptiveLimiter:
+    """OpenAIへの同時リクエスト数をAIMDで調整する
+
+    成功するたびに上限を少しずつ上げ（加算的増加）、429を受けたら半分にする
+    （乗算的減少）。レート制限ヘッダーで残りが尽きたと分かった場合は、
+    リセットされるまで新しいリクエストを待たせる。
+    """
+
+    def __init__(
+        self,
+        initial: float = Config.OPENAI_CONCURRENCY_INITIAL,
+        minimum: float = 1,
+        maximum: float = Config.OPENAI_CONCURRENCY_MAX,
+    ):
+        self.limit = float(initial)
+        self.minimum = float(minimum)
+        self.maximum = float(maximum)
+
+        self._active = 0
+        self._pause_until = 0.0
+        self._last_decrease = 0.0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self) -> None:
+        """枠が空くまで待って確保する（終わったら release() すること）"""
+        async with self._cond:
+            while True:
+                pause = self._pause_until - time.monotonic()
+                if pause > 0:
+                    # 待っている間に状況が変わることもあるので定期的に見直す
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), pause)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                if self._active < int(self.limit):
+                    break
+                await self._cond.wait()
+            self._active += 1
+
+    async def release(self) -> None:
+        async with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    def on_success(self) -> None:
+        self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+    def on_rate_limited(self, retry_after: Optional[float]) -> None:
+        now = time.monotonic()
+        # 同時に返ってきた429で何度も半分にしないよう、1秒に1回まで
+        if now - self._last_decrease >= 1.0:
+            self.limit = max(self.minimum, self.limit / 2)
+            self._last_decrease = now
+        if retry_after:
+            self.pause(retry_after)
+
+    def pause(self, seconds: float) -> None:
+        self._pause_until = max(self._pause_until, time.monotonic() + seconds)
+
+
+class _SlotStream:
+    """読み終えるか閉じるまで、同時実行の枠を持ち続けるストリーム
+
+    ストリーミングではレスポンスヘッダーが届いた後も生成が続くので、
+    ヘッダーの時点で枠を返すと同時に生成している数を制限できない。
+    """
+
+    def __init__(self, stream, release: Callable[[], Awaitable[None]]):
+        self._stream = stream
+        self._release: Optional[Callable[[], Awaitable[None]]] = release
+
+    def __aiter__(self) -> AsyncIterator:
+        return self._iterate()
+
+    async def _iterate(self) -> AsyncIterator:
+        try:
+            async for chunk in self._stream:
+                yield chunk
+        finally:
+            await self.close()
+
+    async def close(self) -> None:
+        try:
+            await self._stream.close()
+        finally:
+            release, self._release = self._release, None
+            if release is not None:
+                await release()
+
+    def __getattr__(self, name: str):
+        return getattr(self._stream, name)
+
+
+class OpenAIRetrier:
+    """レート制限とサーバーエラーを考慮してOpenAIを呼び出す
+
+    429・5xx・接続エラーは、締め切り（deadline）までジッター付きの
+    指数バックオフで再試行する。通常モデルと検索モデルのどちらの呼び出しも通る。
+    """
+
+    def __init__(self, get_client: Callable[[], "openai.AsyncOpenAI"]):
+        # SDKクライアントは初回の呼び出しまで作らない（OpenAIClient.client）
+        self.get_client = get_client
+        self.limiter = AdaptiveLimiter()
+        self.max_retries = Config.OPENAI_MAX_RETRIES
+        self.deadline = Config.OPENAI_RETRY_DEADLINE
+        self.backoff_base = 0.5
+        self.backoff_max = 8.0
+
+        # 統計情報
+        self.attempts = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.server_errors = 0
+        self.gave_up = 0
+        self.last_headers: Dict[str, Optional[float]] = {}
+
+    async def create(self, deadline: Optional["Deadline"] = None, **request):
+        """chat.completions.create を再試行付きで呼び出す
+
+        deadline（リクエスト全体の締め切り）を過ぎてしまう再試行はしない。
+        stream=True のときは、返したストリームを読み終えるか閉じるまで枠を返さない。
+        """
+        give_up_at = time.monotonic() + self.deadline
+        if deadline is not None:
+            give_up_at = min(give_up_at, deadline.expires_at)
+        attempt = 0
+        while True:
+            self.attempts += 1
+            try:
+                await self.limiter.acquire()
+                try:
+                    raw = await self.get_client().chat.completions.with_raw_response.create(**request)
+                    result = raw.parse()
+                except BaseException:
+                    await self.limiter.release()
+                    raise
+                if request.get("stream"):
+                    result = _SlotStream(result, self.limiter.release)
+                else:
+                    await self.limiter.release()
+                self._observe_headers(raw.headers)
+                self.limiter.on_success()
+                return result
+            except Exception as e:
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                if attempt >= self.max_retries or time.monotonic() + delay >= give_up_at:
+                    self.gave_up += 1
+                    raise
+                attempt += 1
+                self.retries += 1
+                print(
+                    f"OpenAI request failed ({type(e).__name__}, model={request.get('model')}), "
+                    f"retrying in {delay:.1f}s ({attempt}/{self.max_retries})"
+                )
+                await asyncio.sleep(delay)
+
+    def _retry_delay(self, error: Exception, attempt: int) -> Optional[float]:
+        """再試行までの待ち時間（再試行しないエラーならNone）"""
+        import openai
+
+        backoff = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+        if isinstance(error, openai.RateLimitError):
+            # 利用枠の超過は待っても回復しない
+            if error.code == "insufficient_quota":
+                return None
+            self.rate_limited += 1
+            retry_after = self._retry_after(error.response.headers)
+            self.limiter.on_rate_limited(retry_after)
+            return max(backoff, retry_after or 0.0)
+
+        if isinstance(error, openai.APIStatusError):
+            if error.status_code >= 500:
+                self.server_errors += 1
+                return backoff
+            return None
+
+        if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+            return backoff
+
+        return None
+
+    @staticmethod
+    def _retry_after(headers: Mapping[str, str]) -> Optional[float]:
+        retry_after = parse_reset(headers.get("retry-after"))
+        if retry_after is not None:
+            return retry_after
+        resets = [
+            parse_reset(headers.get("x-ratelimit-reset-requests")),
+            parse_reset(headers.get("x-ratelimit-reset-tokens")),
+        ]
+        resets = [r for r in resets if r is not None]
+        return min(resets) if resets else None
+
+    def _observe_headers(self, headers: Mapping[str, str]) -> None:
+        """残りリクエスト数・トークン数を見て、尽きていればリセットまで待たせる"""
+        remaining_requests = _to_int(headers.get("x-ratelimit-remaining-requests"))
+        remaining_tokens = _to_int(headers.get("x-ratelimit-remaining-tokens"))
+        reset_requests = parse_reset(headers.get("x-ratelimit-reset-requests"))
+        reset_tokens = parse_reset(headers.get("x-ratelimit-reset-tokens"))
+
+        self.last_headers = {
+            "remaining_requests": remaining_requests,
+            "remaining_tokens": remaining_tokens,
+            "reset_requests": reset_requests,
+            "reset_tokens": reset_tokens,
+        }
+
+        if remaining_requests == 0 and reset_requests:
+            self.limiter.pause(reset_requests)
+        if (
+            remaining_tokens is not None
+            and remaining_tokens < Config.OPENAI_MIN_REMAINING_TOKENS
+            and reset_tokens
+        ):
+            self.limiter.pause(reset_tokens)
+
+    def stats(self) -> Dict[str, float]:
+        """再試行・同時実行数の統計情報"""
+        return {
+            "concurrency_limit": self.limiter.limit,
+            "attempts": self.attempts,
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+            "server_errors": self.server_errors,
+            "gave_up": self.gave_up,
+        }
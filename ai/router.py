@@ -0,0 +1,96 @@
+import json
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+from ai.keyword_matcher import KeywordMatcher
+
+
+# ユーザーメッセージのうち、チャンネルの文脈の後に続く今回の発言の見出し
+QUESTION_HEADER = "【質問】\n"
+
+
+def question_part(message: str) -> str:
+    """チャンネルの文脈を除いた、今回の発言だけを返す"""
+    return message.rsplit(QUESTION_HEADER, 1)[-1]
+
+# ルールファイルが読めないときの既定値
+DEFAULT_RULES = {
+    "fast_max_chars": 40,
+    "fast_max_history_turns": 6,
+    "fast_max_last_reply_chars": 300,
+    "full_keywords": {},
+}
+
+
+class ModelRouter:
+    """リクエストの複雑さから、軽いモデルで足りるかを判定する
+
+    挨拶や一言の相づちのような短いやり取りは軽いモデル（fast）に、
+    質問・相談・画像付き・長い会話の途中などは通常のモデル（full）に回す。
+    判定の条件はJSONファイルから読み込み、更新されたら再起動なしで読み直す。
+    """
+
+    def __init__(self, path: str, reload_interval: float = 5.0):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._rules: Dict = dict(DEFAULT_RULES)
+        self._matcher = KeywordMatcher([])
+        self._mtime: Optional[float] = None
+        self._checked_at = 0.0
+        self._reload()
+
+    def _reload(self) -> None:
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime == self._mtime:
+                return
+            with open(self.path, encoding="utf-8") as f:
+                rules = dict(DEFAULT_RULES, **json.load(f))
+            self._matcher = KeywordMatcher(
+                (keyword.lower(), category)
+                for category, keywords in rules["full_keywords"].items()
+                for keyword in keywords
+            )
+            self._rules = rules
+            self._mtime = mtime
+            print(f"Loaded route rules from {self.path}")
+        except Exception as e:
+            # 読み込みに失敗したら前回のルールを使い続ける
+            print(f"Failed to load route rules: {e}")
+
+    def route(
+        self,
+        message: str,
+        image_urls: Optional[List[str]],
+        history: Optional[List[Dict]],
+    ) -> Tuple[str, str]:
+        """("fast" か "full", 理由) を返す"""
+        now = time.monotonic()
+        if now - self._checked_at >= self.reload_interval:
+            self._checked_at = now
+            self._reload()
+        rules = self._rules
+
+        if image_urls:
+            return "full", "image"
+
+        if len(message) > rules["fast_max_chars"]:
+            return "full", "long"
+
+        found = self._matcher.search(message.lower())
+        if found:
+            return "full", found[1]
+
+        # 長く続いている会話や、直前に詳しく答えた話題の続きは文脈が大事
+        history = history or []
+        if len(history) > rules["fast_max_history_turns"] * 2:
+            return "full", "deep_history"
+        last_reply = next(
+            (m.get("content") or "" for m in reversed(history) if m.get("role") == "assistant"),
+            "",
+        )
+        if len(last_reply) > rules["fast_max_last_reply_chars"]:
+            return "full", "follow_up"
+
+        return "fast", "trivial"
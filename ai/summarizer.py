@@ -0,0 +1,81 @@
+import asyncio
+from typing import Dict, List, Set, Tuple
+
+from ai.tokens import count_message_tokens, ensure_encoding
+from config import Config
+
+
+class HistorySummarizer:
+    """トークン予算からはみ出した古い会話を要約に畳み込む
+
+    応答の送信後にバックグラウンドで実行するので、応答時間には影響しない。
+    予算を超えたら半分まで減らすので、要約の作成は数往復に1回で済む。
+    保存できる往復数（history.max_history）の上限に近づいたときも、
+    上限で古い往復が消される前に半分まで畳み込む。
+    """
+
+    def __init__(self, ai_client, history):
+        self.ai_client = ai_client
+        self.history = history
+        self.budget = Config.HISTORY_TOKEN_BUDGET
+        self.model = Config.AI_MODEL
+
+        self._tasks: Set[asyncio.Task] = set()
+        self._running: Set[Tuple[int, int]] = set()  # 要約中の (channel_id, user_id)
+
+    def schedule(self, channel_id: int, user_id: int) -> None:
+        """必要なら要約をバックグラウンドで実行する"""
+        key = (channel_id, user_id)
+        if not Config.HISTORY_SUMMARY_ENABLED or key in self._running:
+            return
+
+        self._running.add(key)
+        task = asyncio.create_task(self._run(channel_id, user_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        task.add_done_callback(lambda _: self._running.discard(key))
+
+    def _select_folded(self, messages: List[Dict]) -> List[Dict]:
+        """予算・件数の半分に収まるまで古い往復を選ぶ（どちらにも余裕があれば空）"""
+        counts = [count_message_tokens(m, self.model) for m in messages]
+        total = sum(counts)
+        # 次の往復を足すと上限で消される件数（user + assistant で2件）
+        max_messages = (self.history.max_history - 1) * 2
+        if total <= self.budget and len(messages) < max_messages:
+            return []
+
+        target = self.budget // 2
+        end = 0
+        # 最後の1往復は必ず残す
+        while end < len(messages) - 2 and (total > target or len(messages) - end > max_messages // 2):
+            total -= counts[end]
+            end += 1
+        # ユーザー発言の手前で区切る
+        while end < len(messages) and messages[end].get("role") != "user":
+            end += 1
+        return messages[:end]
+
+    async def _run(self, channel_id: int, user_id: int) -> None:
+        try:
+            conversation = await self.history.get_conversation(channel_id, user_id)
+            await ensure_encoding(self.model)
+            folded = self._select_folded(conversation["messages"])
+            if not folded:
+                return
+
+            summary = await self.ai_client.summarize(conversation["summary"], folded)
+            if not summary:
+                return
+
+            compacted = await self.history.compact_history(
+                channel_id, user_id, folded, summary
+            )
+            if compacted:
+                print(f"Summarized {len(folded)} old message(s) for {channel_id}_{user_id}")
+        except Exception as e:
+            print(f"Failed to summarize history: {e}")
+
+    async def close(self) -> None:
+        """実行中の要約が終わるのを待つ"""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
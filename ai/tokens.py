@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import zlib
+from typing import Any, Dict, List
+
+logger = logging.getLogger(__name__)
+
+# メッセージ1件ごとにかかる役割・区切りのトークン
+MESSAGE_OVERHEAD = 4
+# 画像1枚あたりの見積もり（low detail相当）
+IMAGE_TOKENS = 85
+
+# モデル -> エンコーディング（読み込めなければ None）
+_encodings: Dict[str, Any] = {}
+
+
+def _load_encoding(model: str):
+    # tiktoken は読み込みが重いので、初めて使うときに import する
+    try:
+        import tiktoken
+    except ImportError:  # tiktokenがない場合は文字数から概算する
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # 未知のモデルはGPT-4o系と同じエンコーディングを使う
+        try:
+            return tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            logger.warning("Failed to load tokenizer: %s", e)
+            return None
+    except Exception as e:
+        logger.warning("Failed to load tokenizer: %s", e)
+        return None
+
+
+def _get_encoding(model: str):
+    if model not in _encodings:
+        _encodings[model] = _load_encoding(model)
+    return _encodings[model]
+
+
+async def ensure_encoding(model: str) -> bool:
+    """トークナイザーを読み込んでおく
+
+    初回は import とダウンロードでイベントループを止めないよう別スレッドで読み込む。
+    数える前に await しておけば、count_tokens() などはブロックしない。
+    """
+    if model not in _encodings:
+        await asyncio.to_thread(_get_encoding, model)
+    return _encodings[model] is not None
+
+
+def count_tokens(text: str, model: str) -> int:
+    """テキストのトークン数を数える"""
+    encoding = _get_encoding(model)
+    if encoding is None:
+        # 日本語はおおむね1文字1トークンなので文字数で見積もる
+        return len(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(message: Dict, model: str) -> int:
+    """チャットメッセージ1件のトークン数を数える"""
+    content = message.get("content") or ""
+    if isinstance(content, str):
+        return MESSAGE_OVERHEAD + count_tokens(content, model)
+
+    tokens = MESSAGE_OVERHEAD
+    for part in content:
+        if part.get("type") == "text":
+            tokens += count_tokens(part.get("text", ""), model)
+        else:
+            tokens += IMAGE_TOKENS
+    return tokens
+
+
+def count_messages_tokens(messages: List[Dict], model: str) -> int:
+    """チャットメッセージ全体のトークン数を数える"""
+    return sum(count_message_tokens(m, model) for m in messages)
+
+
+def fit_history(history: List[Dict], budget: int, model: str) -> List[Dict]:
+    """新しい順にトークン予算に収まるだけの履歴を残す
+
+    ユーザー発言から始まるように、はみ出した往復はまとめて落とす。
+    """
+    if not history:
+        return []
+
+    counts = [count_message_tokens(m, model) for m in history]
+    total = sum(counts)
+    if total <= budget:
+        return history
+
+    start = 0
+    while start < len(history) and total > budget:
+        total -= counts[start]
+        start += 1
+    # assistantの発言から始まらないようにする
+    while start < len(history) and history[start].get("role") != "user":
+        start += 1
+    return history[start:]
+
+
+def _is_anchor(message: Dict, anchor_turns: int) -> bool:
+    content = message.get("content") or ""
+    if not isinstance(content, str):
+        content = str(content)
+    return zlib.crc32(content.encode()) % anchor_turns == 0
+
+
+def stable_history_start(history: List[Dict], anchor_turns: int) -> List[Dict]:
+    """履歴の始まりを「目印」のユーザー発言に揃え、先頭が数往復のあいだ変わらないようにする
+
+    上限に達した履歴は古い往復が1つずつ消えるので、そのまま送るとプロンプトの先頭が
+    毎回ずれてOpenAIのプロンプトキャッシュが効かない。内容のハッシュでおよそ
+    anchor_turns 往復に1つ選ばれる目印から始めれば、その目印が消えるまで先頭が同じになる。
+    目印は先頭の anchor_turns 往復の中だけで探す（見つからなければそのまま返す）。
+    """
+    if anchor_turns <= 1:
+        return history
+    for i, message in enumerate(history[: anchor_turns * 2]):
+        if message.get("role") == "user" and _is_anchor(message, anchor_turns):
+            return history[i:]
+    return history
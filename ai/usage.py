@@ -0,0 +1,57 @@
+from typing import Dict
+
+from metrics import OPENAI_PROMPT_CACHE_HIT_RATIO, OPENAI_TOKENS
+
+
+class UsageTracker:
+    """モデルごとのトークン使用量と、プロンプトキャッシュのヒット率を集計する
+
+    OpenAIは1024トークン以上の同じ先頭部分を自動でキャッシュし、その分は
+    usage.prompt_tokens_details.cached_tokens として返ってくる（料金・待ち時間が減る）。
+    """
+
+    def __init__(self):
+        self._models: Dict[str, Dict[str, int]] = {}
+
+    def record(self, model: str, route: str, usage) -> Dict[str, int]:
+        """1リクエスト分の使用量を記録し、{"prompt", "cached", "completion"} を返す"""
+        details = getattr(usage, "prompt_tokens_details", None)
+        tokens = {
+            "prompt": usage.prompt_tokens or 0,
+            "cached": (getattr(details, "cached_tokens", None) or 0) if details else 0,
+            "completion": usage.completion_tokens or 0,
+        }
+        totals = self._models.setdefault(
+            model, {"requests": 0, "prompt": 0, "cached": 0, "completion": 0}
+        )
+        totals["requests"] += 1
+        for kind, count in tokens.items():
+            totals[kind] += count
+            OPENAI_TOKENS.inc(count, model=model, route=route, kind=kind)
+        OPENAI_PROMPT_CACHE_HIT_RATIO.set(self.hit_ratio(model), model=model)
+        return tokens
+
+    def hit_ratio(self, model: str) -> float:
+        """プロンプトトークンのうちキャッシュから読まれた割合"""
+        totals = self._models.get(model)
+        if not totals or not totals["prompt"]:
+            return 0.0
+        return totals["cached"] / totals["prompt"]
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """モデルごとの累計とヒット率"""
+        return {
+            model: dict(totals, hit_ratio=self.hit_ratio(model))
+            for model, totals in self._models.items()
+        }
+
+    def report(self) -> str:
+        """モデルごとのヒット率の一覧"""
+        lines = ["Prompt cache by model:"]
+        for model, totals in sorted(self._models.items()):
+            lines.append(
+                f"  {model}: requests={totals['requests']} prompt={totals['prompt']} "
+                f"cached={totals['cached']} ({self.hit_ratio(model):.1%}) "
+                f"completion={totals['completion']}"
+            )
+        return "\n".join(lines)
@@ -0,0 +1,89 @@
+"""画像パイプラインのベンチマーク
+
+サンプル画像を生成し、従来の方式（そのままbase64で埋め込み）と
+ImagePipeline（縮小・再圧縮 / URLパススルー）でリクエストボディの
+サイズとPythonヒープのピーク使用量を比較する。
+
+    python -m benchmarks.bench_image_pipeline
+"""
+import base64
+import io
+import json
+import tracemalloc
+
+from PIL import Image
+
+from ai.image_pipeline import shrink_image
+from config import Config
+
+
+def make_sample(width: int, height: int, fmt: str) -> bytes:
+    """写真に近い（圧縮しにくい）サンプル画像を作る"""
+    img = Image.effect_noise((width, height), 64).convert("RGB")
+    out = io.BytesIO()
+    img.save(out, format=fmt)
+    return out.getvalue()
+
+
+def legacy_body(data: bytes, content_type: str) -> str:
+    b64 = base64.b64encode(data).decode("utf-8")
+    return _body(f"data:{content_type};base64,{b64}")
+
+
+def pipeline_body(data: bytes, content_type: str) -> str:
+    data, content_type = shrink_image(
+        data, content_type, Config.IMAGE_MAX_DIMENSION, Config.IMAGE_JPEG_QUALITY
+    )
+    b64 = base64.b64encode(data).decode("ascii")
+    return _body(f"data:{content_type};base64,{b64}")
+
+
+def url_body(url: str) -> str:
+    return _body(url)
+
+
+def _body(image_url: str) -> str:
+    return json.dumps(
+        {
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": "この画像について説明してください"},
+                        {"type": "image_url", "image_url": {"url": image_url}},
+                    ],
+                }
+            ]
+        }
+    )
+
+
+def measure(fn, *args):
+    tracemalloc.start()
+    body = fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(body), peak
+
+
+def main():
+    samples = [
+        ("4000x3000 PNG", make_sample(4000, 3000, "PNG"), "image/png"),
+        ("1920x1080 JPEG", make_sample(1920, 1080, "JPEG"), "image/jpeg"),
+        ("800x600 PNG", make_sample(800, 600, "PNG"), "image/png"),
+    ]
+    url = "https://cdn.discordapp.com/attachments/1/2/image.png?ex=0&is=0&hm=0"
+
+    print(f"{'sample':<16}{'mode':<10}{'body KiB':>12}{'peak KiB':>12}")
+    for name, data, content_type in samples:
+        for mode, fn, args in (
+            ("legacy", legacy_body, (data, content_type)),
+            ("inline", pipeline_body, (data, content_type)),
+            ("url", url_body, (url,)),
+        ):
+            size, peak = measure(fn, *args)
+            print(f"{name:<16}{mode:<10}{size / 1024:>12.1f}{peak / 1024:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Web検索キーワード判定のベンチマーク
+
+従来の線形スキャン（キーワードごとに `keyword in message`）と
+Aho-Corasick の KeywordMatcher を、長いメッセージと大きなキーワード集合で比較する。
+KeywordMatcher はキーワードが LINEAR_SCAN_MAX_KEYWORDS 個以下なら線形スキャンに切り替えるので、
+実際のキーワード数（百数十）では両者がほぼ同じになる。
+
+    python -m benchmarks.bench_keyword_matcher
+"""
+import random
+import timeit
+
+from ai.keyword_matcher import KeywordMatcher, SearchKeywordRouter
+from config import Config
+
+KANA = "あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわをん"
+
+
+def linear_scan(keywords, message: str) -> bool:
+    """従来の実装と同じ判定"""
+    message_lower = message.lower()
+    for keyword in keywords:
+        if keyword in message_lower:
+            return True
+    return False
+
+
+def synthetic_keywords(n: int, rng: random.Random):
+    # メッセージに出てこないようカタカナ語にする
+    return [
+        "".join(chr(ord(c) + 0x60) for c in rng.choices(KANA, k=rng.randint(3, 6)))
+        for _ in range(n)
+    ]
+
+
+def main():
+    rng = random.Random(0)
+    base = SearchKeywordRouter.load_keywords(Config.SEARCH_KEYWORDS_PATH)
+
+    filler = "".join(rng.choices(KANA + "、。", k=2000))
+    messages = {
+        "2000字・該当なし": filler,
+        "2000字・末尾で該当": filler + "転職",
+        "30字・該当なし": filler[:30],
+    }
+
+    print(f"{'keywords':>9} {'message':<18}{'linear µs':>12}{'matcher µs':>12}{'speedup':>9}")
+    for extra in (0, 1000, 5000):
+        pairs = base + [(k, "synthetic") for k in synthetic_keywords(extra, rng)]
+        keywords = [k for k, _ in pairs]
+        matcher = KeywordMatcher(pairs)
+
+        for name, message in messages.items():
+            # 両者の判定が一致することを確認
+            assert linear_scan(keywords, message) == (matcher.search(message.lower()) is not None)
+
+            n = 200
+            t_linear = timeit.timeit(lambda: linear_scan(keywords, message), number=n) / n
+            t_matcher = timeit.timeit(lambda: matcher.search(message.lower()), number=n) / n
+            print(
+                f"{len(pairs):>9} {name:<18}{t_linear * 1e6:>12.1f}"
+                f"{t_matcher * 1e6:>12.1f}{t_linear / t_matcher:>8.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
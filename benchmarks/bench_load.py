@@ -0,0 +1,255 @@
+"""返信パイプライン全体の負荷試験
+
+OpenAI互換の偽サーバー・メモリ上の履歴・偽のDiscordチャンネルを使い、
+MessageHandler.on_message と SlashCommands.ask に合成したリクエストを
+同時実行数ごとに流して、次の値を表示する。
+
+- 応答時間（返信が最後に更新されるまで）と最初の返信までの時間の p50/p95/p99
+- スループット（件/秒）、混雑・エラーで返した件数
+- イベントループの遅れ（p99・最大）、ピークRSS
+- プロンプトトークンのうちキャッシュされた割合（偽サーバーがOpenAIの挙動を真似る）
+- イベントハンドラーが（ジョブを積んで）戻るまでの時間の p99
+
+    python -m benchmarks.bench_load --concurrency 1,8,32 --requests 200
+    python -m benchmarks.bench_load --no-stream --openai-latency 1.0 --max-p95 5
+
+--max-p95 を指定すると、p95がそれを超えたときに終了コード1で終わる
+（デプロイ前の性能劣化チェック用）。
+"""
+import argparse
+import asyncio
+import contextlib
+import math
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import List
+
+from benchmarks.fakes import (
+    BOT_USER,
+    FakeChannel,
+    FakeInteraction,
+    FakeOpenAIServer,
+    InMemoryHistory,
+    make_mention,
+    make_user,
+)
+from ai.deadline import TIMEOUT_MESSAGE
+from bot.admission import BUSY_MESSAGE, AdmissionController
+from bot.outbound import OutboundDispatcher
+from config import Config
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+async def sample_loop_lag(samples: List[float], interval: float = 0.01) -> None:
+    """interval 秒ごとに起き、予定からの遅れを記録する"""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, time.perf_counter() - start - interval))
+
+
+def build(args):
+    # OpenAIClient などは Config を読むので、ここで読み込む
+    from ai.openai_client import OpenAIClient
+    from ai.summarizer import HistorySummarizer
+    from bot.commands import SlashCommands
+    from bot.events import MessageHandler
+    from bot.jobs import JobWorkerPool
+    from storage.history_cache import CachedConversationHistory
+    from storage.job_queue import JobQueue
+
+    ai_client = OpenAIClient()
+    if args.history == "sqlite":
+        from storage.sqlite_history import SQLiteHistory
+
+        backend = SQLiteHistory(os.path.join(args.tmpdir, "history.sqlite3"))
+    else:
+        backend = InMemoryHistory(latency=args.history_latency)
+    history = CachedConversationHistory(backend)
+    admission = AdmissionController(max_concurrent=args.max_concurrent)
+    services = SimpleNamespace(
+        ai_client=ai_client,
+        history=history,
+        summarizer=HistorySummarizer(ai_client, history),
+        admission=admission,
+        outbound=OutboundDispatcher(),
+        jobs=JobWorkerPool(
+            JobQueue(tempfile.mktemp(suffix=".sqlite3", dir=args.tmpdir)),
+            admission,
+            workers=args.workers,
+            max_pending=args.max_queue,
+        ),
+    )
+    bot = SimpleNamespace(user=BOT_USER)
+    return services, MessageHandler(bot, services), SlashCommands(bot, services)
+
+
+async def close(services) -> None:
+    await services.jobs.close()
+    await services.outbound.close()
+    await services.summarizer.close()
+    await services.history.close()
+    await services.ai_client.close()
+
+
+async def run_level(args, concurrency: int) -> dict:
+    services, handler, commands = build(args)
+    channels = [
+        FakeChannel(10_000 + i, send_latency=args.send_latency)
+        for i in range(math.ceil(concurrency / args.users_per_channel))
+    ]
+    requests = []
+    handler_seconds: List[float] = []  # イベントハンドラーが戻るまで（ジョブを積むだけ）
+    remaining = args.requests
+    # 本番と同じく、計測前にSDKの読み込みと接続を済ませる
+    await services.ai_client.warm_up()
+    await services.jobs.start()
+
+    async def user(index: int) -> None:
+        nonlocal remaining
+        author = make_user(100_000 + index)
+        channel = channels[index // args.users_per_channel]
+        n = 0
+        while remaining > 0:
+            remaining -= 1
+            n += 1
+            text = f"質問{n}: Pythonのリスト内包表記について教えて"
+            use_ask = args.mode == "ask" or (args.mode == "mixed" and n % 2 == 0)
+            if use_ask:
+                interaction = FakeInteraction(channel, author)
+                await commands.ask.callback(commands, interaction, text, None)
+                request = interaction.request
+                enqueued = time.perf_counter()
+                # 混雑で断られたものはジョブにならない
+                if request.first_content != BUSY_MESSAGE:
+                    await services.jobs.wait("ask", interaction.id)
+            else:
+                message = make_mention(channel, author, text)
+                await handler.on_message(message)
+                request = message.request
+                enqueued = time.perf_counter()
+                if request.first_content != BUSY_MESSAGE:
+                    await services.jobs.wait("mention", message.id)
+            handler_seconds.append(enqueued - request.started)
+            request.finished = time.perf_counter()
+            requests.append(request)
+
+    lag: List[float] = []
+    sampler = asyncio.create_task(sample_loop_lag(lag))
+    start = time.perf_counter()
+    await asyncio.gather(*(user(i) for i in range(concurrency)))
+    await services.outbound.close()
+    elapsed = time.perf_counter() - start
+    sampler.cancel()
+    await close(services)
+
+    failed = [
+        r for r in requests
+        if r.first_content in (BUSY_MESSAGE, TIMEOUT_MESSAGE) or r.first_content.startswith("エラー")
+    ]
+    ok = [r for r in requests if r not in failed]
+    latencies = [r.latency for r in ok]
+    first = [r.first_reply - r.started for r in ok if r.first_reply is not None]
+    return {
+        "concurrency": concurrency,
+        "requests": len(requests),
+        "failed": len(failed),
+        "throughput": len(ok) / elapsed,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "first_p50": percentile(first, 50),
+        "first_p95": percentile(first, 95),
+        "lag_p99": percentile(lag, 99),
+        "lag_max": max(lag, default=0.0),
+        # Linuxでは KiB 単位
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "cache_hit": services.ai_client.usage.hit_ratio(services.ai_client.model),
+        "handler_p99": percentile(handler_seconds, 99),
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", default="1,8,32", help="同時ユーザー数（カンマ区切り）")
+    parser.add_argument("--requests", type=int, default=200, help="同時実行数ごとのリクエスト数")
+    parser.add_argument("--mode", choices=("mention", "ask", "mixed"), default="mixed")
+    parser.add_argument("--stream", action=argparse.BooleanOptionalAction, default=Config.STREAMING_ENABLED)
+    parser.add_argument("--openai-latency", type=float, default=0.5, help="最初のトークンまでの秒数")
+    parser.add_argument("--slow-ratio", type=float, default=0.0, help="最初のトークンまで10倍かかるリクエストの割合")
+    parser.add_argument("--token-delay", type=float, default=0.005, help="トークン間の秒数")
+    parser.add_argument("--tokens", type=int, default=200, help="応答のトークン数")
+    parser.add_argument(
+        "--history", choices=("memory", "sqlite"), default="memory",
+        help="履歴の保存先（memory は --history-latency の待ちを入れたメモリ上の履歴）",
+    )
+    parser.add_argument("--history-latency", type=float, default=0.02, help="履歴ストアの往復秒数")
+    parser.add_argument("--send-latency", type=float, default=0.05, help="Discordへの送信・編集の秒数")
+    parser.add_argument("--users-per-channel", type=int, default=4)
+    parser.add_argument("--max-concurrent", type=int, default=Config.AI_MAX_CONCURRENT)
+    parser.add_argument("--workers", type=int, default=Config.JOB_WORKERS, help="ジョブのワーカー数")
+    parser.add_argument(
+        "--max-queue", type=int, default=Config.JOB_MAX_BACKLOG, help="処理待ちジョブの上限"
+    )
+    parser.add_argument("--max-p95", type=float, default=None, help="p95の上限（秒）")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    server = FakeOpenAIServer(args.openai_latency, args.token_delay, args.tokens, args.slow_ratio)
+    server.start()
+
+    args.tmpdir = tempfile.mkdtemp(prefix="bench_load_")
+    os.environ["OPENAI_BASE_URL"] = server.base_url
+    Config.OPENAI_API_KEY = Config.OPENAI_API_KEY or "bench"
+    Config.STREAMING_ENABLED = args.stream
+
+    print(
+        f"mode={args.mode} stream={args.stream} openai_latency={args.openai_latency}s "
+        f"tokens={args.tokens} history={args.history} history_latency={args.history_latency}s "
+        f"send_latency={args.send_latency}s"
+    )
+    header = (
+        f"{'conc':>5}{'reqs':>6}{'fail':>6}{'req/s':>8}{'p50':>8}{'p95':>8}{'p99':>8}"
+        f"{'1st p50':>9}{'1st p95':>9}{'lag p99':>9}{'lag max':>9}{'RSS MB':>8}{'cached':>8}{'hdl p99':>9}"
+    )
+    print(header)
+
+    regressed = False
+    try:
+        for concurrency in (int(c) for c in args.concurrency.split(",")):
+            # アプリのログ出力は計測の邪魔になるので捨てる
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                r = asyncio.run(run_level(args, concurrency))
+            print(
+                f"{r['concurrency']:>5}{r['requests']:>6}{r['failed']:>6}{r['throughput']:>8.1f}"
+                f"{r['p50']:>8.3f}{r['p95']:>8.3f}{r['p99']:>8.3f}"
+                f"{r['first_p50']:>9.3f}{r['first_p95']:>9.3f}"
+                f"{r['lag_p99'] * 1000:>7.1f}ms{r['lag_max'] * 1000:>7.1f}ms{r['peak_rss_mb']:>8.1f}"
+                f"{r['cache_hit']:>8.1%}{r['handler_p99'] * 1000:>7.1f}ms"
+            )
+            if args.max_p95 is not None and r["p95"] > args.max_p95:
+                regressed = True
+    finally:
+        server.stop()
+        shutil.rmtree(args.tmpdir, ignore_errors=True)
+
+    if regressed:
+        print(f"p95 exceeded {args.max_p95}s")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""on_message の入口フィルタのベンチマーク
+
+大量のメッセージ（大半はメンションなし、一部はメンション・重複あり）を流し、
+従来の実装（毎回のprint・スライス・dict再構築）と、新しい入口
+（直近メッセージの記録 + MessageHandler._should_handle）が
+1秒あたり何件さばけるかを比較する。
+
+    python -m benchmarks.bench_message_filter
+"""
+import contextlib
+import os
+import random
+import time
+from types import SimpleNamespace
+
+from bot.events import MessageHandler
+
+BOT_USER = SimpleNamespace(id=1, bot=True)
+
+
+def make_stream(n: int, mention_rate: float, duplicate_rate: float, rng: random.Random):
+    """メッセージの列を作る（重複はゲートウェイの再送を想定）"""
+    human = SimpleNamespace(id=2, bot=False, display_name="user")
+    channels = [SimpleNamespace(id=c) for c in range(100)]
+    messages = []
+    for i in range(n):
+        if messages and rng.random() < duplicate_rate:
+            messages.append(messages[-1])
+            continue
+        mentioned = rng.random() < mention_rate
+        messages.append(
+            SimpleNamespace(
+                id=i,
+                author=human,
+                channel=rng.choice(channels),
+                mentions=[BOT_USER] if mentioned else [],
+                content=("<@1> " if mentioned else "") + "今日の天気はどうかな？" * 4,
+            )
+        )
+    return messages
+
+
+class LegacyFilter:
+    """従来の on_message の判定部分"""
+
+    def __init__(self):
+        self._processed = {}
+
+    def should_handle(self, message) -> bool:
+        print(f"[DEBUG] Message received: {message.content[:50]}...")
+        if message.author.bot:
+            print("[DEBUG] Ignored: bot message")
+            return False
+        if not (BOT_USER and BOT_USER in message.mentions):
+            print("[DEBUG] Ignored: not mentioned")
+            return False
+        now = time.time()
+        if message.id in self._processed:
+            print("[DEBUG] Ignored: already processed")
+            return False
+        self._processed = {k: v for k, v in self._processed.items() if now - v < 60}
+        self._processed[message.id] = now
+        print("[DEBUG] Bot was mentioned! Processing...")
+        return True
+
+
+def make_handler() -> MessageHandler:
+    bot = SimpleNamespace(user=BOT_USER)
+    # 入口の判定だけを測るので、応答に使うものは空でよい
+    jobs = SimpleNamespace(register=lambda kind, run, on_failure: None)
+    services = SimpleNamespace(
+        ai_client=None, history=None, summarizer=None, admission=None, outbound=None, jobs=jobs
+    )
+    return MessageHandler(bot, services)
+
+
+def new_filter(handler: MessageHandler):
+    """on_message の入口と同じく、記録してから判定する"""
+
+    def should_handle(message) -> bool:
+        handler._recent.record(message)
+        return handler._should_handle(message)
+
+    return should_handle
+
+
+def run(should_handle, messages) -> float:
+    start = time.perf_counter()
+    for message in messages:
+        should_handle(message)
+    return len(messages) / (time.perf_counter() - start)
+
+
+def main():
+    rng = random.Random(0)
+    n = 200_000
+    print(f"{'mention rate':>12}{'legacy msg/s':>16}{'new msg/s':>16}{'speedup':>10}")
+    for mention_rate in (0.001, 0.01, 0.1):
+        messages = make_stream(n, mention_rate, 0.01, rng)
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            legacy = run(LegacyFilter().should_handle, messages)
+        new = run(new_filter(make_handler()), messages)
+        print(f"{mention_rate:>12}{legacy:>16,.0f}{new:>16,.0f}{new / legacy:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
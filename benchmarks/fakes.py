@@ -0,0 +1,385 @@
+"""負荷試験用のローカルな代役（OpenAI・Firestore・Discord）
+
+- FakeOpenAIServer: OpenAI互換の /v1/chat/completions を返すHTTPサーバー。
+  別プロセスで動かすので、ベンチマーク対象のイベントループを邪魔しない。
+- InMemoryHistory: メモリ上の履歴（HistoryBackend の実装）。
+- FakeChannel / FakeMessage / FakeInteraction: on_message と /ask に渡す
+  Discordオブジェクトの代わり。送信・編集の時刻を記録する。
+"""
+import asyncio
+import hashlib
+import itertools
+import json
+import multiprocessing
+import random
+import socket
+import time
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+from typing import AsyncIterator, Dict, List, Optional
+
+from aiohttp import web
+
+from storage.base import HistoryBackend
+
+
+# --- OpenAI ---
+
+
+def _completion_chunk(model: str, content: Optional[str], usage: Optional[Dict] = None) -> Dict:
+    choices = [] if content is None else [
+        {"index": 0, "delta": {"content": content}, "finish_reason": None}
+    ]
+    return {
+        "id": "chatcmpl-bench",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": choices,
+        "usage": usage,
+    }
+
+
+def _cached_tokens(seen: set, model: str, messages: List[Dict]) -> int:
+    """OpenAIのプロンプトキャッシュを真似て、以前と一致する先頭部分のトークン数を返す
+
+    メッセージ単位で一致を見て、1024トークン以上なら128トークン単位に切り捨てる。
+    """
+    cached = 0
+    prefix = hashlib.sha256(model.encode())
+    length = 0
+    for message in messages:
+        prefix.update(json.dumps(message, sort_keys=True, ensure_ascii=False).encode())
+        length += len(str(message.get("content", "")))
+        key = prefix.hexdigest()
+        if key in seen:
+            cached = length
+        seen.add(key)
+    return cached // 128 * 128 if cached >= 1024 else 0
+
+
+def _make_app(
+    latency: float, token_delay: float, tokens: int, slow_ratio: float = 0.0
+) -> web.Application:
+    seen_prefixes: set = set()
+
+    async def completions(request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        model = body.get("model", "gpt-4o")
+        messages = body.get("messages", [])
+        # 日本語はおおむね1文字1トークン
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in messages)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": tokens,
+            "total_tokens": prompt_tokens + tokens,
+            "prompt_tokens_details": {
+                "cached_tokens": _cached_tokens(seen_prefixes, model, messages)
+            },
+        }
+        headers = {
+            "x-ratelimit-remaining-requests": "10000",
+            "x-ratelimit-remaining-tokens": "10000000",
+        }
+
+        # 最初のトークンまでの待ち時間（slow_ratio の割合で10倍遅くなる）
+        await asyncio.sleep(latency * (10 if random.random() < slow_ratio else 1))
+
+        if not body.get("stream"):
+            await asyncio.sleep(token_delay * tokens)
+            return web.json_response(
+                {
+                    "id": "chatcmpl-bench",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": "あ" * tokens},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": usage,
+                },
+                headers=headers,
+            )
+
+        response = web.StreamResponse(
+            headers={"Content-Type": "text/event-stream", **headers}
+        )
+        try:
+            await response.prepare(request)
+            for _ in range(tokens):
+                chunk = _completion_chunk(model, "あ")
+                await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                if token_delay:
+                    await asyncio.sleep(token_delay)
+            chunk = _completion_chunk(model, None, usage)
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+        except ConnectionResetError:
+            # ヘッジで負けたリクエストなど、クライアントが途中で切った
+            pass
+        return response
+
+    async def model(request: web.Request) -> web.Response:
+        # 接続の事前確立（OpenAIClient.warm_up）用
+        return web.json_response(
+            {"id": request.match_info["model"], "object": "model", "created": 0, "owned_by": "bench"}
+        )
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", completions)
+    app.router.add_get("/v1/models/{model}", model)
+    return app
+
+
+def _serve(port: int, latency: float, token_delay: float, tokens: int, slow_ratio: float) -> None:
+    web.run_app(
+        _make_app(latency, token_delay, tokens, slow_ratio),
+        host="127.0.0.1",
+        port=port,
+        print=None,
+        access_log=None,
+    )
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class FakeOpenAIServer:
+    """OpenAI互換のチャットAPIを別プロセスで起動する
+
+    latency 秒待ってから、tokens 個のトークンを token_delay 秒おきに返す。
+    slow_ratio の割合のリクエストは、最初のトークンまで latency の10倍かかる（裾の遅延）。
+    """
+
+    def __init__(
+        self, latency: float = 0.5, token_delay: float = 0.0, tokens: int = 200, slow_ratio: float = 0.0
+    ):
+        self.latency = latency
+        self.slow_ratio = slow_ratio
+        self.token_delay = token_delay
+        self.tokens = tokens
+        self.port = _free_port()
+        self._process: Optional[multiprocessing.Process] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    def start(self) -> None:
+        self._process = multiprocessing.Process(
+            target=_serve,
+            args=(self.port, self.latency, self.token_delay, self.tokens, self.slow_ratio),
+            daemon=True,
+        )
+        self._process.start()
+        # 待ち受けを始めるまで待つ
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            try:
+                with socket.create_connection(("127.0.0.1", self.port), timeout=0.1):
+                    return
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError("fake OpenAI server did not start")
+
+    def stop(self) -> None:
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+
+
+# --- 会話履歴 ---
+
+
+class InMemoryHistory(HistoryBackend):
+    """メモリ上の会話履歴
+
+    latency 秒の待ちを入れて、Firestoreの往復時間を真似る。
+    """
+
+    def __init__(self, latency: float = 0.02):
+        super().__init__()
+        self.latency = latency
+        self._docs: Dict[str, Dict] = {}
+
+    async def get_conversation(self, channel_id: int, user_id: int) -> Dict:
+        await asyncio.sleep(self.latency)
+        doc = self._docs.get(self._get_doc_id(channel_id, user_id))
+        if doc is None:
+            return {"messages": [], "summary": ""}
+        return {"messages": list(doc["messages"]), "summary": doc["summary"]}
+
+    async def append_messages(self, channel_id: int, user_id: int, new_messages: List[Dict]) -> None:
+        await asyncio.sleep(self.latency)
+        doc = self._docs.setdefault(
+            self._get_doc_id(channel_id, user_id),
+            {"channel_id": channel_id, "user_id": user_id, "messages": [], "summary": ""},
+        )
+        doc["messages"] = (doc["messages"] + list(new_messages))[-self.max_history * 2 :]
+        doc["updated_at"] = time.time()
+
+    async def compact_history(
+        self, channel_id: int, user_id: int, folded: List[Dict], summary: str
+    ) -> bool:
+        await asyncio.sleep(self.latency)
+        doc = self._docs.get(self._get_doc_id(channel_id, user_id))
+        if doc is None or doc["messages"][: len(folded)] != folded:
+            return False
+        doc["messages"] = doc["messages"][len(folded) :]
+        doc["summary"] = summary
+        return True
+
+    async def clear_history(self, channel_id: int, user_id: int) -> bool:
+        await asyncio.sleep(self.latency)
+        return self._docs.pop(self._get_doc_id(channel_id, user_id), None) is not None
+
+    async def delete_idle(self, cutoff: float, batch_size: int) -> int:
+        await asyncio.sleep(self.latency)
+        idle = [k for k, doc in self._docs.items() if doc.get("updated_at", 0.0) < cutoff]
+        for doc_id in idle[:batch_size]:
+            del self._docs[doc_id]
+        return min(len(idle), batch_size)
+
+    async def iter_conversations(self) -> AsyncIterator[Dict]:
+        for doc in list(self._docs.values()):
+            yield dict(doc, messages=list(doc["messages"]))
+
+    async def import_conversation(self, conversation: Dict) -> None:
+        doc_id = self._get_doc_id(conversation["channel_id"], conversation["user_id"])
+        self._docs[doc_id] = dict(conversation, messages=list(conversation["messages"]))
+
+
+# --- Discord ---
+
+_ids = itertools.count(1_000_000)
+
+
+class Request:
+    """1件のリクエスト（メンション / /ask）の計測結果"""
+
+    __slots__ = ("started", "first_reply", "first_content", "last_update", "finished")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.first_reply: Optional[float] = None
+        self.first_content = ""
+        self.last_update: Optional[float] = None
+        self.finished: Optional[float] = None
+
+    def touch(self, content: str) -> None:
+        now = time.perf_counter()
+        if self.first_reply is None:
+            self.first_reply = now
+            self.first_content = content
+        self.last_update = now
+
+    @property
+    def latency(self) -> float:
+        """返信が最後に更新されるか、ハンドラーが戻るまでの時間"""
+        end = max(self.finished or 0.0, self.last_update or 0.0)
+        return end - self.started
+
+
+class FakeMessage:
+    def __init__(self, channel: "FakeChannel", author, content: str, mentions=(), request: Optional[Request] = None):
+        self.id = next(_ids)
+        self.channel = channel
+        self.guild = None
+        self.author = author
+        self.content = content
+        self.mentions = list(mentions)
+        self.role_mentions: List = []
+        self.attachments: List = []
+        self.request = request
+
+    async def reply(self, content: str) -> "FakeMessage":
+        return await self.channel._post(content, self.request)
+
+    async def edit(self, content: str) -> "FakeMessage":
+        await asyncio.sleep(self.channel.send_latency)
+        self.content = content
+        if self.request is not None:
+            self.request.touch(content)
+        return self
+
+
+class FakeChannel:
+    """送信に send_latency 秒かかるチャンネル"""
+
+    def __init__(self, channel_id: int, send_latency: float = 0.05):
+        self.id = channel_id
+        self.send_latency = send_latency
+        self.sent = 0
+
+    async def _post(self, content: str, request: Optional[Request]) -> FakeMessage:
+        await asyncio.sleep(self.send_latency)
+        self.sent += 1
+        if request is not None:
+            request.touch(content)
+        return FakeMessage(self, BOT_USER, content, request=request)
+
+    async def send(self, content: str) -> FakeMessage:
+        return await self._post(content, None)
+
+    @asynccontextmanager
+    async def typing(self):
+        yield
+
+    async def history(self, limit: int = 100, before=None):
+        # 起動直後のチャンネルと同じく、過去のメッセージはない
+        return
+        yield
+
+
+BOT_USER = SimpleNamespace(id=1, bot=True, display_name="bot")
+
+
+def make_user(user_id: int):
+    return SimpleNamespace(id=user_id, bot=False, display_name=f"user{user_id}")
+
+
+def make_mention(channel: FakeChannel, user, text: str) -> FakeMessage:
+    """Botへのメンション付きメッセージを作る"""
+    request = Request()
+    return FakeMessage(channel, user, f"<@{BOT_USER.id}> {text}", [BOT_USER], request)
+
+
+class _Followup:
+    def __init__(self, interaction: "FakeInteraction"):
+        self._interaction = interaction
+
+    async def send(self, content: str = "", wait: bool = False, **kwargs) -> FakeMessage:
+        interaction = self._interaction
+        return await interaction.channel._post(content, interaction.request)
+
+
+class _InteractionResponse:
+    async def defer(self, **kwargs) -> None:
+        pass
+
+    async def send_message(self, *args, **kwargs) -> None:
+        pass
+
+
+class FakeInteraction:
+    """/ask に渡すインタラクションの代わり"""
+
+    def __init__(self, channel: FakeChannel, user):
+        self.id = next(_ids)
+        self.application_id = BOT_USER.id
+        self.token = "bench"
+        self.guild = None
+        self.channel = channel
+        self.channel_id = channel.id
+        self.user = user
+        self.request = Request()
+        self.response = _InteractionResponse()
+        self.followup = _Followup(self)
@@ -0,0 +1,85 @@
+from typing import Dict, List, Tuple
+
+from config import Config
+
+
+# 混雑時にユーザーへ返すメッセージ
+BUSY_MESSAGE = "現在混み合っています。少し時間をおいてもう一度お試しください。"
+
+
+class BusyError(Exception):
+    """混雑していてリクエストを受け付けられない"""
+
+
+class AdmissionController:
+    """AIリクエストの同時実行数を制限する
+
+    - 全体の同時実行数（max_concurrent）
+    - ユーザーごと・チャンネルごとの同時実行数
+
+    待たせる仕組みは持たない。JobWorkerPool が saturated() を見て、枠の空いている
+    ユーザー・チャンネルのジョブだけをキューから取り出す（待ち時間と処理待ちの件数は
+    shizue_job_wait_seconds・shizue_job_backlog に出る）。
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = Config.AI_MAX_CONCURRENT,
+        per_user: int = Config.AI_MAX_PER_USER,
+        per_channel: int = Config.AI_MAX_PER_CHANNEL,
+    ):
+        self.max_concurrent = max_concurrent
+        self.per_user = per_user
+        self.per_channel = per_channel
+
+        self._active = 0
+        self._users: Dict[int, int] = {}
+        self._channels: Dict[int, int] = {}
+
+        # 統計情報
+        self.admitted = 0
+
+    def saturated(self) -> Tuple[bool, List[int], List[int]]:
+        """(全体の枠が埋まっているか, 上限に達したユーザー, 上限に達したチャンネル)"""
+        return (
+            self._active >= self.max_concurrent,
+            [user for user, count in self._users.items() if count >= self.per_user],
+            [channel for channel, count in self._channels.items() if count >= self.per_channel],
+        )
+
+    def acquire_nowait(self, user_id: int, channel_id: int) -> bool:
+        """待たずに実行枠を取る（取れなければ False）。終わったら release() すること"""
+        if not self._can_run(user_id, channel_id):
+            return False
+        self._active += 1
+        self._users[user_id] = self._users.get(user_id, 0) + 1
+        self._channels[channel_id] = self._channels.get(channel_id, 0) + 1
+        self.admitted += 1
+        return True
+
+    def release(self, user_id: int, channel_id: int) -> None:
+        """acquire_nowait() で取った枠を返す"""
+        self._active -= 1
+        self._users[user_id] -= 1
+        if not self._users[user_id]:
+            del self._users[user_id]
+        self._channels[channel_id] -= 1
+        if not self._channels[channel_id]:
+            del self._channels[channel_id]
+
+    def _can_run(self, user_id: int, channel_id: int) -> bool:
+        return (
+            self._active < self.max_concurrent
+            and self._users.get(user_id, 0) < self.per_user
+            and self._channels.get(channel_id, 0) < self.per_channel
+        )
+
+    def stats(self) -> Dict[str, float]:
+        """同時実行数の統計情報"""
+        _, busy_users, busy_channels = self.saturated()
+        return {
+            "active": self._active,
+            "admitted": self.admitted,
+            "busy_users": len(busy_users),
+            "busy_channels": len(busy_channels),
+        }
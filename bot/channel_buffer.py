@@ -0,0 +1,107 @@
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+import discord
+
+from config import Config
+
+
+# (メッセージID, 表示名, 本文)
+Entry = Tuple[int, str, str]
+
+
+class _ChannelBuffer:
+    __slots__ = ("entries", "complete")
+
+    def __init__(self, size: int):
+        self.entries: Deque[Entry] = deque(maxlen=size)
+        # APIで補完したときにチャンネルの最初のメッセージまで取れたか
+        # （それより前はないので、件数が足りなくても正しい）
+        self.complete = False
+
+
+class RecentMessageBuffer:
+    """チャンネルごとの直近のメッセージを保持するリングバッファ
+
+    on_message で受け取った全メッセージを記録しておき、メンション時の
+    「直前のチャンネルの会話」をAPIを呼ばずに作る。保持するチャンネル数には
+    上限があり、しばらく発言のないチャンネルから順に捨てる（LRU）。
+    """
+
+    def __init__(
+        self,
+        max_channels: int = Config.CHANNEL_BUFFER_MAX_CHANNELS,
+        size: int = Config.CHANNEL_BUFFER_SIZE,
+    ):
+        self.max_channels = max_channels
+        self.size = size
+        self._channels: "OrderedDict[int, _ChannelBuffer]" = OrderedDict()
+
+        # 統計情報
+        self.hits = 0
+        self.misses = 0
+
+    def _get_or_create(self, channel_id: int) -> _ChannelBuffer:
+        buf = self._channels.get(channel_id)
+        if buf is None:
+            buf = _ChannelBuffer(self.size)
+            self._channels[channel_id] = buf
+            if len(self._channels) > self.max_channels:
+                self._channels.popitem(last=False)
+        else:
+            self._channels.move_to_end(channel_id)
+        return buf
+
+    def record(self, message: discord.Message) -> None:
+        """受信したメッセージを記録する（全メッセージで呼ばれるので軽く保つ）"""
+        channel_id = message.channel.id
+        buf = self._channels.get(channel_id)
+        if buf is None:
+            buf = self._get_or_create(channel_id)
+        else:
+            self._channels.move_to_end(channel_id)
+        if buf.complete and len(buf.entries) == self.size:
+            # 最初のメッセージが押し出される
+            buf.complete = False
+        buf.entries.append((message.id, message.author.display_name, message.content))
+
+    def recent(self, channel_id: int, before_id: int, limit: int) -> Optional[List[Entry]]:
+        """before_id より前の直近 limit 件を古い順に返す
+
+        limit 件に満たない場合は、チャンネルの最初まで把握しているときだけ返す。
+        起動直後や、後から届いたメッセージで古いものが押し出された場合などは None を返す。
+        """
+        buf = self._channels.get(channel_id)
+        if buf is None:
+            self.misses += 1
+            return None
+
+        entries = [e for e in buf.entries if e[0] < before_id]
+        # 起動後に見たメッセージだけで足りていれば、補完しなくても正しい
+        if len(entries) < limit and not buf.complete:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return entries[-limit:]
+
+    def seed(self, channel_id: int, entries: Iterable[Entry], complete: bool = False) -> None:
+        """APIで取得した過去のメッセージで補完する（古い順に渡す）
+
+        complete はチャンネルの最初のメッセージまで取得できたか。
+        """
+        buf = self._get_or_create(channel_id)
+        known = {e[0] for e in buf.entries}
+        merged = [e for e in entries if e[0] not in known] + list(buf.entries)
+        merged.sort(key=lambda e: e[0])
+        buf.entries = deque(merged, maxlen=self.size)
+        # 収まりきらずに古いものを捨てたら、最初まで把握しているとは言えない
+        buf.complete = complete and len(merged) <= self.size
+
+    def stats(self) -> Dict[str, float]:
+        """バッファの統計情報"""
+        return {
+            "channels": len(self._channels),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
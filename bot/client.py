@@ -1,7 +1,14 @@
+import asyncio
+import time
+from typing import Dict, Optional
+
 import discord
 from discord.ext import commands
 
+from bot.services import Services
+from bot.startup import STARTUP, CommandSyncer
 from config import Config
+from metrics import GATEWAY_CONNECTED, GATEWAY_LATENCY_SECONDS, REGISTRY, register_stats
 
 
 def create_bot() -> commands.Bot:
@@ -11,35 +18,103 @@ def create_bot() -> commands.Bot:
     intents.guilds = True
     intents.members = True
 
-    bot = commands.Bot(
+    options = dict(
         command_prefix="!",  # プレフィックスコマンド用（メインはスラッシュコマンド）
         intents=intents,
         help_command=None,  # デフォルトのhelpコマンドを無効化
     )
 
-    return bot
+    if Config.SHARD_COUNT:
+        # 担当するシャードだけを1つのプロセスで動かす（launcher.py から起動）
+        return commands.AutoShardedBot(
+            shard_count=Config.SHARD_COUNT,
+            shard_ids=Config.SHARD_IDS or None,
+            **options,
+        )
+    return commands.Bot(**options)
+
+
+def is_primary(bot: commands.Bot) -> bool:
+    """シャード0を担当するプロセスか（プロセス全体で1回だけ行う処理に使う）"""
+    shard_ids = getattr(bot, "shard_ids", None)
+    return not shard_ids or 0 in shard_ids
+
 
+def shard_states(bot: commands.Bot) -> Dict[int, bool]:
+    """このプロセスが担当するシャードごとのゲートウェイ接続状態"""
+    if isinstance(bot, commands.AutoShardedBot):
+        return {
+            shard_id: not shard.is_closed() for shard_id, shard in list(bot.shards.items())
+        }
+    ws = bot.ws
+    return {bot.shard_id or 0: ws is not None and ws.open}
 
-async def setup_bot(bot: commands.Bot) -> None:
-    """Botの初期設定を行う"""
+
+async def setup_bot(bot: commands.Bot) -> Services:
+    """Botの初期設定を行う
+
+    Returns:
+        全コグで共有するサービス（終了時に close() すること）
+    """
     # コグ（機能モジュール）を読み込む
     from bot.events import MessageHandler
     from bot.commands import SlashCommands
 
-    await bot.add_cog(MessageHandler(bot))
-    await bot.add_cog(SlashCommands(bot))
+    # OpenAI / Firestore のクライアントは1つだけ作って共有する
+    services = Services()
+
+    message_handler = MessageHandler(bot, services)
+    await bot.add_cog(message_handler)
+    await bot.add_cog(SlashCommands(bot, services))
+
+    _register_metrics(bot, services, message_handler)
+
+    # 古い会話の削除（シャーディング時は1プロセスだけが行う）
+    if is_primary(bot):
+        services.janitor.start()
+
+    syncer = CommandSyncer(bot)
+    warm_up: Optional[asyncio.Task] = None
+
+    @bot.event
+    async def on_connect():
+        # ログインできたら、READYを待つ間にOpenAIと履歴の保存先に接続しておく
+        nonlocal warm_up
+        if warm_up is None:
+            STARTUP.mark("login_and_connect")
+            if Config.WARM_UP_ENABLED:
+                warm_up = asyncio.create_task(services.warm_up())
 
     @bot.event
     async def on_ready():
+        first_ready = not STARTUP.reported
+        if first_ready:
+            STARTUP.mark("ready")
+            # 接続できてからジョブの処理を始める（前回の処理待ちのジョブもここから再開する）
+            await services.jobs.start()
         print(f"Logged in as {bot.user} (ID: {bot.user.id})")
-        print(f"Connected to {len(bot.guilds)} guilds")
+        print(f"Connected to {len(bot.guilds)} guilds (shards: {sorted(shard_states(bot))})")
 
-        # スラッシュコマンドを同期
-        try:
-            synced = await bot.tree.sync()
-            print(f"Synced {len(synced)} command(s)")
-        except Exception as e:
-            print(f"Failed to sync commands: {e}")
+        # スラッシュコマンドを同期（定義が変わったときだけ、シャーディング時は1プロセスだけが行う）
+        if is_primary(bot):
+            start = time.perf_counter()
+            try:
+                synced = await syncer.sync()
+                if synced is None:
+                    print("Command tree unchanged, skipped sync")
+                else:
+                    print(f"Synced {synced} command(s)")
+                    if first_ready:
+                        STARTUP.record("command_sync", time.perf_counter() - start)
+            except Exception as e:
+                print(f"Failed to sync commands: {e}")
+
+        if first_ready:
+            STARTUP.reported = True
+            if warm_up is not None:
+                for name, seconds in (await warm_up).items():
+                    STARTUP.record(f"warm_up_{name}", seconds)
+            print(STARTUP.report())
 
         # ステータスを設定
         await bot.change_presence(
@@ -48,3 +123,32 @@ async def setup_bot(bot: commands.Bot) -> None:
                 name="@メンションで質問",
             )
         )
+
+    return services
+
+
+def _register_metrics(bot: commands.Bot, services: Services, message_handler) -> None:
+    """各コンポーネントの統計情報とゲートウェイの状態をメトリクスに出す"""
+    register_stats("shizue_history_cache", "Conversation history cache", services.history.stats)
+    register_stats("shizue_admission", "AI request admission control", services.admission.stats)
+    register_stats("shizue_openai_retry", "OpenAI retries and concurrency", services.ai_client.retrier.stats)
+    register_stats("shizue_outbound", "Discord outbound dispatcher", services.outbound.stats)
+    register_stats("shizue_history_janitor", "Idle conversation expiry", services.janitor.stats)
+    register_stats("shizue_jobs", "Durable job queue workers", services.jobs.stats)
+    register_stats("shizue_channel_buffer", "Recent channel message buffer", message_handler._recent.stats)
+    if services.ai_client.hedge is not None:
+        register_stats("shizue_openai_hedge", "Hedged OpenAI requests", services.ai_client.hedge.stats)
+    if services.ai_client.response_cache is not None:
+        register_stats("shizue_response_cache", "AI response cache", services.ai_client.response_cache.stats)
+
+    def collect_gateway() -> None:
+        for shard_id, connected in shard_states(bot).items():
+            GATEWAY_CONNECTED.set(1 if connected else 0, shard=shard_id)
+        if isinstance(bot, commands.AutoShardedBot):
+            latencies = bot.latencies
+        else:
+            latencies = [(bot.shard_id or 0, bot.latency)]
+        for shard_id, latency in latencies:
+            GATEWAY_LATENCY_SECONDS.set(latency, shard=shard_id)
+
+    REGISTRY.add_collector(collect_gateway)
@@ -1,19 +1,38 @@
+import asyncio
+import logging
+import time
 from typing import Optional
 import discord
 from discord import app_commands
 from discord.ext import commands
 
-from ai.openai_client import OpenAIClient
-from storage.firestore_history import ConversationHistory
+from ai.deadline import TIMEOUT_MESSAGE, Deadline, within
+from bot.admission import BUSY_MESSAGE, BusyError
+from bot.outbound import split_message
+from bot.services import Services
+from bot.streaming import EMPTY_RESPONSE_MESSAGE, StreamingReply
+from config import Config
+from metrics import REQUEST_ERRORS, REQUEST_SECONDS, REQUESTS, STAGE_SECONDS
+from storage.job_queue import Job
+
+logger = logging.getLogger(__name__)
+
+
+# インタラクションのトークンは15分で切れる（余裕を見て14分）
+INTERACTION_TOKEN_LIFETIME = 14 * 60
 
 
 class SlashCommands(commands.Cog):
     """スラッシュコマンドを処理するCog"""
 
-    def __init__(self, bot: commands.Bot):
+    def __init__(self, bot: commands.Bot, services: Services):
         self.bot = bot
-        self.ai_client = OpenAIClient()
-        self.history = ConversationHistory()
+        self.ai_client = services.ai_client
+        self.history = services.history
+        self.summarizer = services.summarizer
+        self.outbound = services.outbound
+        self.jobs = services.jobs
+        self.jobs.register("ask", self._run_job, self._job_failed)
 
     @app_commands.command(name="ask", description="AIに質問します")
     @app_commands.describe(
@@ -29,38 +48,132 @@ class SlashCommands(commands.Cog):
         """AIに質問するスラッシュコマンド"""
         await interaction.response.defer(thinking=True)
 
-        try:
-            # 画像URLを取得
-            image_urls = []
-            if image and image.content_type and image.content_type.startswith("image/"):
-                image_urls.append(image.url)
+        # 画像URLを取得
+        image_urls = []
+        if image and image.content_type and image.content_type.startswith("image/"):
+            image_urls.append(image.url)
 
-            # 会話履歴を取得
-            history = await self.history.get_history(
-                interaction.channel_id, interaction.user.id
+        # 応答はワーカーに任せる。再起動後も続きから返せるよう、
+        # フォローアップ用のトークン（15分で切れる）も処理が済むまで保存しておく
+        try:
+            submitted = await self.jobs.submit(
+                "ask",
+                interaction.id,
+                shard_id=interaction.guild.shard_id if interaction.guild else 0,
+                user_id=interaction.user.id,
+                channel_id=interaction.channel_id,
+                payload={
+                    "question": question,
+                    "image_urls": image_urls,
+                    "application_id": interaction.application_id,
+                    "token": interaction.token,
+                },
+                context=interaction,
             )
+        except BusyError:
+            REQUEST_ERRORS.inc(source="ask", error="BusyError")
+            await interaction.followup.send(BUSY_MESSAGE)
+            return
+        if submitted:
+            REQUESTS.inc(source="ask")
+
+    async def _followup(self, job: Job):
+        """応答を送る関数（再起動前に積まれたものはトークンから送り先を作り直す）"""
+        if job.context is not None:
+            return job.context.followup.send
+        payload = job.payload
+        if time.time() - job.enqueued_at < INTERACTION_TOKEN_LIFETIME:
+            webhook = discord.Webhook.partial(
+                payload["application_id"], payload["token"], client=self.bot
+            )
+            return webhook.send
 
-            # AIに問い合わせ
-            response = await self.ai_client.chat(
-                user_message=question,
-                history=history,
-                image_urls=image_urls if image_urls else None,
+        # トークンが切れていたら、チャンネルにメンション付きで送る
+        channel = self.bot.get_channel(job.channel_id) or await self.bot.fetch_channel(job.channel_id)
+        mention = f"<@{job.user_id}> "
+        return lambda content, **kwargs: channel.send(mention + content)
+
+    async def _run_job(self, job: Job, deadline: Deadline):
+        """キューから取り出した /ask に応答する（実行枠はワーカーが確保済み）"""
+        try:
+            send = await self._followup(job)
+        except (discord.NotFound, discord.Forbidden) as e:
+            logger.info("Dropped job %s: %s", job.id, e)
+            return
+
+        try:
+            with REQUEST_SECONDS.time(source="ask"):
+                await self._respond(job, send, deadline)
+        except TimeoutError:
+            REQUEST_ERRORS.inc(source="ask", error="TimeoutError")
+            await send(TIMEOUT_MESSAGE)
+        except Exception as e:
+            # やり直すかどうかはワーカーが決める
+            logger.exception("Error in /ask command (attempt %d): %s", job.attempts, e)
+            raise
+
+    async def _job_failed(self, job: Job, error: Exception):
+        """やり直しきれなかった /ask にエラーを返す"""
+        REQUEST_ERRORS.inc(source="ask", error=type(error).__name__)
+        send = await self._followup(job)
+        await send(f"エラーが発生しました: {type(error).__name__}")
+
+    async def _respond(self, job: Job, send, deadline: Deadline):
+        """AIに問い合わせて応答する"""
+        payload = job.payload
+        channel_id = job.channel_id
+        user_id = job.user_id
+        question = payload["question"]
+        image_urls = payload["image_urls"]
+
+        # 会話履歴（と古い会話の要約）を取得
+        with STAGE_SECONDS.time(stage="history_read"):
+            async with within(deadline):
+                conversation = await self.history.get_conversation(channel_id, user_id)
+
+        # AIに問い合わせ
+        chat_args = dict(
+            user_message=question,
+            history=conversation["messages"],
+            image_urls=image_urls if image_urls else None,
+            summary=conversation["summary"],
+            deadline=deadline,
+        )
+        if Config.STREAMING_ENABLED:
+            # 生成しながらメッセージを編集して表示する
+            send_wait = self.jobs.tracked(job, lambda content: send(content, wait=True))
+            reply = StreamingReply(
+                send_first=send_wait,
+                send_next=send_wait,
+                outbound=self.outbound,
+                channel_id=channel_id,
             )
+            async for delta in self.ai_client.chat_stream(**chat_args):
+                await reply.feed(delta)
+            response = await reply.finish()
+        else:
+            response = await self.ai_client.chat(**chat_args)
+
+        # 応答を送信（ストリーミング時は送信済み）
+        if not Config.STREAMING_ENABLED:
+            # Discordが受け付けるまで待つ（送れなければジョブとしてやり直す）
+            await self._send_response(job, channel_id, send, response)
+
+        # 空の応答は履歴に残さない（次の問い合わせで空の発言を送らないように）
+        if not response.strip():
+            return
 
-            # 会話履歴に追加
+        # 会話履歴に追加
+        with STAGE_SECONDS.time(stage="history_write"):
             await self.history.add_conversation(
-                channel_id=interaction.channel_id,
-                user_id=interaction.user.id,
+                channel_id=channel_id,
+                user_id=user_id,
                 user_message=question,
                 assistant_message=response,
             )
 
-            # 応答を送信
-            await self._send_response(interaction, response)
-
-        except Exception as e:
-            await interaction.followup.send(f"エラーが発生しました: {type(e).__name__}")
-            print(f"Error in /ask command: {e}")
+        # 長くなった履歴は応答後にバックグラウンドで要約する
+        self.summarizer.schedule(channel_id, user_id)
 
     @app_commands.command(name="clear", description="会話履歴をクリアします")
     async def clear(self, interaction: discord.Interaction):
@@ -85,7 +198,7 @@ class SlashCommands(commands.Cog):
             await interaction.followup.send(
                 f"エラーが発生しました: {type(e).__name__}", ephemeral=True
             )
-            print(f"Error in /clear command: {e}")
+            logger.exception("Error in /clear command: %s", e)
 
     @app_commands.command(name="help", description="Botの使い方を表示します")
     async def help(self, interaction: discord.Interaction):
@@ -124,27 +237,12 @@ class SlashCommands(commands.Cog):
 
         await interaction.response.send_message(embed=embed)
 
-    async def _send_response(self, interaction: discord.Interaction, response: str):
-        """応答を送信（長い場合は分割）"""
-        max_length = 2000
+    def _send_response(self, job: Job, channel_id: int, send, response: str) -> asyncio.Future:
+        """応答を送信キューに積む（長い場合は分割、1通目が送れた時点でジョブを送信済みにする）
 
-        if len(response) <= max_length:
-            await interaction.followup.send(response)
-            return
-
-        # 長い応答は分割して送信
-        chunks = []
-        current_chunk = ""
-
-        for line in response.split("\n"):
-            if len(current_chunk) + len(line) + 1 > max_length:
-                chunks.append(current_chunk)
-                current_chunk = line
-            else:
-                current_chunk += "\n" + line if current_chunk else line
-
-        if current_chunk:
-            chunks.append(current_chunk)
-
-        for chunk in chunks:
-            await interaction.followup.send(chunk)
+        応答が空なら代わりに EMPTY_RESPONSE_MESSAGE を送る。
+        """
+        chunks = split_message(response) or [EMPTY_RESPONSE_MESSAGE]
+        return self.outbound.dispatch(
+            channel_id, chunks, first=self.jobs.tracked(job, send), rest=send
+        )
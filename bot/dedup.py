@@ -0,0 +1,33 @@
+import time
+from collections import deque
+from typing import Callable, Deque, Hashable, Set, Tuple
+
+
+class TTLDedup:
+    """一定時間内に処理したIDを覚えておく
+
+    期限順に並んだdequeとsetを組み合わせ、追加・期限切れの削除を
+    償却O(1)で行う（毎回全体を作り直さない）。
+    """
+
+    def __init__(self, ttl: float = 60.0, clock: Callable[[], float] = time.monotonic):
+        self.ttl = ttl
+        self._clock = clock
+        self._keys: Set[Hashable] = set()
+        self._order: Deque[Tuple[float, Hashable]] = deque()
+
+    def seen(self, key: Hashable) -> bool:
+        """記録済みならTrue、初めてなら記録してFalseを返す"""
+        now = self._clock()
+        order = self._order
+        while order and order[0][0] <= now:
+            self._keys.discard(order.popleft()[1])
+
+        if key in self._keys:
+            return True
+        self._keys.add(key)
+        order.append((now + self.ttl, key))
+        return False
+
+    def __len__(self) -> int:
+        return len(self._keys)
@@ -1,67 +1,93 @@
-import time
+import asyncio
+import logging
 import discord
 from discord.ext import commands
 
-from ai.openai_client import OpenAIClient
-from storage.firestore_history import ConversationHistory
+from ai.deadline import TIMEOUT_MESSAGE, Deadline, within
+from ai.router import QUESTION_HEADER
+from bot.admission import BUSY_MESSAGE, BusyError
+from bot.channel_buffer import RecentMessageBuffer
+from bot.dedup import TTLDedup
+from bot.outbound import split_message
+from bot.services import Services
+from bot.streaming import EMPTY_RESPONSE_MESSAGE, StreamingReply
+from config import Config
+from metrics import REQUEST_ERRORS, REQUEST_SECONDS, REQUESTS, STAGE_SECONDS
+from storage.job_queue import Job
+
+logger = logging.getLogger(__name__)
 
 
 class MessageHandler(commands.Cog):
     """メッセージイベントを処理するCog"""
 
-    def __init__(self, bot: commands.Bot):
+    def __init__(self, bot: commands.Bot, services: Services):
         self.bot = bot
-        self.ai_client = OpenAIClient()
-        self.history = ConversationHistory()
-        self._processed = {}  # 処理済みメッセージID -> タイムスタンプ
-
-    async def _get_recent_messages(self, channel: discord.TextChannel, before_message: discord.Message, limit: int = 3) -> str:
+        self.ai_client = services.ai_client
+        self.history = services.history
+        self.summarizer = services.summarizer
+        self.outbound = services.outbound
+        self.jobs = services.jobs
+        self.jobs.register("mention", self._run_job, self._job_failed)
+        self._processed = TTLDedup(ttl=60.0)  # 処理済みメッセージID
+        self._recent = RecentMessageBuffer()  # チャンネルごとの直近のメッセージ
+
+    async def _get_recent_messages(
+        self, channel: discord.TextChannel, before_message: discord.Message, limit: int = Config.CHANNEL_CONTEXT_MESSAGES
+    ) -> str:
         """直近のメッセージを取得してコンテキストとして返す"""
-        recent = []
-        async for msg in channel.history(limit=limit + 1, before=before_message):
-            if msg.id != before_message.id:
-                author_name = msg.author.display_name
-                recent.append(f"{author_name}: {msg.content}")
-
-        recent.reverse()  # 古い順に並べる
+        entries = self._recent.recent(channel.id, before_message.id, limit)
+        if entries is None:
+            # 起動直後などでバッファが足りないときだけAPIで取得する
+            fetched = []
+            async for msg in channel.history(limit=limit + 1, before=before_message):
+                if msg.id != before_message.id:
+                    fetched.append((msg.id, msg.author.display_name, msg.content))
+            fetched.reverse()  # 古い順に並べる
+            # limit 件に満たなければ、チャンネルの最初まで取れている
+            self._recent.seed(channel.id, fetched, complete=len(fetched) < limit)
+            entries = fetched[-limit:]
+
+        recent = [f"{author_name}: {content}" for _, author_name, content in entries]
         if recent:
-            return "【直前のチャンネルの会話】\n" + "\n".join(recent) + "\n\n【質問】\n"
+            return "【直前のチャンネルの会話】\n" + "\n".join(recent) + "\n\n" + QUESTION_HEADER
         return ""
 
     def _is_bot_mentioned(self, message: discord.Message) -> bool:
         """Botがメンションされているか確認（ユーザーメンションのみ）"""
         # ユーザーとして直接メンションされている場合のみ反応
-        if self.bot.user and self.bot.user in message.mentions:
-            return True
+        mentions = message.mentions
+        if not mentions:
+            return False
+        user = self.bot.user
+        return user is not None and user in mentions
+
+    def _should_handle(self, message: discord.Message) -> bool:
+        """応答すべきメッセージか判定する
+
+        全ギルドの全メッセージに対して呼ばれるので、大半を占める
+        メンションなしのメッセージは何も作らずに弾く。
+        """
+        # Bot自身のメッセージ・メンションされていないメッセージは無視
+        if message.author.bot or not self._is_bot_mentioned(message):
+            return False
 
-        return False
+        # 同じメッセージを2回処理しないようにする（60秒間は重複を無視）
+        if self._processed.seen(message.id):
+            logger.debug("Ignored: already processed (message %s)", message.id)
+            return False
+        return True
 
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
         """メッセージ受信時の処理"""
-        print(f"[DEBUG] Message received: {message.content[:50]}...")
-
-        # Bot自身のメッセージは無視
-        if message.author.bot:
-            print("[DEBUG] Ignored: bot message")
-            return
+        # メンション時の文脈に使うので、全メッセージを記録しておく
+        self._recent.record(message)
 
-        # Botがメンションされているか確認（ユーザー or ロール）
-        if not self._is_bot_mentioned(message):
-            print(f"[DEBUG] Ignored: not mentioned")
+        if not self._should_handle(message):
             return
 
-        # 同じメッセージを2回処理しないようにする（60秒間は重複を無視）
-        now = time.time()
-        if message.id in self._processed:
-            print("[DEBUG] Ignored: already processed")
-            return
-
-        # 古いエントリを削除（メモリリーク防止）
-        self._processed = {k: v for k, v in self._processed.items() if now - v < 60}
-        self._processed[message.id] = now
-
-        print(f"[DEBUG] Bot was mentioned! Processing...")
+        logger.debug("Bot was mentioned (message %s)", message.id)
 
         # メンションを除去してメッセージを取得
         content = message.content
@@ -79,75 +105,141 @@ class MessageHandler(commands.Cog):
             await message.reply("何か質問してください！")
             return
 
-        # 処理中であることを示す
+        # 画像URLを収集
+        image_urls = []
+        for attachment in message.attachments:
+            if attachment.content_type and attachment.content_type.startswith("image/"):
+                image_urls.append(attachment.url)
+
+        # 応答はワーカーに任せ、ここではジョブを積むだけですぐに戻る
+        # （メッセージIDをキーにするので、同じメッセージは再起動をまたいでも1回しか処理しない）
+        try:
+            submitted = await self.jobs.submit(
+                "mention",
+                message.id,
+                shard_id=message.guild.shard_id if message.guild else 0,
+                user_id=message.author.id,
+                channel_id=message.channel.id,
+                payload={
+                    "message_id": message.id,
+                    "content": content,
+                    "image_urls": image_urls,
+                },
+                context=message,
+            )
+        except BusyError:
+            REQUEST_ERRORS.inc(source="mention", error="BusyError")
+            await message.reply(BUSY_MESSAGE)
+            return
+        if submitted:
+            REQUESTS.inc(source="mention")
+
+    async def _resolve(self, job: Job):
+        """ジョブの元のメッセージ（再起動前に積まれたものはIDから引き直した PartialMessage）"""
+        if job.context is not None:
+            return job.context
+        channel = self.bot.get_channel(job.channel_id) or await self.bot.fetch_channel(job.channel_id)
+        return channel.get_partial_message(job.payload["message_id"])
+
+    async def _run_job(self, job: Job, deadline: Deadline):
+        """キューから取り出したメンションに応答する（実行枠はワーカーが確保済み）"""
+        try:
+            message = await self._resolve(job)
+        except (discord.NotFound, discord.Forbidden) as e:
+            # 待っている間にチャンネルが消えた・見えなくなった
+            logger.info("Dropped job %s: %s", job.id, e)
+            return
+
         async with message.channel.typing():
             try:
-                # 画像URLを収集
-                image_urls = []
-                for attachment in message.attachments:
-                    if attachment.content_type and attachment.content_type.startswith("image/"):
-                        image_urls.append(attachment.url)
-
-                # 会話履歴を取得
-                history = await self.history.get_history(
-                    message.channel.id, message.author.id
-                )
-
-                # 直前3件のチャンネル会話を取得
-                recent_context = await self._get_recent_messages(message.channel, message, limit=3)
-
-                # ユーザーメッセージにコンテキストを追加
-                user_message = recent_context + (content or "この画像について説明してください")
-
-                # AIに問い合わせ
-                response = await self.ai_client.chat(
-                    user_message=user_message,
-                    history=history,
-                    image_urls=image_urls if image_urls else None,
-                )
-
-                # 会話履歴に追加
-                await self.history.add_conversation(
-                    channel_id=message.channel.id,
-                    user_id=message.author.id,
-                    user_message=content or "[画像]",
-                    assistant_message=response,
-                )
-
-                # 応答を送信（2000文字制限対応）
-                await self._send_response(message, response)
-
+                with REQUEST_SECONDS.time(source="mention"):
+                    await self._respond(job, message, deadline)
+            except TimeoutError:
+                REQUEST_ERRORS.inc(source="mention", error="TimeoutError")
+                await message.reply(TIMEOUT_MESSAGE)
             except Exception as e:
-                await message.reply(f"エラーが発生しました: {type(e).__name__}")
-                import traceback
-                print(f"Error processing message: {e}")
-                traceback.print_exc()
-
-    async def _send_response(self, message: discord.Message, response: str):
-        """応答を送信（長い場合は分割）"""
-        max_length = 2000
+                # やり直すかどうかはワーカーが決める
+                logger.exception("Error processing message (attempt %d): %s", job.attempts, e)
+                raise
+
+    async def _job_failed(self, job: Job, error: Exception):
+        """やり直しきれなかったメンションにエラーを返す"""
+        REQUEST_ERRORS.inc(source="mention", error=type(error).__name__)
+        message = await self._resolve(job)
+        await message.reply(f"エラーが発生しました: {type(error).__name__}")
+
+    async def _respond(self, job: Job, message: discord.Message, deadline: Deadline):
+        """AIに問い合わせて応答する"""
+        payload = job.payload
+        content = payload["content"]
+        image_urls = payload["image_urls"]
+
+        # 会話履歴（と古い会話の要約）を取得
+        with STAGE_SECONDS.time(stage="history_read"):
+            async with within(deadline):
+                conversation = await self.history.get_conversation(
+                    message.channel.id, job.user_id
+                )
 
-        if len(response) <= max_length:
-            await message.reply(response)
+        # 直前3件のチャンネル会話を取得
+        with STAGE_SECONDS.time(stage="channel_context"):
+            async with within(deadline):
+                recent_context = await self._get_recent_messages(message.channel, message)
+
+        # ユーザーメッセージにコンテキストを追加
+        user_message = recent_context + (content or "この画像について説明してください")
+
+        # AIに問い合わせ
+        chat_args = dict(
+            user_message=user_message,
+            history=conversation["messages"],
+            image_urls=image_urls if image_urls else None,
+            summary=conversation["summary"],
+            deadline=deadline,
+        )
+        if Config.STREAMING_ENABLED:
+            # 生成しながらメッセージを編集して表示する
+            reply = StreamingReply(
+                send_first=self.jobs.tracked(job, message.reply),
+                send_next=self.jobs.tracked(job, message.channel.send),
+                outbound=self.outbound,
+                channel_id=message.channel.id,
+            )
+            async for delta in self.ai_client.chat_stream(**chat_args):
+                await reply.feed(delta)
+            response = await reply.finish()
+        else:
+            response = await self.ai_client.chat(**chat_args)
+
+        # 応答を送信（2000文字制限対応、ストリーミング時は送信済み）
+        if not Config.STREAMING_ENABLED:
+            # Discordが受け付けるまで待つ（送れなければジョブとしてやり直す）
+            await self._send_response(job, message, response)
+
+        # 空の応答は履歴に残さない（次の問い合わせで空の発言を送らないように）
+        if not response.strip():
             return
 
-        # 長い応答は分割して送信
-        chunks = []
-        current_chunk = ""
-
-        for line in response.split("\n"):
-            if len(current_chunk) + len(line) + 1 > max_length:
-                chunks.append(current_chunk)
-                current_chunk = line
-            else:
-                current_chunk += "\n" + line if current_chunk else line
-
-        if current_chunk:
-            chunks.append(current_chunk)
-
-        # 最初のチャンクはリプライ、残りは通常メッセージ
-        for i, chunk in enumerate(chunks):
-            if i == 0:
-                await message.reply(chunk)
-            else:
-                await message.channel.send(chunk)
+        # 会話履歴に追加
+        with STAGE_SECONDS.time(stage="history_write"):
+            await self.history.add_conversation(
+                channel_id=message.channel.id,
+                user_id=job.user_id,
+                user_message=content or "[画像]",
+                assistant_message=response,
+            )
+
+        # 長くなった履歴は応答後にバックグラウンドで要約する
+        self.summarizer.schedule(message.channel.id, job.user_id)
+
+    def _send_response(self, job: Job, message: discord.Message, response: str) -> asyncio.Future:
+        """応答を送信キューに積む（長い場合は分割、最初はリプライ）
+
+        1通目が送れた時点でジョブを送信済みにする。応答が空なら代わりに EMPTY_RESPONSE_MESSAGE を送る。
+        """
+        return self.outbound.dispatch(
+            message.channel.id,
+            split_message(response) or [EMPTY_RESPONSE_MESSAGE],
+            first=self.jobs.tracked(job, message.reply),
+            rest=message.channel.send,
+        )
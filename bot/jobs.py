@@ -0,0 +1,360 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple, TypeVar
+
+from ai.deadline import Deadline
+from bot.admission import AdmissionController, BusyError
+from config import Config
+from metrics import JOB_BACKLOG, JOB_OLDEST_AGE_SECONDS, JOB_RESULTS, JOB_WAIT_SECONDS
+from storage.job_queue import ACTIVE_STATUSES, Job, JobQueue
+
+logger = logging.getLogger(__name__)
+
+
+T = TypeVar("T")
+
+JobHandler = Callable[[Job, Deadline], Awaitable[None]]
+FailureHandler = Callable[[Job, BaseException], Awaitable[None]]
+
+
+class JobWorkerPool:
+    """永続キューに積んだジョブを、決まった数のワーカーで処理する
+
+    ゲートウェイのイベントハンドラーはジョブを積むだけですぐに戻り、
+    履歴の読み込みやOpenAIの呼び出しはワーカーが行う。
+    - 処理待ちが max_pending 件に達したら、新しいジョブは BusyError で断る
+    - AdmissionController の枠が空いているユーザー・チャンネルのジョブだけを取り出す
+      （混んでいるチャンネルのジョブがワーカーを占めて、他のチャンネルを待たせない）
+    - 失敗したジョブは間隔を倍にしながら max_attempts 回までやり直す
+      （ユーザーにすでに何か送っていたら、二重に送らないようやり直さない。
+      送ったことはキューにも記録するので、再起動後も同じ）
+    - 再起動したら、処理待ちのジョブと処理中だったジョブを続きから処理する
+    - 終了時は処理中のジョブを drain_timeout 秒まで待ち、残りは次の起動に回す
+    """
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        admission: AdmissionController,
+        workers: int = Config.JOB_WORKERS,
+        max_pending: int = Config.JOB_MAX_BACKLOG,
+        max_attempts: int = Config.JOB_MAX_ATTEMPTS,
+        retry_base_delay: float = Config.JOB_RETRY_BASE_DELAY,
+        retry_max_delay: float = Config.JOB_RETRY_MAX_DELAY,
+        poll_interval: float = Config.JOB_POLL_INTERVAL,
+        drain_timeout: float = Config.JOB_DRAIN_TIMEOUT,
+        retention: float = Config.JOB_RETENTION,
+        metrics_interval: float = Config.JOB_METRICS_INTERVAL,
+        deadline: float = Config.REQUEST_DEADLINE,
+        shard_ids: Optional[Sequence[int]] = None,
+    ):
+        self.queue = queue
+        self.admission = admission
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.poll_interval = poll_interval
+        self.drain_timeout = drain_timeout
+        self.retention = retention
+        self.metrics_interval = metrics_interval
+        self.deadline = deadline
+        self.shard_ids = list(shard_ids) if shard_ids else None
+
+        self._handlers: Dict[str, Tuple[JobHandler, FailureHandler]] = {}
+        self._contexts: Dict[str, object] = {}  # ジョブID -> 元のメッセージなど
+        self._waiters: Dict[str, asyncio.Future] = {}
+        # 積まれたジョブ・空いた枠1つにつき1つ、待っているワーカーを起こす
+        self._wakeup: asyncio.Queue = asyncio.Queue()
+        # 枠の確認から確保までを他のワーカーに割り込ませない
+        self._claim_lock = asyncio.Lock()
+        self._tasks: List[asyncio.Task] = []
+        self._monitor: Optional[asyncio.Task] = None
+        self._closing = False
+        self._started_at = 0.0
+        self._pruned_at = 0.0
+
+        # 統計情報
+        self.submitted = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.resumed = 0
+        self.running = 0
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+        self.backlog_depth = 0
+        self.oldest_age = 0.0
+
+    def register(self, kind: str, run: JobHandler, on_failure: FailureHandler) -> None:
+        """kind のジョブを処理する関数と、やり直しきれなかったときに呼ぶ関数を登録する"""
+        self._handlers[kind] = (run, on_failure)
+
+    async def submit(
+        self,
+        kind: str,
+        key: int,
+        shard_id: int,
+        user_id: int,
+        channel_id: int,
+        payload: Dict,
+        context: object = None,
+    ) -> bool:
+        """ジョブを積む（同じ kind・key のジョブがすでにあれば何もせず False）
+
+        処理待ちが max_pending 件に達していたら BusyError。
+        context は同じプロセスで処理するときにだけ使う元のオブジェクト（保存はしない）。
+        """
+        job_id = f"{kind}:{key}"
+        fresh_context = context is not None and job_id not in self._contexts
+        if fresh_context:
+            # 登録した直後にワーカーが取り出しても使えるよう、先に置いておく
+            self._contexts[job_id] = context
+        try:
+            status = await self.queue.enqueue(
+                job_id, kind, shard_id, user_id, channel_id, payload, self.max_pending
+            )
+        except BaseException:
+            if fresh_context:
+                del self._contexts[job_id]
+            raise
+        if status != "added":
+            if fresh_context:
+                del self._contexts[job_id]
+            if status == "full":
+                self.rejected += 1
+                raise BusyError("job queue is full")
+            self.duplicates += 1
+            return False
+        self.submitted += 1
+        self._wakeup.put_nowait(None)
+        return True
+
+    async def wait(self, kind: str, key: int) -> None:
+        """ジョブが（成功・失敗にかかわらず）終わるまで待つ（submit の後、終わる前に呼ぶこと）"""
+        job_id = f"{kind}:{key}"
+        future = self._waiters.get(job_id)
+        if future is None:
+            future = self._waiters[job_id] = asyncio.get_running_loop().create_future()
+        await asyncio.shield(future)
+
+    async def start(self) -> None:
+        """前回処理中だったジョブを戻してから、ワーカーを起動する"""
+        if self._tasks:
+            return
+        self._started_at = time.time()
+        self.resumed = await self.queue.requeue_running(self.shard_ids)
+        if self.resumed:
+            logger.info("Resuming %d job(s) interrupted by the last shutdown", self.resumed)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._monitor = asyncio.create_task(self._monitor_loop())
+
+    def tracked(self, job: Job, send: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+        """send で送信できたら送信済みと記録する関数を返す（送った後のジョブはやり直さない）"""
+        async def wrapper(*args, **kwargs) -> T:
+            result = await send(*args, **kwargs)
+            await self.mark_replied(job)
+            return result
+
+        return wrapper
+
+    async def mark_replied(self, job: Job) -> None:
+        """ユーザーに送信済みと記録する（ジョブを完了にする前にキューにも書いておく）"""
+        if not job.replied:
+            job.replied = True
+            await self.queue.mark_replied(job.id)
+
+    async def _worker(self) -> None:
+        while not self._closing:
+            try:
+                await self._work_once()
+            except asyncio.CancelledError:
+                if self._closing:
+                    raise
+                # 終了処理以外で取り消されても、ワーカーの数は減らさない
+                asyncio.current_task().uncancel()
+                logger.warning("Job worker was cancelled outside shutdown; continuing")
+
+    async def _work_once(self) -> None:
+        try:
+            job = await self._claim()
+        except Exception as e:
+            logger.exception("Failed to claim a job: %s", e)
+            job = None
+        if job is None:
+            # やり直し待ちのジョブは時間が来たら取り出せるよう、通知がなくても見に行く
+            try:
+                await asyncio.wait_for(self._wakeup.get(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            return
+
+        self.running += 1
+        try:
+            await self._run(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # キューに書き込めなかったジョブは処理中のまま残り、次の起動でやり直す
+            logger.exception("Failed to record the result of job %s: %s", job.id, e)
+        finally:
+            self.running -= 1
+            self.admission.release(job.user_id, job.channel_id)
+            # 空いた枠で動けるジョブを取りに行かせる
+            self._wakeup.put_nowait(None)
+
+    async def _claim(self) -> Optional[Job]:
+        """実行枠の空いているユーザー・チャンネルのジョブを取り出し、枠を確保する"""
+        async with self._claim_lock:
+            full, busy_users, busy_channels = self.admission.saturated()
+            if full:
+                return None
+            job = await self.queue.claim(self.shard_ids, busy_users, busy_channels)
+            if job is not None and not self.admission.acquire_nowait(job.user_id, job.channel_id):
+                # ロック中は枠が減らないので起きないはずだが、念のため処理待ちに戻す
+                await self.queue.retry(job.id, 0.0, "no admission slot")
+                return None
+            return job
+
+    def _deadline_for(self, job: Job) -> Deadline:
+        # 最初の実行では、キューで待った時間も締め切りに含める。
+        # やり直しや再起動後の実行は、その時点から数え直す
+        if job.attempts > 1 or job.enqueued_at < self._started_at:
+            return Deadline(self.deadline)
+        return Deadline(self.deadline - (time.time() - job.enqueued_at))
+
+    async def _run(self, job: Job) -> None:
+        if job.attempts == 1:
+            JOB_WAIT_SECONDS.observe(max(0.0, time.time() - job.enqueued_at), kind=job.kind)
+        handlers = self._handlers.get(job.kind)
+        if handlers is None:
+            await self._fail(job, f"no handler for job kind {job.kind!r}")
+            return
+        run, on_failure = handlers
+        job.context = self._contexts.get(job.id)
+
+        if job.replied:
+            # 前回のプロセスが送信した後で終わっていた。やり直すと二重に送るので完了にする
+            logger.info("Job %s was already replied to before the restart; marking it done", job.id)
+        else:
+            try:
+                await run(job, self._deadline_for(job))
+            except asyncio.CancelledError as e:
+                if self._closing:
+                    raise
+                # 終了処理以外での取り消しは、失敗として扱う
+                asyncio.current_task().uncancel()
+                logger.warning("Job %s was cancelled outside shutdown", job.id)
+                await self._handle_error(job, on_failure, e)
+                return
+            except Exception as e:
+                await self._handle_error(job, on_failure, e)
+                return
+
+        await self.queue.complete(job.id)
+        self.completed += 1
+        JOB_RESULTS.inc(kind=job.kind, result="done")
+        self._finished(job.id)
+
+    async def _handle_error(self, job: Job, on_failure: FailureHandler, e: BaseException) -> None:
+        """やり直せるならやり直しを予約し、そうでなければ失敗を伝える"""
+        error = f"{type(e).__name__}: {e}"
+        if job.attempts < self.max_attempts and not job.replied:
+            delay = min(self.retry_max_delay, self.retry_base_delay * 2 ** (job.attempts - 1))
+            logger.warning(
+                "Job %s failed (attempt %d), retrying in %.0fs: %s", job.id, job.attempts, delay, error
+            )
+            await self.queue.retry(job.id, delay, error)
+            self.retried += 1
+            JOB_RESULTS.inc(kind=job.kind, result="retried")
+            return
+        logger.error("Job %s failed after %d attempt(s): %s", job.id, job.attempts, error)
+        try:
+            await on_failure(job, e)
+        except Exception as notify_error:
+            logger.exception("Failed to report job failure for %s: %s", job.id, notify_error)
+        await self._fail(job, error)
+
+    async def _fail(self, job: Job, error: str) -> None:
+        await self.queue.fail(job.id, error)
+        self.failed += 1
+        JOB_RESULTS.inc(kind=job.kind, result="failed")
+        self._finished(job.id)
+
+    def _finished(self, job_id: str) -> None:
+        self._contexts.pop(job_id, None)
+        future = self._waiters.pop(job_id, None)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    async def _monitor_loop(self) -> None:
+        """キューの長さと最も古いジョブの待ち時間を定期的にメトリクスに出す"""
+        while True:
+            try:
+                await self.refresh_metrics()
+                if time.time() - self._pruned_at >= 3600:
+                    self._pruned_at = time.time()
+                    await self.queue.prune(self._pruned_at - self.retention)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Failed to collect job queue metrics: %s", e)
+            await asyncio.sleep(self.metrics_interval)
+
+    async def refresh_metrics(self) -> None:
+        backlog = await self.queue.backlog(self.shard_ids)
+        now = time.time()
+        kinds = set(self._handlers) | {kind for kind, _ in backlog}
+        depth = 0
+        oldest_overall = 0.0
+        for kind in kinds:
+            oldest = None
+            for status in ACTIVE_STATUSES:
+                count, enqueued_at = backlog.get((kind, status), (0, None))
+                JOB_BACKLOG.set(count, kind=kind, status=status)
+                depth += count
+                if enqueued_at is not None:
+                    oldest = enqueued_at if oldest is None else min(oldest, enqueued_at)
+            age = now - oldest if oldest is not None else 0.0
+            JOB_OLDEST_AGE_SECONDS.set(age, kind=kind)
+            oldest_overall = max(oldest_overall, age)
+        self.backlog_depth = depth
+        self.oldest_age = oldest_overall
+
+    async def close(self) -> None:
+        """新しいジョブの取り出しを止め、処理中のジョブを少し待ってからキューを閉じる"""
+        if self._closing:
+            return
+        self._closing = True
+        for _ in self._tasks:
+            self._wakeup.put_nowait(None)
+        if self._tasks:
+            _, pending = await asyncio.wait(self._tasks, timeout=self.drain_timeout)
+            if pending:
+                # 取り消したジョブは処理中のまま残り、次の起動で続きから処理する
+                logger.warning("Interrupted %d running job(s); they will resume on restart", len(pending))
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._monitor is not None:
+            self._monitor.cancel()
+            await asyncio.gather(self._monitor, return_exceptions=True)
+        await self.queue.close()
+
+    def stats(self) -> Dict[str, float]:
+        """ジョブの処理状況（backlog_depth・oldest_age_seconds は最後に集計したときの値）"""
+        return {
+            "workers": len(self._tasks),
+            "running": self.running,
+            "submitted": self.submitted,
+            "duplicates": self.duplicates,
+            "rejected": self.rejected,
+            "resumed": self.resumed,
+            "completed": self.completed,
+            "retried": self.retried,
+            "failed": self.failed,
+            "backlog_depth": self.backlog_depth,
+            "oldest_age_seconds": self.oldest_age,
+        }
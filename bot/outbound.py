@@ -0,0 +1,192 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from metrics import STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Discordの1メッセージあたりの最大文字数
+MAX_MESSAGE_LENGTH = 2000
+
+SendFunc = Callable[[str], Awaitable[object]]
+
+
+def split_partial(text: str, limit: int = MAX_MESSAGE_LENGTH) -> Tuple[List[str], str]:
+    """確定したメッセージと、まだ続きが書ける残りの部分に分ける
+
+    - 行単位でできるだけ詰めて、メッセージ数を減らす
+    - 1通に収まらない長い行は、空いている分だけ詰めて行の途中で分割する
+    - コードブロックの途中で分割するときは、閉じてから次のメッセージで開き直す
+
+    残りの部分はコードブロックが開いたままのことがある（ストリーミング用）。
+    """
+    chunks: List[str] = []
+    current = ""
+    fence: Optional[str] = None  # 開いているコードブロックの開始行（```python など）
+
+    def flush() -> None:
+        nonlocal current
+        body = current
+        if fence is not None:
+            # 開いただけで中身のないコードブロックは送らず、次のメッセージで開く
+            if body == fence:
+                body = ""
+            elif body.endswith("\n" + fence):
+                body = body[: -len(fence) - 1]
+            else:
+                body += "\n```"
+        if body.strip():
+            chunks.append(body)
+        current = fence if fence is not None else ""
+
+    for line in text.split("\n"):
+        is_fence = line.lstrip().startswith("```")
+        # コードブロック内か、この行で開くなら、閉じる "\n```" の分も空けておく
+        closes = is_fence and fence is not None
+        reserve = 4 if not closes and (fence is not None or is_fence) else 0
+
+        while True:
+            sep = "\n" if current else ""
+            room = limit - len(current) - len(sep) - reserve
+            if len(line) <= room:
+                current += sep + line
+                break
+            has_content = bool(current) and current != fence
+            fresh_room = limit - (len(fence) + 1 if fence is not None else 0) - reserve
+            if has_content and (len(line) <= fresh_room or room <= 0):
+                flush()
+                continue
+            room = max(room, 1)
+            current += sep + line[:room]
+            line = line[room:]
+            flush()
+
+        if is_fence:
+            fence = None if fence is not None else line.strip()
+
+    return chunks, current
+
+
+def split_message(text: str, limit: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """Discordの文字数制限に収まるようにテキストを分割する（split_partial を参照）"""
+    chunks, rest = split_partial(text, limit)
+    lines = rest.split("\n")
+    fences = sum(1 for line in lines if line.lstrip().startswith("```"))
+    if fences % 2:
+        # 開き直しただけで中身がなければ送らない
+        if len(lines) == 1:
+            return chunks
+        rest += "\n```"
+    if rest.strip():
+        chunks.append(rest)
+    return chunks
+
+
+class OutboundDispatcher:
+    """Discordへの送信をチャンネルごとの行列に積んで順番に送る
+
+    ハンドラーは送信を積んだらすぐに戻れる。同じチャンネルへの送信は
+    順番どおりに1つずつ行い、チャンネルごとのレート制限に沿わせる。
+    ストリーミング中の送信・編集も send() で同じ行列を通す。
+    """
+
+    def __init__(self):
+        self._queues: Dict[int, Deque[Tuple[List[str], SendFunc, SendFunc, str, asyncio.Future]]] = {}
+        self._workers: Dict[int, asyncio.Task] = {}
+
+        # 統計情報
+        self.sent = 0
+        self.failed = 0
+        self.send_seconds_total = 0.0
+        self.send_seconds_max = 0.0
+
+    def dispatch(
+        self,
+        channel_id: int,
+        chunks: List[str],
+        first: SendFunc,
+        rest: SendFunc,
+        stage: str = "discord_send",
+    ) -> asyncio.Future:
+        """送信を積む（完了を待ちたい場合は戻り値のFutureをawaitする）
+
+        Args:
+            channel_id: 送信先チャンネル（送信の順番を保つ単位）
+            chunks: 送るメッセージ（split_message で分割済みのもの）
+            first: 1通目の送り方（リプライなど）
+            rest: 2通目以降の送り方
+            stage: 所要時間を記録する STAGE_SECONDS のラベル
+
+        Futureの結果は最後に送ったときの戻り値（送信したメッセージなど）。
+        """
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.setdefault(channel_id, deque())
+        queue.append((chunks, first, rest, stage, future))
+
+        if channel_id not in self._workers:
+            self._workers[channel_id] = asyncio.create_task(self._worker(channel_id))
+        return future
+
+    async def send(
+        self, channel_id: int, send: SendFunc, content: str, stage: str = "discord_send"
+    ) -> object:
+        """1通を行列に積み、送り終わるのを待って send の戻り値を返す（ストリーミング用）"""
+        return await self.dispatch(channel_id, [content], send, send, stage)
+
+    async def _worker(self, channel_id: int) -> None:
+        queue = self._queues[channel_id]
+        try:
+            while queue:
+                chunks, first, rest, stage, future = queue.popleft()
+                result = None
+                try:
+                    for i, chunk in enumerate(chunks):
+                        result = await self._send(first if i == 0 else rest, chunk, stage)
+                except Exception as e:
+                    logger.warning("Failed to send message to channel %s: %s", channel_id, e)
+                    if not future.done():
+                        future.set_exception(e)
+                        future.exception()  # 誰も待っていなくても警告を出さない
+                else:
+                    if not future.done():
+                        future.set_result(result)
+        finally:
+            # 空になったチャンネルの行列とタスクは片付ける
+            del self._workers[channel_id]
+            if not queue:
+                del self._queues[channel_id]
+
+    async def _send(self, send: SendFunc, content: str, stage: str) -> object:
+        start = time.monotonic()
+        try:
+            result = await send(content)
+            self.sent += 1
+            return result
+        except Exception:
+            # 429 は discord.py が待って再送するのでここには来ない（discord.http のログに出る）
+            self.failed += 1
+            raise
+        finally:
+            elapsed = time.monotonic() - start
+            self.send_seconds_total += elapsed
+            self.send_seconds_max = max(self.send_seconds_max, elapsed)
+            STAGE_SECONDS.observe(elapsed, stage=stage)
+
+    async def close(self, timeout: float = 10.0) -> None:
+        """積まれている送信が終わるのを待つ"""
+        if self._workers:
+            await asyncio.wait(list(self._workers.values()), timeout=timeout)
+
+    def stats(self) -> Dict[str, float]:
+        """送信の統計情報"""
+        return {
+            "queued_channels": len(self._queues),
+            "queued_jobs": sum(len(q) for q in self._queues.values()),
+            "sent": self.sent,
+            "failed": self.failed,
+            "send_seconds_total": self.send_seconds_total,
+            "send_seconds_max": self.send_seconds_max,
+        }
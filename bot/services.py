@@ -0,0 +1,66 @@
+import asyncio
+import time
+from typing import Dict
+
+from ai.openai_client import OpenAIClient
+from ai.summarizer import HistorySummarizer
+from bot.admission import AdmissionController
+from bot.jobs import JobWorkerPool
+from bot.outbound import OutboundDispatcher
+from config import Config
+from storage import LazyHistoryBackend
+from storage.history_cache import CachedConversationHistory
+from storage.job_queue import JobQueue
+from storage.janitor import HistoryJanitor
+
+
+class Services:
+    """コグ間で共有するクライアント類
+
+    OpenAIの接続プールと履歴の保存先（Firestore / SQLite）、履歴キャッシュ、
+    メンション・/ask のジョブキューをプロセス内で1つにまとめ、全コグから同じものを使う。
+    """
+
+    def __init__(self):
+        self.ai_client = OpenAIClient()
+        # 保存先のSDKは warm_up() か最初の読み書きで読み込む
+        self.history = CachedConversationHistory(LazyHistoryBackend())
+        self.summarizer = HistorySummarizer(self.ai_client, self.history)
+        self.admission = AdmissionController()
+        self.outbound = OutboundDispatcher()
+        self.janitor = HistoryJanitor(self.history.backend)
+        # シャーディング時は担当シャードのジョブだけを処理する
+        self.jobs = JobWorkerPool(JobQueue(), self.admission, shard_ids=Config.SHARD_IDS)
+
+    async def warm_up(self) -> Dict[str, float]:
+        """OpenAIと履歴の保存先への接続を並行して作っておく
+
+        Returns:
+            {"openai": 秒, "history": 秒}（失敗・時間切れのものは含めない）
+        """
+        async def timed(name: str, coro) -> None:
+            start = time.perf_counter()
+            try:
+                await asyncio.wait_for(coro, Config.WARM_UP_TIMEOUT)
+                durations[name] = time.perf_counter() - start
+            except Exception as e:
+                # 失敗しても最初のリクエストで接続し直すだけなので続ける
+                print(f"Warm-up of {name} failed: {type(e).__name__}: {e}")
+
+        durations: Dict[str, float] = {}
+        await asyncio.gather(
+            timed("openai", self.ai_client.warm_up()),
+            timed("history", self.history.backend.warm_up()),
+        )
+        return durations
+
+    async def close(self) -> None:
+        """処理中のジョブ・送信待ちのメッセージ・未書き込みの履歴を片付けてから接続を閉じる"""
+        try:
+            await self.jobs.close()
+            await self.janitor.close()
+            await self.outbound.close()
+            await self.summarizer.close()
+            await self.history.close()
+        finally:
+            await self.ai_client.close()
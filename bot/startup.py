@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import time
+from typing import TYPE_CHECKING, List, Optional, Tuple
+
+from config import Config
+from metrics import STARTUP_SECONDS
+
+if TYPE_CHECKING:
+    from discord.ext import commands
+
+
+class StartupTimer:
+    """起動にかかった時間を段階ごとに記録する
+
+    mark() は前の mark() からの時間を1つの段階として記録する（順に進む処理）。
+    record() はログイン後にバックグラウンドで並行して動く処理の時間を記録する。
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._last = self.started
+        self.phases: List[Tuple[str, float]] = []
+        self.background: List[Tuple[str, float]] = []
+        self.reported = False
+
+    def mark(self, phase: str) -> None:
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        STARTUP_SECONDS.set(now - self._last, phase=phase)
+        self._last = now
+
+    def record(self, phase: str, seconds: float) -> None:
+        self.background.append((phase, seconds))
+        STARTUP_SECONDS.set(seconds, phase=phase)
+
+    def report(self) -> str:
+        total = self._last - self.started
+        lines = [f"Startup timing (ready in {total:.2f}s):"]
+        lines += [f"  {phase:<20}{seconds:>7.2f}s" for phase, seconds in self.phases]
+        lines += [
+            f"  {phase:<20}{seconds:>7.2f}s (after ready)" for phase, seconds in self.background
+        ]
+        return "\n".join(lines)
+
+
+# プロセス起動時（最初の import 時）から計測する
+STARTUP = StartupTimer()
+
+
+class CommandSyncer:
+    """スラッシュコマンドの定義が変わったときだけ Discord に同期する
+
+    tree.sync() はグローバルコマンドを丸ごと上書きするAPIで、レート制限も厳しい。
+    定義のハッシュをファイルに残しておき、再接続や再起動のたびに同期しないようにする。
+    """
+
+    def __init__(self, bot: "commands.Bot", state_path: str = Config.COMMAND_SYNC_STATE_PATH):
+        self.bot = bot
+        self.state_path = state_path
+        self.synced_hash = self._load()
+
+    def _load(self) -> Optional[str]:
+        try:
+            with open(self.state_path, encoding="utf-8") as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def _save(self, digest: str) -> None:
+        try:
+            directory = os.path.dirname(self.state_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.state_path, "w", encoding="utf-8") as f:
+                f.write(digest)
+        except OSError as e:
+            print(f"Failed to save command tree hash: {e}")
+
+    def tree_hash(self) -> str:
+        """登録済みコマンドの定義（とアプリケーションID）のハッシュ"""
+        tree = self.bot.tree
+        payload = {
+            "application_id": self.bot.application_id,
+            "commands": sorted(
+                (command.to_dict(tree) for command in tree.get_commands()),
+                key=lambda c: (c.get("type", 1), c["name"]),
+            ),
+        }
+        data = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    async def sync(self) -> Optional[int]:
+        """定義が変わっていれば同期する
+
+        Returns:
+            同期したコマンド数（変わっていなければ None）
+        """
+        digest = self.tree_hash()
+        if digest == self.synced_hash:
+            return None
+        synced = await self.bot.tree.sync()
+        self.synced_hash = digest
+        self._save(digest)
+        return len(synced)
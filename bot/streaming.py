@@ -0,0 +1,93 @@
+import time
+from typing import Awaitable, Callable, Optional
+
+import discord
+
+from bot.outbound import MAX_MESSAGE_LENGTH, OutboundDispatcher, split_partial
+from config import Config
+
+
+SendFunc = Callable[[str], Awaitable[discord.Message]]
+
+# モデルが空の応答を返したときに代わりに送るメッセージ
+EMPTY_RESPONSE_MESSAGE = "応答を生成できませんでした。少し時間をおいてもう一度お試しください。"
+
+
+class StreamingReply:
+    """生成中の応答をDiscordメッセージの編集で少しずつ表示する
+
+    最初の差分が届いた時点でメッセージを投稿し、以降は edit_interval 秒ごとに
+    まとめて編集する（Discordの編集レート制限に引っかからないようにするため）。
+    2000文字を超えたら現在のメッセージを確定し、続きは新しいメッセージに書く
+    （コードブロックの途中なら閉じてから、次のメッセージで開き直す）。
+    送信・編集は OutboundDispatcher のチャンネルごとの行列を通す。
+    """
+
+    def __init__(
+        self,
+        send_first: SendFunc,
+        send_next: SendFunc,
+        outbound: OutboundDispatcher,
+        channel_id: int,
+        max_length: int = MAX_MESSAGE_LENGTH,
+        edit_interval: float = Config.STREAM_EDIT_INTERVAL,
+    ):
+        self._send_first = send_first  # 最初のメッセージ（リプライなど）
+        self._send_next = send_next  # 2通目以降のメッセージ
+        self._outbound = outbound
+        self._channel_id = channel_id
+        self.max_length = max_length
+        self.edit_interval = edit_interval
+
+        self.text = ""  # 応答の全文
+        self._current = ""  # 表示中のメッセージに入る部分
+        self._message: Optional[discord.Message] = None
+        self._shown = ""  # 最後に送信・編集した内容
+        self._sent_any = False
+        self._last_update = 0.0
+
+    async def feed(self, delta: str) -> None:
+        """差分を追加し、前回の更新から間隔が空いていれば表示を更新する"""
+        self.text += delta
+        self._current += delta
+        if time.monotonic() - self._last_update >= self.edit_interval:
+            await self._sync()
+
+    async def finish(self) -> str:
+        """残りを表示して全文を返す
+
+        応答が空なら EMPTY_RESPONSE_MESSAGE を送り、空文字列を返す（履歴には残さない）。
+        """
+        await self._sync()
+        if not self.text.strip():
+            await self._show(EMPTY_RESPONSE_MESSAGE)
+            return ""
+        return self.text
+
+    async def _sync(self) -> None:
+        # 上限を超えた分は確定させて次のメッセージへ送る
+        if len(self._current) > self.max_length:
+            heads, self._current = split_partial(self._current, self.max_length)
+            for head in heads:
+                await self._show(head)
+                self._message = None
+                self._shown = ""
+
+        if self._current.strip():
+            await self._show(self._current)
+        self._last_update = time.monotonic()
+
+    async def _show(self, content: str) -> None:
+        if self._message is None:
+            send = self._send_next if self._sent_any else self._send_first
+            self._message = await self._outbound.send(self._channel_id, send, content)
+            self._sent_any = True
+        elif content != self._shown:
+            message = self._message
+            await self._outbound.send(
+                self._channel_id,
+                lambda content: message.edit(content=content),
+                content,
+                stage="discord_edit",
+            )
+        self._shown = content
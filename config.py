@@ -9,16 +9,149 @@ class Config:
     # Discord
     DISCORD_BOT_TOKEN: str = os.environ.get("DISCORD_BOT_TOKEN", "")
 
+    # シャーディング（SHARD_COUNT=0 なら1プロセス・シャードなしで動かす）
+    # SHARD_IDS はこのプロセスが担当するシャード（カンマ区切り、空なら全シャード）
+    SHARD_COUNT: int = int(os.environ.get("SHARD_COUNT", "0"))
+    SHARD_IDS: List[int] = [
+        int(i) for i in os.environ.get("SHARD_IDS", "").split(",") if i.strip()
+    ]
+    # launcher.py で起動するプロセス数
+    SHARD_PROCESSES: int = int(os.environ.get("SHARD_PROCESSES", "1"))
+
+    # スラッシュコマンドの定義のハッシュを保存するファイル（変わったときだけ同期する）
+    COMMAND_SYNC_STATE_PATH: str = os.environ.get("COMMAND_SYNC_STATE_PATH", "data/command_tree.sha256")
+    # ログイン後にOpenAI・履歴の保存先への接続を先に作っておく
+    WARM_UP_ENABLED: bool = os.environ.get("WARM_UP_ENABLED", "true").lower() == "true"
+    WARM_UP_TIMEOUT: float = float(os.environ.get("WARM_UP_TIMEOUT", "10"))  # 秒
+
+    # ログレベル（DEBUG / INFO / WARNING など）
+    LOG_LEVEL: str = os.environ.get("LOG_LEVEL", "INFO").upper()
+
+    # ヘルスチェック・メトリクス用HTTPサーバー（Renderでは常に起動）
+    HEALTH_SERVER_ENABLED: bool = (
+        os.environ.get("HEALTH_SERVER_ENABLED", "false").lower() == "true"
+        or bool(os.environ.get("RENDER"))
+    )
+    HEALTH_PORT: int = int(os.environ.get("PORT", "10000"))
+    READY_MAX_LOOP_LAG: float = float(os.environ.get("READY_MAX_LOOP_LAG", "2.0"))  # 秒
+
     # OpenAI
     OPENAI_API_KEY: str = os.environ.get("OPENAI_API_KEY", "")
     AI_MODEL: str = os.environ.get("AI_MODEL", "gpt-4o")
     AI_MODEL_SEARCH: str = os.environ.get("AI_MODEL_SEARCH", "gpt-4o-search-preview")
 
+    # 挨拶などの短いやり取りを軽いモデルに回す（条件はJSON、更新すると自動で読み直す）
+    ROUTING_ENABLED: bool = os.environ.get("ROUTING_ENABLED", "true").lower() == "true"
+    AI_MODEL_FAST: str = os.environ.get("AI_MODEL_FAST", "gpt-4o-mini")
+    AI_FAST_MAX_TOKENS: int = int(os.environ.get("AI_FAST_MAX_TOKENS", "300"))
+    ROUTE_RULES_PATH: str = os.environ.get(
+        "ROUTE_RULES_PATH",
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "ai", "route_rules.json"),
+    )
+
+    # OpenAI呼び出しの再試行（429・5xx）と同時実行数の自動調整
+    OPENAI_MAX_RETRIES: int = int(os.environ.get("OPENAI_MAX_RETRIES", "4"))
+    OPENAI_RETRY_DEADLINE: float = float(os.environ.get("OPENAI_RETRY_DEADLINE", "30"))  # 秒
+    OPENAI_CONCURRENCY_INITIAL: int = int(os.environ.get("OPENAI_CONCURRENCY_INITIAL", "4"))
+    OPENAI_CONCURRENCY_MAX: int = int(os.environ.get("OPENAI_CONCURRENCY_MAX", "16"))
+    OPENAI_MIN_REMAINING_TOKENS: int = int(os.environ.get("OPENAI_MIN_REMAINING_TOKENS", "2000"))
+
+    # 1件のリクエストの締め切り（受付から応答の開始まで、履歴・画像・モデル呼び出しを含む）
+    REQUEST_DEADLINE: float = float(os.environ.get("REQUEST_DEADLINE", "45"))  # 秒
+    # ストリーミング中に次のトークンが来ないまま待つ上限
+    OPENAI_STREAM_IDLE_TIMEOUT: float = float(os.environ.get("OPENAI_STREAM_IDLE_TIMEOUT", "20"))  # 秒
+
+    # 遅いリクエストの複製（ヘッジ）。直近の応答時間の HEDGE_PERCENTILE を超えたら
+    # もう1本出し（HEDGE_FALLBACK_MODEL があればそのモデルへ）、先に返った方を使う
+    HEDGE_ENABLED: bool = os.environ.get("HEDGE_ENABLED", "true").lower() == "true"
+    HEDGE_PERCENTILE: float = float(os.environ.get("HEDGE_PERCENTILE", "95"))
+    HEDGE_MIN_DELAY: float = float(os.environ.get("HEDGE_MIN_DELAY", "2"))  # 秒
+    HEDGE_MAX_RATIO: float = float(os.environ.get("HEDGE_MAX_RATIO", "0.1"))  # ヘッジするリクエストの割合の上限
+    HEDGE_FALLBACK_MODEL: str = os.environ.get("HEDGE_FALLBACK_MODEL", "")
+
     # Web検索設定
     WEB_SEARCH_ENABLED: bool = os.environ.get("WEB_SEARCH_ENABLED", "true").lower() == "true"
+    # 検索を使うキーワード（カテゴリごとのJSON、更新すると自動で読み直す）
+    SEARCH_KEYWORDS_PATH: str = os.environ.get(
+        "SEARCH_KEYWORDS_PATH",
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "ai", "search_keywords.json"),
+    )
+    SEARCH_KEYWORDS_RELOAD_INTERVAL: float = float(os.environ.get("SEARCH_KEYWORDS_RELOAD_INTERVAL", "5"))  # 秒
+
+    # AIリクエストの同時実行制限
+    AI_MAX_CONCURRENT: int = int(os.environ.get("AI_MAX_CONCURRENT", "8"))
+    AI_MAX_PER_USER: int = int(os.environ.get("AI_MAX_PER_USER", "1"))
+    AI_MAX_PER_CHANNEL: int = int(os.environ.get("AI_MAX_PER_CHANNEL", "3"))
+
+    # メンション・/ask のジョブキュー（SQLite、再起動しても処理待ちのものは続きから処理する）
+    # 処理待ちの /ask のインタラクショントークンを含むので、他人が読める場所に置かないこと
+    JOB_QUEUE_PATH: str = os.environ.get("JOB_QUEUE_PATH", "data/jobs.sqlite3")
+    JOB_WORKERS: int = int(os.environ.get("JOB_WORKERS", "16"))
+    JOB_MAX_BACKLOG: int = int(os.environ.get("JOB_MAX_BACKLOG", "32"))  # 処理待ちの上限（超えたら混雑と返す）
+    JOB_MAX_ATTEMPTS: int = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+    JOB_RETRY_BASE_DELAY: float = float(os.environ.get("JOB_RETRY_BASE_DELAY", "2"))  # 秒（やり直すたびに倍）
+    JOB_RETRY_MAX_DELAY: float = float(os.environ.get("JOB_RETRY_MAX_DELAY", "60"))  # 秒
+    JOB_POLL_INTERVAL: float = float(os.environ.get("JOB_POLL_INTERVAL", "1"))  # 秒
+    JOB_DRAIN_TIMEOUT: float = float(os.environ.get("JOB_DRAIN_TIMEOUT", "10"))  # 終了時に処理中のジョブを待つ秒数
+    JOB_RETENTION: float = float(os.environ.get("JOB_RETENTION", "86400"))  # 処理済みのIDを重複除けに残す秒数
+    JOB_METRICS_INTERVAL: float = float(os.environ.get("JOB_METRICS_INTERVAL", "5"))  # 秒
+
+    # 画像ダウンロード設定
+    IMAGE_FETCH_CONCURRENCY: int = int(os.environ.get("IMAGE_FETCH_CONCURRENCY", "4"))
+    IMAGE_FETCH_TIMEOUT: float = float(os.environ.get("IMAGE_FETCH_TIMEOUT", "10"))  # 秒
+
+    # 画像の渡し方（url: URLをそのまま渡す / inline: 埋め込む / auto: Discord CDNはURL）
+    IMAGE_MODE: str = os.environ.get("IMAGE_MODE", "auto").lower()
+    IMAGE_MAX_BYTES: int = int(os.environ.get("IMAGE_MAX_BYTES", str(10 * 1024 * 1024)))
+    IMAGE_MAX_DIMENSION: int = int(os.environ.get("IMAGE_MAX_DIMENSION", "2048"))  # 長辺px
+    IMAGE_JPEG_QUALITY: int = int(os.environ.get("IMAGE_JPEG_QUALITY", "85"))
+    IMAGE_CACHE_MAX_ENTRIES: int = int(os.environ.get("IMAGE_CACHE_MAX_ENTRIES", "64"))
+
+    # 応答キャッシュ（同じ短いプロンプトへの応答を使い回す）
+    RESPONSE_CACHE_ENABLED: bool = os.environ.get("RESPONSE_CACHE_ENABLED", "false").lower() == "true"
+    RESPONSE_CACHE_MAX_ENTRIES: int = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "500"))
+    RESPONSE_CACHE_TTL: float = float(os.environ.get("RESPONSE_CACHE_TTL", "300"))  # 秒
+    RESPONSE_CACHE_SEARCH_TTL: float = float(os.environ.get("RESPONSE_CACHE_SEARCH_TTL", "0"))  # 0で検索結果は保存しない
+    RESPONSE_CACHE_HISTORY_TURNS: int = int(os.environ.get("RESPONSE_CACHE_HISTORY_TURNS", "1"))  # キーに含める直近の往復数
+
+    # ストリーミング応答（生成途中のテキストをメッセージ編集で表示）
+    STREAMING_ENABLED: bool = os.environ.get("STREAMING_ENABLED", "true").lower() == "true"
+    STREAM_EDIT_INTERVAL: float = float(os.environ.get("STREAM_EDIT_INTERVAL", "1.2"))  # 秒
+
+    # メンション時に文脈として渡す直前のメッセージ数
+    CHANNEL_CONTEXT_MESSAGES: int = int(os.environ.get("CHANNEL_CONTEXT_MESSAGES", "3"))
+    # チャンネルごとの直近メッセージのバッファ（メンション自体も入るので、文脈の件数より多くする）
+    CHANNEL_BUFFER_SIZE: int = int(os.environ.get("CHANNEL_BUFFER_SIZE", "5"))
+    CHANNEL_BUFFER_MAX_CHANNELS: int = int(os.environ.get("CHANNEL_BUFFER_MAX_CHANNELS", "5000"))
+
+    # 会話履歴の保存先（firestore / sqlite）
+    HISTORY_BACKEND: str = os.environ.get("HISTORY_BACKEND", "firestore").lower()
+    SQLITE_PATH: str = os.environ.get("SQLITE_PATH", "data/history.sqlite3")
+
+    # 使われなくなった会話の自動削除（0日で無効。既定は無効で、履歴を消すかは運用者が決める）
+    HISTORY_RETENTION_DAYS: float = float(os.environ.get("HISTORY_RETENTION_DAYS", "0"))
+    HISTORY_JANITOR_INTERVAL: float = float(os.environ.get("HISTORY_JANITOR_INTERVAL", "3600"))  # 秒
+    HISTORY_JANITOR_BATCH_SIZE: int = int(os.environ.get("HISTORY_JANITOR_BATCH_SIZE", "200"))
+    HISTORY_JANITOR_MAX_DELETES_PER_SEC: float = float(os.environ.get("HISTORY_JANITOR_MAX_DELETES_PER_SEC", "50"))
 
     # 会話履歴設定（直近の往復数）
     MAX_HISTORY_LENGTH: int = int(os.environ.get("MAX_HISTORY_LENGTH", "10"))
+    # 1リクエストで送る履歴のトークン上限（超えた古い会話は要約に畳み込む）
+    HISTORY_TOKEN_BUDGET: int = int(os.environ.get("HISTORY_TOKEN_BUDGET", "3000"))
+    # 上限に達した履歴の始まりを揃える往復数（プロンプトキャッシュ用、1で無効）
+    PROMPT_CACHE_ANCHOR_TURNS: int = int(os.environ.get("PROMPT_CACHE_ANCHOR_TURNS", "3"))
+    HISTORY_SUMMARY_ENABLED: bool = os.environ.get("HISTORY_SUMMARY_ENABLED", "true").lower() == "true"
+    # 要約が有効なときに保存する往復数の上限（古い往復は要約に畳み込んでから消すので、
+    # 送る履歴の長さはトークン予算で決まる。これは要約が追いつかないときの安全弁）
+    HISTORY_STORED_MAX_LENGTH: int = int(os.environ.get("HISTORY_STORED_MAX_LENGTH", "100"))
+    HISTORY_SUMMARY_MAX_TOKENS: int = int(os.environ.get("HISTORY_SUMMARY_MAX_TOKENS", "400"))
+    SUMMARY_MODEL: str = os.environ.get("SUMMARY_MODEL", "gpt-4o-mini")
+
+    # 会話履歴キャッシュ設定
+    HISTORY_CACHE_MAX_ENTRIES: int = int(os.environ.get("HISTORY_CACHE_MAX_ENTRIES", "1000"))
+    HISTORY_CACHE_TTL: float = float(os.environ.get("HISTORY_CACHE_TTL", "600"))  # 秒
+    HISTORY_FLUSH_INTERVAL: float = float(os.environ.get("HISTORY_FLUSH_INTERVAL", "5"))  # 秒
+    HISTORY_FLUSH_CONCURRENCY: int = int(os.environ.get("HISTORY_FLUSH_CONCURRENCY", "8"))  # 同時に書き出すドキュメント数
 
     # システムプロンプト
     SYSTEM_PROMPT: str = """あなたは「修造」というキャラクターです。松岡修造のような熱血キャラクターとして振る舞ってください。
@@ -51,4 +184,16 @@ class Config:
             errors.append("DISCORD_BOT_TOKEN が設定されていません")
         if not cls.OPENAI_API_KEY:
             errors.append("OPENAI_API_KEY が設定されていません")
+        if cls.HISTORY_BACKEND not in ("firestore", "sqlite"):
+            errors.append(f"HISTORY_BACKEND が不正です: {cls.HISTORY_BACKEND}")
+        if cls.CHANNEL_BUFFER_SIZE <= cls.CHANNEL_CONTEXT_MESSAGES:
+            # バッファから足りる件数を返せず、毎回APIで取得することになる
+            errors.append("CHANNEL_BUFFER_SIZE は CHANNEL_CONTEXT_MESSAGES より大きくしてください")
+        if cls.HISTORY_JANITOR_BATCH_SIZE <= 0:
+            errors.append("HISTORY_JANITOR_BATCH_SIZE は1以上にしてください")
+        if cls.SHARD_IDS and not cls.SHARD_COUNT:
+            errors.append("SHARD_IDS を使う場合は SHARD_COUNT も設定してください")
+        bad_ids = [i for i in cls.SHARD_IDS if not 0 <= i < cls.SHARD_COUNT]
+        if cls.SHARD_COUNT and bad_ids:
+            errors.append(f"SHARD_IDS に範囲外のシャードがあります: {bad_ids}")
         return errors
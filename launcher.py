@@ -0,0 +1,140 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+from typing import Dict, List, Tuple
+
+from config import Config
+
+
+# Discordは同じバケットのIDENTIFYを5秒に1回しか受け付けない
+IDENTIFY_INTERVAL = 5.0
+
+
+def fetch_gateway_info(token: str) -> Tuple[int, int]:
+    """推奨シャード数と、同時にIDENTIFYできる数を取得する"""
+    request = urllib.request.Request(
+        "https://discord.com/api/v10/gateway/bot",
+        headers={"Authorization": f"Bot {token}", "User-Agent": "DiscordBot (launcher, 1.0)"},
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        data = json.load(response)
+    return data["shards"], data["session_start_limit"]["max_concurrency"]
+
+
+def assign_shards(shard_count: int, processes: int) -> List[List[int]]:
+    """シャードをプロセスに連続した範囲で均等に割り振る"""
+    processes = max(1, min(processes, shard_count))
+    base, extra = divmod(shard_count, processes)
+    groups = []
+    start = 0
+    for i in range(processes):
+        size = base + (1 if i < extra else 0)
+        groups.append(list(range(start, start + size)))
+        start += size
+    return groups
+
+
+class Launcher:
+    """シャードを分担するBotプロセスを複数起動して見守る
+
+    各プロセスは main.py をそのまま実行し、担当シャード（SHARD_IDS）と
+    ヘルスチェック用のポート（PORT + 番号）を環境変数で受け取る。
+    落ちたプロセスは5秒後に起動し直す。
+    """
+
+    def __init__(self, shard_count: int, groups: List[List[int]], max_concurrency: int = 1):
+        self.shard_count = shard_count
+        self.groups = groups
+        self.max_concurrency = max(1, max_concurrency)
+        self.processes: Dict[int, subprocess.Popen] = {}
+        self.stopping = False
+
+    def _env(self, index: int) -> Dict[str, str]:
+        env = dict(os.environ)
+        env["SHARD_COUNT"] = str(self.shard_count)
+        env["SHARD_IDS"] = ",".join(str(i) for i in self.groups[index])
+        env["PORT"] = str(Config.HEALTH_PORT + index)
+        env["HEALTH_SERVER_ENABLED"] = "true"
+        return env
+
+    def _spawn(self, index: int) -> None:
+        shard_ids = self.groups[index]
+        print(f"Starting process {index} (shards {shard_ids}, port {Config.HEALTH_PORT + index})")
+        self.processes[index] = subprocess.Popen(
+            [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")],
+            env=self._env(index),
+        )
+
+    def _startup_delay(self, index: int) -> float:
+        """前のプロセスのシャードがIDENTIFYし終わるまでの目安"""
+        return IDENTIFY_INTERVAL * len(self.groups[index]) / self.max_concurrency
+
+    def stop(self, *_) -> None:
+        self.stopping = True
+        for process in self.processes.values():
+            if process.poll() is None:
+                process.terminate()
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for index in range(len(self.groups)):
+            if self.stopping:
+                break
+            self._spawn(index)
+            if index + 1 < len(self.groups):
+                time.sleep(self._startup_delay(index))
+
+        restart_at: Dict[int, float] = {}
+        while not self.stopping:
+            now = time.monotonic()
+            for index, process in list(self.processes.items()):
+                if process.poll() is None:
+                    continue
+                if index not in restart_at:
+                    print(f"Process {index} exited with code {process.returncode}, restarting in 5 seconds...")
+                    restart_at[index] = now + 5
+                elif now >= restart_at[index]:
+                    del restart_at[index]
+                    self._spawn(index)
+            time.sleep(1)
+
+        # 終了処理（各プロセスは未書き込みの履歴を書き出してから終わる）
+        deadline = time.monotonic() + 30
+        for process in self.processes.values():
+            try:
+                process.wait(timeout=max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def main() -> None:
+    errors = Config.validate()
+    if errors:
+        print("設定エラー:")
+        for error in errors:
+            print(f"  - {error}")
+        sys.exit(1)
+
+    shard_count = Config.SHARD_COUNT
+    max_concurrency = 1
+    if not shard_count:
+        # シャード数が未指定ならDiscordの推奨値を使う
+        try:
+            shard_count, max_concurrency = fetch_gateway_info(Config.DISCORD_BOT_TOKEN)
+        except Exception as e:
+            print(f"Failed to fetch recommended shard count: {e}")
+            shard_count = Config.SHARD_PROCESSES
+
+    groups = assign_shards(shard_count, Config.SHARD_PROCESSES)
+    print(f"Launching {len(groups)} process(es) for {shard_count} shard(s)")
+    Launcher(shard_count, groups, max_concurrency).run()
+
+
+if __name__ == "__main__":
+    main()
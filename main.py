@@ -1,36 +1,88 @@
 import asyncio
+import logging
+import signal
 import sys
-import os
 from threading import Thread
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 
+# 起動時間の計測を始める（重いモジュールの import より先に）
+from bot.startup import STARTUP
 from config import Config
-from bot.client import create_bot, setup_bot
+from bot.client import create_bot, setup_bot, shard_states
+from metrics import REGISTRY, LoopMonitor
 
 
 class HealthCheckHandler(BaseHTTPRequestHandler):
-    """Renderのヘルスチェック用（スリープ防止）"""
+    """ヘルスチェック・メトリクス用（Renderのスリープ防止も兼ねる）
+
+    - /healthz: プロセスが生きていれば常に200
+    - /readyz: ゲートウェイに接続中で、イベントループが詰まっていなければ200
+    - /metrics: Prometheus形式のメトリクス
+    """
+
+    bot = None
+    loop_monitor = None
 
     def do_GET(self):
-        self.send_response(200)
-        self.send_header("Content-type", "text/plain")
+        path = self.path.split("?", 1)[0]
+        if path == "/metrics":
+            self._reply(200, REGISTRY.render(), "text/plain; version=0.0.4")
+        elif path == "/readyz":
+            ready, reason = self._readiness()
+            self._reply(200 if ready else 503, reason)
+        else:
+            self._reply(200, "OK")
+
+    def _readiness(self):
+        bot = self.bot
+        if bot is None or bot.is_closed() or not bot.is_ready():
+            return False, "not connected"
+        if self.loop_monitor is not None and not self.loop_monitor.responsive(
+            Config.READY_MAX_LOOP_LAG
+        ):
+            return False, "event loop unresponsive"
+
+        # シャードごとの接続状態（1つでも切れていれば準備できていない扱い）
+        states = shard_states(bot)
+        lines = [
+            f"shard {shard_id}: {'connected' if connected else 'disconnected'}"
+            for shard_id, connected in sorted(states.items())
+        ]
+        ready = all(states.values())
+        return ready, ("OK" if ready else "gateway disconnected") + "\n" + "\n".join(lines)
+
+    def _reply(self, status: int, body: str, content_type: str = "text/plain"):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-Length", str(len(data)))
         self.end_headers()
-        self.wfile.write(b"OK")
+        self.wfile.write(data)
 
     def log_message(self, format, *args):
         pass  # ログを抑制
 
 
-def start_health_server():
+def start_health_server(bot, loop_monitor: LoopMonitor):
     """ヘルスチェック用HTTPサーバーを起動"""
-    port = int(os.environ.get("PORT", 10000))
-    server = HTTPServer(("0.0.0.0", port), HealthCheckHandler)
+    HealthCheckHandler.bot = bot
+    HealthCheckHandler.loop_monitor = loop_monitor
+    port = Config.HEALTH_PORT
+    server = ThreadingHTTPServer(("0.0.0.0", port), HealthCheckHandler)
     thread = Thread(target=server.serve_forever, daemon=True)
     thread.start()
     print(f"Health check server running on port {port}")
 
 
 async def main():
+    STARTUP.mark("imports")
+
+    # ログ出力（DEBUGはLOG_LEVEL=DEBUGのときだけ出る）
+    logging.basicConfig(
+        level=Config.LOG_LEVEL,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+
     # 環境変数の検証
     errors = Config.validate()
     if errors:
@@ -39,25 +91,47 @@ async def main():
             print(f"  - {error}")
         sys.exit(1)
 
-    # ヘルスチェックサーバー起動（Render用）
-    if os.environ.get("RENDER"):
-        start_health_server()
-
     # Botを作成
     bot = create_bot()
 
     # 初期設定
-    await setup_bot(bot)
+    services = await setup_bot(bot)
+    STARTUP.mark("setup")
+
+    # イベントループの遅れを測りつつ、定期的にメトリクスを集める
+    loop_monitor = LoopMonitor()
+    loop_monitor.start()
+
+    # ヘルスチェック・メトリクスサーバー起動
+    if Config.HEALTH_SERVER_ENABLED:
+        start_health_server(bot, loop_monitor)
+
+    # SIGTERM（Renderの再デプロイ等）でも終了処理を走らせる
+    main_task = asyncio.current_task()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, main_task.cancel)
 
     # Bot起動（自動再接続付き）
     print("Starting bot...")
-    while True:
-        try:
-            await bot.start(Config.DISCORD_BOT_TOKEN)
-        except Exception as e:
-            print(f"Bot disconnected: {e}")
-            print("Reconnecting in 5 seconds...")
-            await asyncio.sleep(5)
+    try:
+        while True:
+            try:
+                await bot.start(Config.DISCORD_BOT_TOKEN)
+            except Exception as e:
+                print(f"Bot disconnected: {e}")
+                print("Reconnecting in 5 seconds...")
+                await asyncio.sleep(5)
+    except asyncio.CancelledError:
+        print("Shutting down...")
+    finally:
+        loop_monitor.stop()
+        # 処理中のジョブを少し待ち、残りは次の起動に回す
+        await services.jobs.close()
+        # 送信待ちの応答はDiscordとの接続を閉じる前に送り切る
+        await services.outbound.close()
+        if not bot.is_closed():
+            await bot.close()
+        # 未書き込みの会話履歴を書き出して接続を閉じる
+        await services.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,268 @@
+import asyncio
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Mapping, Sequence, Tuple
+
+# 応答時間向けのバケット（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# 値の記録はイベントループから、出力はヘルスチェックサーバーのスレッドから
+# 行うので、更新と読み出しはロックで守る
+_lock = threading.Lock()
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(pairs: Sequence[Tuple[str, str]]) -> str:
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value != value:
+        return "NaN"
+    if value == float("inf"):
+        return "+Inf"
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+class Registry:
+    """メトリクスと、出力前に値を集めるコレクターの一覧"""
+
+    def __init__(self):
+        self._metrics: List["_Metric"] = []
+        self._collectors: List[Callable[[], None]] = []
+
+    def register(self, metric: "_Metric") -> None:
+        self._metrics.append(metric)
+
+    def add_collector(self, collector: Callable[[], None]) -> None:
+        """collect() のたびに呼ばれる関数を登録する（イベントループ上で呼ぶ）"""
+        self._collectors.append(collector)
+
+    def collect(self) -> None:
+        """各コンポーネントの stats() などをメトリクスに写す"""
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                print(f"Failed to collect metrics: {e}")
+
+    def render(self) -> str:
+        """Prometheusのテキスト形式で出力する"""
+        lines: List[str] = []
+        with _lock:
+            for metric in self._metrics:
+                lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values: Dict[Tuple[str, ...], object] = {}
+        REGISTRY.register(self)
+
+    def _key(self, labels: Mapping[str, object]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        for key, value in self._values.items():
+            labels = _format_labels(list(zip(self.label_names, key)))
+            lines.append(f"{self.name}{labels} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    """増えるだけの値（リクエスト数・トークン数など）"""
+
+    type = "counter"
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    """現在の値（キューの長さなど）"""
+
+    type = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = float(value)
+
+
+class Histogram(_Metric):
+    """値の分布（処理時間など）"""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            state = self._values.get(key)
+            if state is None:
+                # [バケットごとの件数..., 合計, 件数]
+                state = [0] * len(self.buckets) + [0.0, 0]
+                self._values[key] = state
+            if index < len(self.buckets):
+                state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """with ブロックの処理時間を記録する"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        for key, state in self._values.items():
+            pairs = list(zip(self.label_names, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                labels = _format_labels(pairs + [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(pairs + [("le", "+Inf")])
+            lines.append(f"{self.name}_bucket{labels} {state[-1]}")
+            labels = _format_labels(pairs)
+            lines.append(f"{self.name}_sum{labels} {_format_value(state[-2])}")
+            lines.append(f"{self.name}_count{labels} {state[-1]}")
+        return lines
+
+
+def register_stats(name: str, help: str, stats: Callable[[], Mapping[str, float]]) -> None:
+    """stats() の各項目を {stat="..."} ラベル付きのゲージとして出力する"""
+    gauge = Gauge(name, help, ["stat"])
+
+    def collect() -> None:
+        for stat, value in stats().items():
+            if isinstance(value, (int, float)):
+                gauge.set(value, stat=stat)
+
+    REGISTRY.add_collector(collect)
+
+
+# --- 各処理段階のメトリクス ---
+
+REQUESTS = Counter("shizue_requests_total", "Handled AI requests", ["source"])
+REQUEST_ERRORS = Counter(
+    "shizue_request_errors_total", "AI requests that failed", ["source", "error"]
+)
+REQUEST_SECONDS = Histogram(
+    "shizue_request_seconds", "End-to-end latency of AI requests", ["source"]
+)
+STAGE_SECONDS = Histogram(
+    "shizue_stage_seconds",
+    "Latency of each stage (history_read, channel_context, image_fetch, history_write, discord_send, discord_edit)",
+    ["stage"],
+)
+OPENAI_SECONDS = Histogram(
+    "shizue_openai_seconds", "Latency of OpenAI chat completions", ["model", "route", "search", "stream"]
+)
+OPENAI_TOKENS = Counter(
+    "shizue_openai_tokens_total",
+    "Tokens used by OpenAI calls (prompt, cached, completion)",
+    ["model", "route", "kind"],
+)
+OPENAI_ROUTES = Counter(
+    "shizue_openai_routes_total", "Chat requests by model route (fast, full, search) and reason", ["route", "reason"]
+)
+OPENAI_PROMPT_CACHE_HIT_RATIO = Gauge(
+    "shizue_openai_prompt_cache_hit_ratio", "Share of prompt tokens served from the provider prompt cache", ["model"]
+)
+JOB_BACKLOG = Gauge(
+    "shizue_job_backlog", "Jobs in the durable queue by status (pending, running)", ["kind", "status"]
+)
+JOB_OLDEST_AGE_SECONDS = Gauge(
+    "shizue_job_oldest_age_seconds", "Age of the oldest pending or running job", ["kind"]
+)
+JOB_WAIT_SECONDS = Histogram(
+    "shizue_job_wait_seconds", "Time from enqueue until a worker first picks the job up", ["kind"]
+)
+JOB_RESULTS = Counter(
+    "shizue_jobs_total", "Job attempts by result (done, retried, failed)", ["kind", "result"]
+)
+LOOP_LAG_SECONDS = Gauge("shizue_event_loop_lag_seconds", "Latest event loop lag")
+GATEWAY_CONNECTED = Gauge(
+    "shizue_gateway_connected", "1 while the shard is connected to the Discord gateway", ["shard"]
+)
+GATEWAY_LATENCY_SECONDS = Gauge(
+    "shizue_gateway_latency_seconds", "Discord gateway heartbeat latency", ["shard"]
+)
+STARTUP_SECONDS = Gauge(
+    "shizue_startup_seconds", "Time spent in each startup phase of this process", ["phase"]
+)
+
+
+class LoopMonitor:
+    """イベントループの遅れを測り、定期的にメトリクスを集める
+
+    interval 秒ごとに起きるタスクが、予定よりどれだけ遅れて起きたかを測る。
+    ループが止まるとハートビートが途絶えるので、別スレッドからも検知できる。
+    """
+
+    def __init__(self, interval: float = 1.0):
+        self.interval = interval
+        self.lag = 0.0
+        self.last_beat = time.monotonic()
+        self._task = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.lag = max(0.0, now - start - self.interval)
+            self.last_beat = now
+            LOOP_LAG_SECONDS.set(self.lag)
+            REGISTRY.collect()
+
+    def responsive(self, max_lag: float) -> bool:
+        """ループが max_lag 秒以内の遅れで動いているか（別スレッドから呼べる）"""
+        stalled = time.monotonic() - self.last_beat - self.interval
+        return self.lag <= max_lag and stalled <= max_lag
+
+    def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
@@ -0,0 +1,78 @@
+import asyncio
+import importlib
+from typing import AsyncIterator, Dict, List, Optional
+
+from config import Config
+from storage.base import HistoryBackend
+
+# 名前 -> (モジュール, クラス)。使わない保存先のSDK（google-cloud-firestore など）は読み込まない
+_BACKENDS = {
+    "sqlite": ("storage.sqlite_history", "SQLiteHistory"),
+    "firestore": ("storage.firestore_history", "ConversationHistory"),
+}
+
+
+def create_history_backend(name: Optional[str] = None) -> HistoryBackend:
+    """Config.HISTORY_BACKEND に応じた履歴の保存先を作る"""
+    name = name or Config.HISTORY_BACKEND
+    if name not in _BACKENDS:
+        raise ValueError(f"unknown history backend: {name}")
+    module, cls = _BACKENDS[name]
+    return getattr(importlib.import_module(module), cls)()
+
+
+class LazyHistoryBackend(HistoryBackend):
+    """初めて使うときに保存先を作る HistoryBackend
+
+    google-cloud-firestore は読み込みが重いので、起動時には読み込まない。
+    warm_up() で別スレッドから読み込み、接続まで済ませておく（OpenAIのSDKと同じ）。
+    """
+
+    def __init__(self, name: Optional[str] = None):
+        super().__init__()
+        self.name = name or Config.HISTORY_BACKEND
+        if self.name not in _BACKENDS:
+            raise ValueError(f"unknown history backend: {self.name}")
+        self._backend: Optional[HistoryBackend] = None
+
+    @property
+    def backend(self) -> HistoryBackend:
+        if self._backend is None:
+            self._backend = create_history_backend(self.name)
+        return self._backend
+
+    async def warm_up(self) -> None:
+        if self._backend is None:
+            # import はイベントループを止めないよう別スレッドで行う
+            await asyncio.to_thread(importlib.import_module, _BACKENDS[self.name][0])
+        await self.backend.warm_up()
+
+    async def get_conversation(self, channel_id: int, user_id: int) -> Dict:
+        return await self.backend.get_conversation(channel_id, user_id)
+
+    async def append_messages(
+        self, channel_id: int, user_id: int, new_messages: List[Dict]
+    ) -> None:
+        await self.backend.append_messages(channel_id, user_id, new_messages)
+
+    async def compact_history(
+        self, channel_id: int, user_id: int, folded: List[Dict], summary: str
+    ) -> bool:
+        return await self.backend.compact_history(channel_id, user_id, folded, summary)
+
+    async def clear_history(self, channel_id: int, user_id: int) -> bool:
+        return await self.backend.clear_history(channel_id, user_id)
+
+    async def delete_idle(self, cutoff: float, batch_size: int) -> int:
+        return await self.backend.delete_idle(cutoff, batch_size)
+
+    def iter_conversations(self) -> AsyncIterator[Dict]:
+        return self.backend.iter_conversations()
+
+    async def import_conversation(self, conversation: Dict) -> None:
+        await self.backend.import_conversation(conversation)
+
+    async def close(self) -> None:
+        # 一度も使っていなければ何も読み込まない
+        if self._backend is not None:
+            await self._backend.close()
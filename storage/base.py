@@ -0,0 +1,102 @@
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, Dict, List
+
+from config import Config
+
+
+class HistoryBackend(ABC):
+    """会話履歴の保存先の共通インターフェース
+
+    会話は (channel_id, user_id) ごとに、メッセージの列と古い会話の要約を持つ。
+    Config.HISTORY_BACKEND で使う実装を選ぶ（storage.create_history_backend）。
+    """
+
+    def __init__(self):
+        # 保存する往復数の上限。要約が有効なら、要約に畳み込む前の往復を消さないよう広げる
+        if Config.HISTORY_SUMMARY_ENABLED:
+            self.max_history = max(Config.MAX_HISTORY_LENGTH, Config.HISTORY_STORED_MAX_LENGTH)
+        else:
+            self.max_history = Config.MAX_HISTORY_LENGTH
+
+    def _get_doc_id(self, channel_id: int, user_id: int) -> str:
+        """チャンネル+ユーザーでユニークなIDを生成"""
+        return f"{channel_id}_{user_id}"
+
+    @abstractmethod
+    async def get_conversation(self, channel_id: int, user_id: int) -> Dict:
+        """会話履歴と、古い会話の要約を取得
+
+        Returns:
+            {"messages": [...], "summary": "..."}
+        """
+
+    @abstractmethod
+    async def append_messages(
+        self, channel_id: int, user_id: int, new_messages: List[Dict]
+    ) -> None:
+        """複数のメッセージをまとめて履歴に追加（最大数を超えた古いものは消す）"""
+
+    @abstractmethod
+    async def compact_history(
+        self, channel_id: int, user_id: int, folded: List[Dict], summary: str
+    ) -> bool:
+        """先頭の folded を履歴から外し、要約を summary に置き換える
+
+        その間に履歴が書き換わっていて先頭が一致しない場合は何もせず False を返す。
+        """
+
+    @abstractmethod
+    async def clear_history(self, channel_id: int, user_id: int) -> bool:
+        """会話履歴をクリア（消すものがなければ False）"""
+
+    @abstractmethod
+    async def delete_idle(self, cutoff: float, batch_size: int) -> int:
+        """cutoff（UNIX時間）より前から更新のない会話を最大 batch_size 件削除する
+
+        Returns:
+            削除した件数（batch_size 未満なら残りはない）
+        """
+
+    @abstractmethod
+    def iter_conversations(self) -> AsyncIterator[Dict]:
+        """全会話を順に返す（移行用）
+
+        {"channel_id", "user_id", "messages", "summary", "updated_at"} の形で、
+        updated_at はUNIX時間（秒）。
+        """
+
+    @abstractmethod
+    async def import_conversation(self, conversation: Dict) -> None:
+        """iter_conversations() の形式の会話をそのまま書き込む（移行用）"""
+
+    async def warm_up(self) -> None:
+        """接続を確立しておく（最初のリクエストで待たないように）"""
+
+    async def close(self) -> None:
+        """接続を閉じる"""
+
+    async def get_history(self, channel_id: int, user_id: int) -> List[Dict]:
+        """会話履歴を取得"""
+        conversation = await self.get_conversation(channel_id, user_id)
+        return conversation["messages"]
+
+    async def add_message(
+        self, channel_id: int, user_id: int, role: str, content: str
+    ) -> None:
+        """メッセージを履歴に追加"""
+        await self.append_messages(
+            channel_id, user_id, [{"role": role, "content": content}]
+        )
+
+    async def add_conversation(
+        self, channel_id: int, user_id: int, user_message: str, assistant_message: str
+    ) -> None:
+        """ユーザーとアシスタントのメッセージをまとめて追加"""
+        await self.append_messages(
+            channel_id,
+            user_id,
+            [
+                {"role": "user", "content": user_message},
+                {"role": "assistant", "content": assistant_message},
+            ],
+        )
@@ -1,62 +1,148 @@
 import datetime
-from typing import List, Dict
+import inspect
+from typing import AsyncIterator, List, Dict, Optional
+from google.api_core.exceptions import FailedPrecondition, NotFound
 from google.cloud import firestore
 
-from config import Config
+from storage.base import HistoryBackend
+
+
+@firestore.async_transactional
+async def _append_in_transaction(
+    transaction: firestore.AsyncTransaction,
+    doc_ref: firestore.AsyncDocumentReference,
+    new_messages: List[Dict],
+    max_messages: int,
+    channel_id: int,
+    user_id: int,
+) -> None:
+    """トランザクション内で履歴を読み、追記・トリムして書き戻す
+
+    競合した場合は Firestore がトランザクションごと再実行するため、
+    同じドキュメントへの同時書き込みで更新が失われない。
+    """
+    doc = await doc_ref.get(transaction=transaction)
+    messages = doc.to_dict().get("messages", []) if doc.exists else []
+
+    messages.extend(new_messages)
+
+    # 最大数を超えた場合、古いものを削除
+    if len(messages) > max_messages:
+        messages = messages[-max_messages:]
+
+    transaction.set(
+        doc_ref,
+        {
+            "messages": messages,
+            "channel_id": channel_id,
+            "user_id": user_id,
+            # インデックスで期限切れを探せるよう、文字列ではなくタイムスタンプで保存する
+            "updated_at": firestore.SERVER_TIMESTAMP,
+        },
+        merge=True,  # 要約など他のフィールドは残す
+    )
+
+
+@firestore.async_transactional
+async def _compact_in_transaction(
+    transaction: firestore.AsyncTransaction,
+    doc_ref: firestore.AsyncDocumentReference,
+    folded: List[Dict],
+    summary: str,
+) -> bool:
+    """要約に畳み込んだ古いメッセージを消し、要約を保存する
+
+    その間に履歴が書き換わっていて先頭が一致しない場合は何もしない。
+    """
+    doc = await doc_ref.get(transaction=transaction)
+    if not doc.exists:
+        return False
+
+    messages = doc.to_dict().get("messages", [])
+    if messages[: len(folded)] != folded:
+        return False
+
+    transaction.update(
+        doc_ref,
+        {
+            "messages": messages[len(folded) :],
+            "summary": summary,
+        },
+    )
+    return True
+
+
+def _to_epoch(value) -> Optional[float]:
+    """updated_at（タイムスタンプ、または以前のISO文字列）をUNIX時間に変換する"""
+    if isinstance(value, datetime.datetime):
+        return value.timestamp()
+    if isinstance(value, str):
+        try:
+            return datetime.datetime.fromisoformat(value).timestamp()
+        except ValueError:
+            return None
+    return None
+
 
+class ConversationHistory(HistoryBackend):
+    """Firestoreを使った会話履歴管理
 
-class ConversationHistory:
-    """Firestoreを使った会話履歴管理"""
+    同期版の firestore.Client はイベントループをブロックするため、
+    AsyncClient を使って複数ユーザーの履歴I/Oを並行に処理する。
+    """
 
     def __init__(self):
-        self.db = firestore.Client()
+        super().__init__()
+        self.db = firestore.AsyncClient()
         self.collection = self.db.collection("ai_bot_conversations")
-        self.max_history = Config.MAX_HISTORY_LENGTH
 
-    def _get_doc_id(self, channel_id: int, user_id: int) -> str:
-        """チャンネル+ユーザーでユニークなドキュメントIDを生成"""
-        return f"{channel_id}_{user_id}"
+    async def warm_up(self) -> None:
+        """認証とgRPCチャンネルの確立を済ませておく（存在しないドキュメントを1回読む）"""
+        await self.collection.document("_warm_up").get()
 
-    async def get_history(self, channel_id: int, user_id: int) -> List[Dict]:
-        """会話履歴を取得"""
+    async def get_conversation(self, channel_id: int, user_id: int) -> Dict:
+        """会話履歴と、古い会話の要約を取得
+
+        Returns:
+            {"messages": [...], "summary": "..."}
+        """
         doc_id = self._get_doc_id(channel_id, user_id)
-        doc = self.collection.document(doc_id).get()
+        doc = await self.collection.document(doc_id).get()
 
         if not doc.exists:
-            return []
+            return {"messages": [], "summary": ""}
 
         data = doc.to_dict()
-        return data.get("messages", [])
-
-    async def add_message(
-        self, channel_id: int, user_id: int, role: str, content: str
-    ) -> None:
-        """メッセージを履歴に追加"""
+        return {
+            "messages": data.get("messages", []),
+            "summary": data.get("summary", ""),
+        }
+
+    async def compact_history(
+        self, channel_id: int, user_id: int, folded: List[Dict], summary: str
+    ) -> bool:
+        """先頭の folded を履歴から外し、要約を summary に置き換える"""
         doc_id = self._get_doc_id(channel_id, user_id)
         doc_ref = self.collection.document(doc_id)
 
-        # 現在の履歴を取得
-        doc = doc_ref.get()
-        if doc.exists:
-            messages = doc.to_dict().get("messages", [])
-        else:
-            messages = []
-
-        # 新しいメッセージを追加
-        messages.append({"role": role, "content": content})
+        return await _compact_in_transaction(
+            self.db.transaction(), doc_ref, folded, summary
+        )
 
-        # 最大数を超えた場合、古いものを削除（システムメッセージ以外）
-        if len(messages) > self.max_history * 2:  # user + assistant で2件
-            messages = messages[-(self.max_history * 2) :]
+    async def append_messages(
+        self, channel_id: int, user_id: int, new_messages: List[Dict]
+    ) -> None:
+        """複数のメッセージを1回のトランザクションで履歴に追加"""
+        doc_id = self._get_doc_id(channel_id, user_id)
+        doc_ref = self.collection.document(doc_id)
 
-        # 保存
-        doc_ref.set(
-            {
-                "messages": messages,
-                "channel_id": channel_id,
-                "user_id": user_id,
-                "updated_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
-            }
+        await _append_in_transaction(
+            self.db.transaction(),
+            doc_ref,
+            new_messages,
+            self.max_history * 2,  # user + assistant で2件
+            channel_id,
+            user_id,
         )
 
     async def clear_history(self, channel_id: int, user_id: int) -> bool:
@@ -64,14 +150,89 @@ class ConversationHistory:
         doc_id = self._get_doc_id(channel_id, user_id)
         doc_ref = self.collection.document(doc_id)
 
-        if doc_ref.get().exists:
-            doc_ref.delete()
-            return True
-        return False
+        # 存在を前提条件にして削除する（事前の読み取りは不要）
+        try:
+            await doc_ref.delete(option=self.db.write_option(exists=True))
+        except NotFound:
+            return False
+        return True
+
+    async def delete_idle(self, cutoff: float, batch_size: int) -> int:
+        """cutoff より前から更新のない会話を最大 batch_size 件削除する"""
+        cutoff_at = datetime.datetime.fromtimestamp(cutoff, datetime.timezone.utc)
+
+        # 以前のISO文字列の updated_at は文字列同士でしか比較されないので、別に探す
+        snapshots = []
+        for bound in (cutoff_at, cutoff_at.isoformat()):
+            query = (
+                self.collection.where(filter=firestore.FieldFilter("updated_at", "<", bound))
+                .select([])
+                .limit(batch_size - len(snapshots))
+            )
+            snapshots.extend([doc async for doc in query.stream()])
+            if len(snapshots) >= batch_size:
+                break
+        if not snapshots:
+            return 0
+
+        def option(doc):
+            # 探してから消すまでの間に更新された会話は消さない
+            return self.db.write_option(last_update_time=doc.update_time)
+
+        batch = self.db.batch()
+        for doc in snapshots:
+            batch.delete(doc.reference, option=option(doc))
+        try:
+            await batch.commit()
+            return len(snapshots)
+        except (FailedPrecondition, NotFound):
+            pass
+
+        # 一部が更新・削除されていたら、1件ずつ消す
+        deleted = 0
+        for doc in snapshots:
+            try:
+                await doc.reference.delete(option=option(doc))
+                deleted += 1
+            except (FailedPrecondition, NotFound):
+                pass
+        return deleted
+
+    async def iter_conversations(self) -> AsyncIterator[Dict]:
+        """全会話を順に返す（移行用）"""
+        async for doc in self.collection.stream():
+            data = doc.to_dict()
+            # 古いドキュメントはIDから取り出す
+            channel_id, _, user_id = doc.id.partition("_")
+            yield {
+                "channel_id": int(data.get("channel_id", channel_id)),
+                "user_id": int(data.get("user_id", user_id)),
+                "messages": data.get("messages", []),
+                "summary": data.get("summary", ""),
+                "updated_at": _to_epoch(data.get("updated_at")),
+            }
 
-    async def add_conversation(
-        self, channel_id: int, user_id: int, user_message: str, assistant_message: str
-    ) -> None:
-        """ユーザーとアシスタントのメッセージをまとめて追加"""
-        await self.add_message(channel_id, user_id, "user", user_message)
-        await self.add_message(channel_id, user_id, "assistant", assistant_message)
+    async def import_conversation(self, conversation: Dict) -> None:
+        """会話をそのまま書き込む（移行用）"""
+        doc_id = self._get_doc_id(conversation["channel_id"], conversation["user_id"])
+        updated_at = conversation.get("updated_at")
+        if updated_at is None:
+            updated = datetime.datetime.now(datetime.timezone.utc)
+        else:
+            updated = datetime.datetime.fromtimestamp(updated_at, datetime.timezone.utc)
+        await self.collection.document(doc_id).set(
+            {
+                "messages": conversation["messages"],
+                "summary": conversation.get("summary", ""),
+                "channel_id": conversation["channel_id"],
+                "user_id": conversation["user_id"],
+                "updated_at": updated,
+            }
+        )
+
+    async def close(self) -> None:
+        """Firestoreのクライアントを閉じる"""
+        # 公開APIの close() を使う（バージョンによっては coroutine を返す）
+        result = self.db.close()
+        if inspect.isawaitable(result):
+            await result
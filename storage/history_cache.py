@@ -0,0 +1,278 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from config import Config
+from storage.base import HistoryBackend
+
+logger = logging.getLogger(__name__)
+
+
+class _CacheEntry:
+    """キャッシュ済みの会話履歴"""
+
+    __slots__ = ("messages", "summary", "expires_at")
+
+    def __init__(self, messages: List[Dict], summary: str, expires_at: float):
+        self.messages = messages
+        self.summary = summary
+        self.expires_at = expires_at
+
+
+class CachedConversationHistory:
+    """履歴の保存先（HistoryBackend）の前段に置くLRU/TTLキャッシュ
+
+    会話中のユーザーの履歴はメモリから返し、保存先への読み取りを省く。
+    書き込みはドキュメントごとにまとめておき、一定間隔とclose()時に
+    バックグラウンドで保存先へ書き出す（write-behind）。
+    """
+
+    def __init__(
+        self,
+        backend: HistoryBackend,
+        max_entries: int = Config.HISTORY_CACHE_MAX_ENTRIES,
+        ttl: float = Config.HISTORY_CACHE_TTL,
+        flush_interval: float = Config.HISTORY_FLUSH_INTERVAL,
+        flush_concurrency: int = Config.HISTORY_FLUSH_CONCURRENCY,
+    ):
+        self.backend = backend
+        self.max_history = backend.max_history
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+
+        self._entries: "OrderedDict[str, _CacheEntry]" = OrderedDict()
+        # doc_id -> (channel_id, user_id, 未書き込みのメッセージ)
+        self._pending: Dict[str, Tuple[int, int, List[Dict]]] = {}
+        self._inflight: Dict[str, asyncio.Task] = {}  # 書き出し中のdoc_id -> 書き込みタスク
+        # 保存先を読み込み中のdoc_id -> 読み込み中のリクエスト数と、その間に書き換えた回数
+        self._reading: Dict[str, int] = {}
+        self._generations: Dict[str, int] = {}
+        # 未書き込み分の取り出しと、削除・要約・読み直しを排他にする（書き込み中は持たない）
+        self._flush_lock = asyncio.Lock()
+        self._flushing = asyncio.Lock()  # フラッシュは同時に1つだけ
+        self._write_slots = asyncio.Semaphore(flush_concurrency)
+        self._flusher: Optional[asyncio.Task] = None
+
+        # 統計情報
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.flushes = 0
+        self.flush_errors = 0
+
+    def _get_doc_id(self, channel_id: int, user_id: int) -> str:
+        return self.backend._get_doc_id(channel_id, user_id)
+
+    def _trim(self, messages: List[Dict]) -> List[Dict]:
+        limit = self.max_history * 2  # user + assistant で2件
+        if len(messages) > limit:
+            return messages[-limit:]
+        return messages
+
+    def _store(self, doc_id: str, messages: List[Dict], summary: str) -> None:
+        """エントリを保存し、上限を超えた分を古い順に追い出す"""
+        self._entries[doc_id] = _CacheEntry(messages, summary, time.monotonic() + self.ttl)
+        self._entries.move_to_end(doc_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get_history(self, channel_id: int, user_id: int) -> List[Dict]:
+        """会話履歴を取得（キャッシュにあれば保存先を読まない）"""
+        conversation = await self.get_conversation(channel_id, user_id)
+        return conversation["messages"]
+
+    async def get_conversation(self, channel_id: int, user_id: int) -> Dict:
+        """会話履歴と要約を取得（キャッシュにあれば保存先を読まない）"""
+        doc_id = self._get_doc_id(channel_id, user_id)
+
+        entry = self._entries.get(doc_id)
+        if entry is not None:
+            if entry.expires_at > time.monotonic():
+                self._entries.move_to_end(doc_id)
+                self.hits += 1
+                return {"messages": list(entry.messages), "summary": entry.summary}
+            del self._entries[doc_id]
+
+        self.misses += 1
+        self._reading[doc_id] = self._reading.get(doc_id, 0) + 1
+        try:
+            # 書き出し途中の内容を読まないよう、書き込みの完了を待つ
+            await self._wait_written(doc_id)
+            generation = self._generations.get(doc_id, 0)
+            conversation = await self.backend.get_conversation(channel_id, user_id)
+            if self._generations.get(doc_id, 0) != generation:
+                # 読んでいる間に書き出し・要約・削除が走った。古い内容を残さないよう、
+                # 書き込みと重ならないロックの中で読み直す
+                async with self._flush_lock:
+                    await self._wait_written(doc_id)
+                    conversation = await self.backend.get_conversation(channel_id, user_id)
+        finally:
+            self._reading[doc_id] -= 1
+            if not self._reading[doc_id]:
+                del self._reading[doc_id]
+                self._generations.pop(doc_id, None)
+        messages = conversation["messages"]
+        summary = conversation["summary"]
+
+        # まだ書き出していない分を重ねる
+        pending = self._pending.get(doc_id)
+        if pending:
+            messages = messages + pending[2]
+        messages = self._trim(messages)
+
+        self._store(doc_id, messages, summary)
+        return {"messages": list(messages), "summary": summary}
+
+    async def _wait_written(self, doc_id: str) -> None:
+        """doc_id の書き出しが終わるのを待つ（待つ側がキャンセルされても書き込みは続ける）"""
+        write = self._inflight.get(doc_id)
+        if write is not None:
+            await asyncio.wait([write])
+
+    def _invalidate_reads(self, doc_id: str) -> None:
+        """保存先の内容を書き換える前に呼び、読み込み中のリクエストに読み直させる"""
+        if doc_id in self._reading:
+            self._generations[doc_id] = self._generations.get(doc_id, 0) + 1
+
+    async def add_conversation(
+        self, channel_id: int, user_id: int, user_message: str, assistant_message: str
+    ) -> None:
+        """ユーザーとアシスタントのメッセージを追加（書き込みは後でまとめて行う）"""
+        doc_id = self._get_doc_id(channel_id, user_id)
+        new_messages = [
+            {"role": "user", "content": user_message},
+            {"role": "assistant", "content": assistant_message},
+        ]
+
+        if doc_id in self._pending:
+            self._pending[doc_id][2].extend(new_messages)
+        else:
+            self._pending[doc_id] = (channel_id, user_id, list(new_messages))
+
+        # 履歴全体を把握しているときだけキャッシュを更新する
+        entry = self._entries.get(doc_id)
+        if entry is not None:
+            self._store(doc_id, self._trim(entry.messages + new_messages), entry.summary)
+
+        self._ensure_flusher()
+
+    async def clear_history(self, channel_id: int, user_id: int) -> bool:
+        """会話履歴をクリア"""
+        doc_id = self._get_doc_id(channel_id, user_id)
+
+        # 書き出し中の分が後から反映されないよう、フラッシュの完了を待つ
+        async with self._flush_lock:
+            self._invalidate_reads(doc_id)
+            self._entries.pop(doc_id, None)
+            had_pending = self._pending.pop(doc_id, None) is not None
+            await self._wait_written(doc_id)
+            cleared = await self.backend.clear_history(channel_id, user_id)
+        return cleared or had_pending
+
+    async def compact_history(
+        self, channel_id: int, user_id: int, folded: List[Dict], summary: str
+    ) -> bool:
+        """先頭の folded を履歴から外し、要約を summary に置き換える"""
+        doc_id = self._get_doc_id(channel_id, user_id)
+
+        # 保存先の履歴の先頭とキャッシュを揃えるため、先に書き出しておく
+        await self.flush()
+
+        async with self._flush_lock:
+            await self._wait_written(doc_id)
+            self._invalidate_reads(doc_id)
+            compacted = await self.backend.compact_history(
+                channel_id, user_id, folded, summary
+            )
+            entry = self._entries.get(doc_id)
+            if entry is not None:
+                if compacted and entry.messages[: len(folded)] == folded:
+                    entry.messages = entry.messages[len(folded) :]
+                    entry.summary = summary
+                else:
+                    # 内容がずれている可能性があるので次回読み直す
+                    del self._entries[doc_id]
+        return compacted
+
+    async def flush(self) -> None:
+        """未書き込みのメッセージを保存先へ書き出す"""
+        async with self._flushing:
+            # 書き出す分はロックの中で取り出し、書き込みはロックの外で並行に行う
+            async with self._flush_lock:
+                pending, self._pending = self._pending, {}
+                for doc_id, (channel_id, user_id, messages) in pending.items():
+                    self._invalidate_reads(doc_id)
+                    self._inflight[doc_id] = asyncio.create_task(
+                        self._write(doc_id, channel_id, user_id, messages)
+                    )
+                writes = list(self._inflight.values())
+            if writes:
+                await asyncio.gather(*writes)
+
+    async def _write(
+        self, doc_id: str, channel_id: int, user_id: int, messages: List[Dict]
+    ) -> None:
+        """1ドキュメント分を書き出す（失敗したら次回のフラッシュで再試行する）"""
+        try:
+            async with self._write_slots:
+                await self.backend.append_messages(channel_id, user_id, messages)
+            self.flushes += 1
+        except Exception as e:
+            self.flush_errors += 1
+            logger.warning("Failed to flush history %s: %s", doc_id, e)
+            # 次回のフラッシュで再試行する（その間に追加された分より前に置く）
+            if doc_id in self._pending:
+                self._pending[doc_id][2][:0] = messages
+            else:
+                self._pending[doc_id] = (channel_id, user_id, messages)
+        finally:
+            del self._inflight[doc_id]
+
+    def _ensure_flusher(self) -> None:
+        """フラッシュ用のバックグラウンドタスクを起動"""
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            # close()でキャンセルされても書き出し途中の分は失わない
+            await asyncio.shield(self.flush())
+            self._expire()
+
+    def _expire(self) -> None:
+        """期限切れのエントリを削除"""
+        now = time.monotonic()
+        expired = [k for k, v in self._entries.items() if v.expires_at <= now]
+        for doc_id in expired:
+            del self._entries[doc_id]
+
+    async def close(self) -> None:
+        """フラッシュタスクを止め、残りを書き出してからバックエンドを閉じる"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        try:
+            await self.flush()
+        finally:
+            await self.backend.close()
+
+    def stats(self) -> Dict[str, int]:
+        """キャッシュの統計情報"""
+        return {
+            "entries": len(self._entries),
+            "pending": len(self._pending),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "flushes": self.flushes,
+            "flush_errors": self.flush_errors,
+        }
@@ -0,0 +1,108 @@
+import asyncio
+import time
+from typing import Dict, Optional
+
+from config import Config
+from storage.base import HistoryBackend
+
+
+class HistoryJanitor:
+    """長く使われていない会話を保存先から消すバックグラウンドタスク
+
+    ttl 秒以上更新のない会話を、interval 秒ごとに batch_size 件ずつ削除する。
+    1秒あたりの削除数を max_deletes_per_sec 以下に抑え、通常の読み書きを邪魔しない。
+    保存先に残るのが最近使われた会話だけになるので、容量と走査量が
+    アクティブなユーザー数に比例するようになる。
+    """
+
+    def __init__(
+        self,
+        backend: HistoryBackend,
+        ttl: float = Config.HISTORY_RETENTION_DAYS * 86400,
+        interval: float = Config.HISTORY_JANITOR_INTERVAL,
+        batch_size: int = Config.HISTORY_JANITOR_BATCH_SIZE,
+        max_deletes_per_sec: float = Config.HISTORY_JANITOR_MAX_DELETES_PER_SEC,
+    ):
+        self.backend = backend
+        self.ttl = ttl
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_deletes_per_sec = max_deletes_per_sec
+        self._task: Optional[asyncio.Task] = None
+
+        # 統計情報
+        self.runs = 0
+        self.errors = 0
+        self.deleted_total = 0
+        self.last_run_deleted = 0
+        self.last_run_seconds = 0.0
+        self.last_run_at = 0.0
+
+    def start(self) -> None:
+        """定期実行を始める（ttl が 0 なら何もしない）"""
+        if self.ttl <= 0:
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                print(f"History janitor failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self) -> int:
+        """期限切れの会話をすべて削除し、削除した件数を返す"""
+        start = time.monotonic()
+        cutoff = time.time() - self.ttl
+        deleted = 0
+        # 1バッチ分の削除にかける最低時間
+        pause = self.batch_size / self.max_deletes_per_sec if self.max_deletes_per_sec > 0 else 0.0
+        try:
+            while True:
+                batch_start = time.monotonic()
+                count = await self.backend.delete_idle(cutoff, self.batch_size)
+                deleted += count
+                self.deleted_total += count
+                if count < self.batch_size:
+                    break
+                print(f"History janitor: deleted {deleted} idle conversation(s) so far")
+                await asyncio.sleep(max(0.0, pause - (time.monotonic() - batch_start)))
+        finally:
+            self.runs += 1
+            self.last_run_deleted = deleted
+            self.last_run_seconds = time.monotonic() - start
+            self.last_run_at = time.time()
+        if deleted:
+            print(
+                f"History janitor: deleted {deleted} conversation(s) idle since "
+                f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(cutoff))} "
+                f"in {self.last_run_seconds:.1f}s"
+            )
+        return deleted
+
+    async def close(self) -> None:
+        """定期実行を止める（削除途中のバッチは取り消される）"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> Dict[str, float]:
+        """削除の進み具合"""
+        return {
+            "runs": self.runs,
+            "errors": self.errors,
+            "deleted_total": self.deleted_total,
+            "last_run_deleted": self.last_run_deleted,
+            "last_run_seconds": self.last_run_seconds,
+            "last_run_timestamp": self.last_run_at,
+        }
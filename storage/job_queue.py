@@ -0,0 +1,298 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from config import Config
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    shard_id INTEGER NOT NULL DEFAULT 0,
+    user_id INTEGER NOT NULL DEFAULT 0,
+    channel_id INTEGER NOT NULL DEFAULT 0,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    replied INTEGER NOT NULL DEFAULT 0,
+    error TEXT NOT NULL DEFAULT '',
+    enqueued_at REAL NOT NULL,
+    available_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_pending ON jobs (status, available_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_updated_at ON jobs (status, updated_at);
+"""
+
+# 後から足した列（古いファイルには ALTER TABLE で追加する）
+_ADDED_COLUMNS = {
+    "user_id": "INTEGER NOT NULL DEFAULT 0",
+    "channel_id": "INTEGER NOT NULL DEFAULT 0",
+    "replied": "INTEGER NOT NULL DEFAULT 0",
+}
+
+# 処理待ち・処理中として数える状態
+ACTIVE_STATUSES = ("pending", "running")
+
+
+class Job:
+    """キューから取り出した1件のジョブ"""
+
+    __slots__ = (
+        "id", "kind", "user_id", "channel_id", "payload", "attempts", "enqueued_at", "context", "replied"
+    )
+
+    def __init__(
+        self,
+        id: str,
+        kind: str,
+        user_id: int,
+        channel_id: int,
+        payload: Dict,
+        attempts: int,
+        enqueued_at: float,
+        replied: bool = False,
+    ):
+        self.id = id
+        self.kind = kind
+        self.user_id = user_id
+        self.channel_id = channel_id
+        self.payload = payload
+        self.attempts = attempts  # 今回を含めた実行回数
+        self.enqueued_at = enqueued_at  # UNIX時間
+        self.context = None  # 登録したプロセスなら元のメッセージ・インタラクション
+        # ユーザーに何か送ったら True（やり直すと二重に送るので、キューにも記録する）
+        self.replied = replied
+
+
+class JobQueue:
+    """ローカルのSQLite（WALモード）に置く永続的なジョブキュー
+
+    ジョブIDを主キーにしているので、同じID（メッセージIDなど）の二重登録は無視される。
+    処理が済んだジョブも prune() で消すまではIDを残し、再起動後に同じイベントが
+    届いても処理し直さない。シャーディング時は複数プロセスで同じファイルを使い、
+    各プロセスは担当シャードのジョブだけを取り出す。
+    sqlite3 はブロッキングなので、専用のスレッド1本で順番に実行する。
+
+    /ask のジョブは応答用のインタラクショントークン（15分有効なWebhookの認証情報）を
+    payload に持つ。ファイルは所有者だけが読めるように作り、処理が済んだら payload を
+    消す（secure_delete で、消した内容がファイルの空き領域にも残らないようにする）。
+    """
+
+    def __init__(self, path: str = Config.JOB_QUEUE_PATH):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-jobs")
+        self._conn = self._executor.submit(self._connect).result()
+
+    def _connect(self) -> sqlite3.Connection:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # WAL・共有メモリのファイルも同じ権限で作られるよう、先に作っておく
+        os.close(os.open(self.path, os.O_CREAT | os.O_RDWR, 0o600))
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA secure_delete=ON")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.executescript(_SCHEMA)
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+        missing = [name for name in _ADDED_COLUMNS if name not in columns]
+        for name in missing:
+            conn.execute(f"ALTER TABLE jobs ADD COLUMN {name} {_ADDED_COLUMNS[name]}")
+        if "user_id" in missing:
+            # 以前のジョブはユーザーとチャンネルを payload に持っている
+            conn.execute(
+                "UPDATE jobs SET user_id = json_extract(payload, '$.user_id'), "
+                "channel_id = json_extract(payload, '$.channel_id') "
+                "WHERE status IN ('pending', 'running')"
+            )
+        return conn
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    @staticmethod
+    def _in_filter(column: str, values: Optional[Sequence[int]], negate: bool = False) -> Tuple[str, List[int]]:
+        if not values:
+            return "", []
+        op = "NOT IN" if negate else "IN"
+        return f" AND {column} {op} ({','.join('?' * len(values))})", list(values)
+
+    @classmethod
+    def _shard_filter(cls, shard_ids: Optional[Sequence[int]]) -> Tuple[str, List[int]]:
+        return cls._in_filter("shard_id", shard_ids)
+
+    # --- 以下は専用スレッドで実行する ---
+
+    def _enqueue(
+        self,
+        job_id: str,
+        kind: str,
+        shard_id: int,
+        user_id: int,
+        channel_id: int,
+        payload: str,
+        max_pending: int,
+    ) -> str:
+        now = time.time()
+        where, params = self._shard_filter([shard_id])
+        # 数えてから書くまでの間に他のプロセスが割り込まないよう、書き込みロックを先に取る
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            if self._conn.execute("SELECT 1 FROM jobs WHERE id = ?", (job_id,)).fetchone():
+                status = "duplicate"
+            elif max_pending > 0 and self._conn.execute(
+                f"SELECT COUNT(*) FROM jobs WHERE status = 'pending'{where}", params
+            ).fetchone()[0] >= max_pending:
+                status = "full"
+            else:
+                self._conn.execute(
+                    "INSERT INTO jobs (id, kind, shard_id, user_id, channel_id, payload, "
+                    "enqueued_at, available_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (job_id, kind, shard_id, user_id, channel_id, payload, now, now, now),
+                )
+                status = "added"
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+        return status
+
+    def _claim(
+        self,
+        shard_ids: Optional[Sequence[int]],
+        busy_users: Sequence[int],
+        busy_channels: Sequence[int],
+    ) -> Optional[Job]:
+        now = time.time()
+        shard_where, shard_params = self._shard_filter(shard_ids)
+        user_where, user_params = self._in_filter("user_id", busy_users, negate=True)
+        channel_where, channel_params = self._in_filter("channel_id", busy_channels, negate=True)
+        # 1文で取り出すので、同じファイルを使う他のプロセスと取り合っても重複しない
+        row = self._conn.execute(
+            "UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ? "
+            "WHERE id = (SELECT id FROM jobs WHERE status = 'pending' AND available_at <= ?"
+            f"{shard_where}{user_where}{channel_where} ORDER BY available_at LIMIT 1) "
+            "RETURNING id, kind, user_id, channel_id, payload, attempts, enqueued_at, replied",
+            [now, now, *shard_params, *user_params, *channel_params],
+        ).fetchone()
+        if row is None:
+            return None
+        job_id, kind, user_id, channel_id, payload, attempts, enqueued_at, replied = row
+        return Job(
+            job_id, kind, user_id, channel_id, json.loads(payload), attempts, enqueued_at, bool(replied)
+        )
+
+    def _mark_replied(self, job_id: str) -> None:
+        self._conn.execute(
+            "UPDATE jobs SET replied = 1, updated_at = ? WHERE id = ?", (time.time(), job_id)
+        )
+
+    def _finish(self, job_id: str, status: str, error: str) -> None:
+        # 処理済みのジョブは重複除けに使うだけなので、中身（インタラクショントークンなど）は消しておく
+        self._conn.execute(
+            "UPDATE jobs SET status = ?, error = ?, payload = '{}', updated_at = ? WHERE id = ?",
+            (status, error, time.time(), job_id),
+        )
+
+    def _retry(self, job_id: str, delay: float, error: str) -> None:
+        now = time.time()
+        self._conn.execute(
+            "UPDATE jobs SET status = 'pending', error = ?, available_at = ?, updated_at = ? WHERE id = ?",
+            (error, now + delay, now, job_id),
+        )
+
+    def _requeue_running(self, shard_ids: Optional[Sequence[int]]) -> int:
+        where, params = self._shard_filter(shard_ids)
+        return self._conn.execute(
+            f"UPDATE jobs SET status = 'pending', updated_at = ? WHERE status = 'running'{where}",
+            [time.time(), *params],
+        ).rowcount
+
+    def _backlog(self, shard_ids: Optional[Sequence[int]]) -> Dict[Tuple[str, str], Tuple[int, float]]:
+        where, params = self._shard_filter(shard_ids)
+        rows = self._conn.execute(
+            "SELECT kind, status, COUNT(*), MIN(enqueued_at) FROM jobs "
+            f"WHERE status IN ('pending', 'running'){where} GROUP BY kind, status",
+            params,
+        ).fetchall()
+        return {(kind, status): (count, oldest) for kind, status, count, oldest in rows}
+
+    def _prune(self, cutoff: float) -> int:
+        return self._conn.execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?", (cutoff,)
+        ).rowcount
+
+    # --- 非同期インターフェース ---
+
+    async def enqueue(
+        self,
+        job_id: str,
+        kind: str,
+        shard_id: int,
+        user_id: int,
+        channel_id: int,
+        payload: Dict,
+        max_pending: int = 0,
+    ) -> str:
+        """ジョブを登録する
+
+        Returns:
+            "added"、同じIDがすでにあれば "duplicate"、
+            そのシャードの処理待ちが max_pending 件以上なら "full"（0なら上限なし）
+        """
+        data = json.dumps(payload, ensure_ascii=False)
+        return await self._run(
+            self._enqueue, job_id, kind, shard_id, user_id, channel_id, data, max_pending
+        )
+
+    async def claim(
+        self,
+        shard_ids: Optional[Sequence[int]] = None,
+        busy_users: Sequence[int] = (),
+        busy_channels: Sequence[int] = (),
+    ) -> Optional[Job]:
+        """実行できるジョブを1件取り出して処理中にする（なければ None）
+
+        busy_users・busy_channels のジョブは、枠が空くまで取り出さない。
+        """
+        return await self._run(self._claim, shard_ids, busy_users, busy_channels)
+
+    async def mark_replied(self, job_id: str) -> None:
+        """ユーザーに送信済みと記録する（再起動後にやり直して二重に送らないため）"""
+        await self._run(self._mark_replied, job_id)
+
+    async def complete(self, job_id: str) -> None:
+        await self._run(self._finish, job_id, "done", "")
+
+    async def fail(self, job_id: str, error: str) -> None:
+        """これ以上やり直さないジョブとして記録する"""
+        await self._run(self._finish, job_id, "failed", error)
+
+    async def retry(self, job_id: str, delay: float, error: str) -> None:
+        """delay 秒後にやり直せるよう処理待ちに戻す"""
+        await self._run(self._retry, job_id, delay, error)
+
+    async def requeue_running(self, shard_ids: Optional[Sequence[int]] = None) -> int:
+        """前回のプロセスが処理中のまま終わったジョブを処理待ちに戻す"""
+        return await self._run(self._requeue_running, shard_ids)
+
+    async def backlog(
+        self, shard_ids: Optional[Sequence[int]] = None
+    ) -> Dict[Tuple[str, str], Tuple[int, float]]:
+        """{(kind, status): (件数, 最も古い登録時刻)}（処理待ち・処理中のもの）"""
+        return await self._run(self._backlog, shard_ids)
+
+    async def prune(self, cutoff: float) -> int:
+        """cutoff（UNIX時間）より前に終わったジョブを消す"""
+        return await self._run(self._prune, cutoff)
+
+    async def close(self) -> None:
+        await self._run(self._conn.close)
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,54 @@
+"""会話履歴を別の保存先へ移す
+
+    python -m storage.migrate firestore sqlite
+    python -m storage.migrate sqlite firestore --dry-run
+
+移行先に同じ会話があれば上書きする。Botを止めてから実行すること。
+"""
+import argparse
+import asyncio
+import time
+
+from storage import create_history_backend
+
+
+async def migrate(source_name: str, target_name: str, dry_run: bool = False) -> int:
+    source = create_history_backend(source_name)
+    target = None if dry_run else create_history_backend(target_name)
+    count = 0
+    messages = 0
+    start = time.monotonic()
+    try:
+        async for conversation in source.iter_conversations():
+            if target is not None:
+                await target.import_conversation(conversation)
+            count += 1
+            messages += len(conversation["messages"])
+            if count % 500 == 0:
+                print(f"  {count} conversations...")
+    finally:
+        await source.close()
+        if target is not None:
+            await target.close()
+
+    action = "Found" if dry_run else "Migrated"
+    print(
+        f"{action} {count} conversation(s), {messages} message(s) "
+        f"from {source_name} to {target_name} in {time.monotonic() - start:.1f}s"
+    )
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="会話履歴を別の保存先へ移す")
+    parser.add_argument("source", choices=("firestore", "sqlite"))
+    parser.add_argument("target", choices=("firestore", "sqlite"))
+    parser.add_argument("--dry-run", action="store_true", help="件数を数えるだけで書き込まない")
+    args = parser.parse_args()
+    if args.source == args.target:
+        parser.error("source と target が同じです")
+    asyncio.run(migrate(args.source, args.target, args.dry_run))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+import asyncio
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import AsyncIterator, Dict, Iterator, List, Tuple
+
+from config import Config
+from storage.base import HistoryBackend
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    channel_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    summary TEXT NOT NULL DEFAULT '',
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (channel_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS idx_conversations_updated_at ON conversations (updated_at);
+
+CREATE TABLE IF NOT EXISTS turns (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    channel_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_turns_conversation ON turns (channel_id, user_id, created_at, id);
+"""
+
+
+class SQLiteHistory(HistoryBackend):
+    """ローカルのSQLite（WALモード）を使った会話履歴管理
+
+    1往復の発言ごとに1行で保存する。sqlite3 はブロッキングなので、
+    専用のスレッド1本で順番に実行してイベントループを止めない。
+    WALモードなので、シャーディング時に同じファイルを複数プロセスから使ってもよい。
+    """
+
+    def __init__(self, path: str = Config.SQLITE_PATH):
+        super().__init__()
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-history")
+        self._conn = self._executor.submit(self._connect).result()
+
+    def _connect(self) -> sqlite3.Connection:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # トランザクションは自分で管理する
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.executescript(_SCHEMA)
+        return conn
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    # --- 以下は専用スレッドで実行する ---
+
+    def _select_turns(self, channel_id: int, user_id: int) -> List[Tuple[int, str, str]]:
+        return self._conn.execute(
+            "SELECT id, role, content FROM turns WHERE channel_id = ? AND user_id = ? "
+            "ORDER BY created_at, id",
+            (channel_id, user_id),
+        ).fetchall()
+
+    def _get(self, channel_id: int, user_id: int) -> Dict:
+        # 要約とメッセージを同じスナップショットから読む
+        self._conn.execute("BEGIN")
+        try:
+            row = self._conn.execute(
+                "SELECT summary FROM conversations WHERE channel_id = ? AND user_id = ?",
+                (channel_id, user_id),
+            ).fetchone()
+            turns = self._select_turns(channel_id, user_id)
+        finally:
+            self._conn.execute("COMMIT")
+        return {
+            "messages": [{"role": role, "content": content} for _, role, content in turns],
+            "summary": row[0] if row else "",
+        }
+
+    def _append(self, channel_id: int, user_id: int, new_messages: List[Dict]) -> None:
+        now = time.time()
+        with self._transaction():
+            self._conn.executemany(
+                "INSERT INTO turns (channel_id, user_id, role, content, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(channel_id, user_id, m["role"], m["content"], now) for m in new_messages],
+            )
+            # 最大数を超えた場合、古いものを削除
+            self._conn.execute(
+                "DELETE FROM turns WHERE channel_id = ? AND user_id = ? AND id NOT IN ("
+                "  SELECT id FROM turns WHERE channel_id = ? AND user_id = ?"
+                "  ORDER BY created_at DESC, id DESC LIMIT ?)",
+                (channel_id, user_id, channel_id, user_id, self.max_history * 2),
+            )
+            self._touch(channel_id, user_id, now)
+
+    def _touch(self, channel_id: int, user_id: int, updated_at: float) -> None:
+        self._conn.execute(
+            "INSERT INTO conversations (channel_id, user_id, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (channel_id, user_id) DO UPDATE SET updated_at = excluded.updated_at",
+            (channel_id, user_id, updated_at),
+        )
+
+    def _compact(self, channel_id: int, user_id: int, folded: List[Dict], summary: str) -> bool:
+        with self._transaction():
+            turns = self._select_turns(channel_id, user_id)
+            head = [{"role": role, "content": content} for _, role, content in turns[: len(folded)]]
+            if not turns or head != folded:
+                return False
+            self._conn.executemany(
+                "DELETE FROM turns WHERE id = ?", [(turn_id,) for turn_id, _, _ in turns[: len(folded)]]
+            )
+            self._conn.execute(
+                "UPDATE conversations SET summary = ? WHERE channel_id = ? AND user_id = ?",
+                (summary, channel_id, user_id),
+            )
+            return True
+
+    def _clear(self, channel_id: int, user_id: int) -> bool:
+        with self._transaction():
+            deleted = self._conn.execute(
+                "DELETE FROM turns WHERE channel_id = ? AND user_id = ?", (channel_id, user_id)
+            ).rowcount
+            deleted += self._conn.execute(
+                "DELETE FROM conversations WHERE channel_id = ? AND user_id = ?",
+                (channel_id, user_id),
+            ).rowcount
+        return deleted > 0
+
+    def _delete_idle(self, cutoff: float, batch_size: int) -> int:
+        with self._transaction():
+            keys = self._conn.execute(
+                "SELECT channel_id, user_id FROM conversations WHERE updated_at < ? LIMIT ?",
+                (cutoff, batch_size),
+            ).fetchall()
+            self._conn.executemany(
+                "DELETE FROM turns WHERE channel_id = ? AND user_id = ?", keys
+            )
+            self._conn.executemany(
+                "DELETE FROM conversations WHERE channel_id = ? AND user_id = ?", keys
+            )
+        return len(keys)
+
+    def _list_conversations(self) -> List[Dict]:
+        rows = self._conn.execute(
+            "SELECT channel_id, user_id, summary, updated_at FROM conversations"
+        ).fetchall()
+        return [
+            {"channel_id": c, "user_id": u, "summary": s, "updated_at": t} for c, u, s, t in rows
+        ]
+
+    def _import(self, conversation: Dict) -> None:
+        channel_id = conversation["channel_id"]
+        user_id = conversation["user_id"]
+        updated_at = conversation.get("updated_at") or time.time()
+        with self._transaction():
+            self._conn.execute(
+                "DELETE FROM turns WHERE channel_id = ? AND user_id = ?", (channel_id, user_id)
+            )
+            self._conn.executemany(
+                "INSERT INTO turns (channel_id, user_id, role, content, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [
+                    (channel_id, user_id, m["role"], m["content"], updated_at)
+                    for m in conversation["messages"]
+                ],
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO conversations (channel_id, user_id, summary, updated_at) "
+                "VALUES (?, ?, ?, ?)",
+                (channel_id, user_id, conversation.get("summary", ""), updated_at),
+            )
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        # 書き込みロックを先に取り、読んでから書くまでの間に他が割り込まないようにする
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    # --- 非同期インターフェース ---
+
+    async def get_conversation(self, channel_id: int, user_id: int) -> Dict:
+        return await self._run(self._get, channel_id, user_id)
+
+    async def append_messages(
+        self, channel_id: int, user_id: int, new_messages: List[Dict]
+    ) -> None:
+        await self._run(self._append, channel_id, user_id, new_messages)
+
+    async def compact_history(
+        self, channel_id: int, user_id: int, folded: List[Dict], summary: str
+    ) -> bool:
+        return await self._run(self._compact, channel_id, user_id, folded, summary)
+
+    async def clear_history(self, channel_id: int, user_id: int) -> bool:
+        return await self._run(self._clear, channel_id, user_id)
+
+    async def delete_idle(self, cutoff: float, batch_size: int) -> int:
+        return await self._run(self._delete_idle, cutoff, batch_size)
+
+    async def iter_conversations(self) -> AsyncIterator[Dict]:
+        for conversation in await self._run(self._list_conversations):
+            data = await self.get_conversation(conversation["channel_id"], conversation["user_id"])
+            conversation["messages"] = data["messages"]
+            yield conversation
+
+    async def import_conversation(self, conversation: Dict) -> None:
+        await self._run(self._import, conversation)
+
+    async def close(self) -> None:
+        await self._run(self._conn.close)
+        self._executor.shutdown(wait=True)
+
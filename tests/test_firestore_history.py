@@ -0,0 +1,69 @@
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip("google.cloud.firestore")
+
+from storage.base import HistoryBackend
+from storage.firestore_history import ConversationHistory
+
+ROUND_TRIP = 0.1
+
+
+class FakeSnapshot:
+    def __init__(self, data):
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data)
+
+
+class FakeDocument:
+    def __init__(self, collection, doc_id):
+        self.collection = collection
+        self.doc_id = doc_id
+
+    async def get(self, transaction=None):
+        # Firestoreへの1往復を真似る
+        self.collection.calls += 1
+        await asyncio.sleep(ROUND_TRIP)
+        return FakeSnapshot(self.collection.docs.get(self.doc_id))
+
+
+class FakeCollection:
+    def __init__(self, docs):
+        self.docs = docs
+        self.calls = 0
+
+    def document(self, doc_id):
+        return FakeDocument(self, doc_id)
+
+
+def make_history(docs):
+    # 認証情報がなくても動くよう、AsyncClient は作らずにコレクションだけ差し替える
+    history = ConversationHistory.__new__(ConversationHistory)
+    HistoryBackend.__init__(history)
+    history.collection = FakeCollection(docs)
+    return history
+
+
+def test_concurrent_get_history_takes_about_one_round_trip():
+    n = 20
+    docs = {
+        f"1_{user}": {"messages": [{"role": "user", "content": f"q{user}"}], "summary": ""}
+        for user in range(n)
+    }
+    history = make_history(docs)
+
+    async def main():
+        start = time.perf_counter()
+        results = await asyncio.gather(*(history.get_history(1, user) for user in range(n)))
+        return results, time.perf_counter() - start
+
+    results, elapsed = asyncio.run(main())
+    assert [r[0]["content"] for r in results] == [f"q{user}" for user in range(n)]
+    assert history.collection.calls == n
+    # 順番に待つと n 往復かかる。並行に進めば1往復ちょっとで終わる
+    assert elapsed < ROUND_TRIP * 3
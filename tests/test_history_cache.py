@@ -0,0 +1,85 @@
+import asyncio
+import time
+from typing import Dict, List
+
+from storage.base import HistoryBackend
+from storage.history_cache import CachedConversationHistory
+
+ROUND_TRIP = 0.1
+
+
+class SlowBackend(HistoryBackend):
+    """1回の読み書きに ROUND_TRIP 秒かかる、メモリ上の保存先"""
+
+    def __init__(self):
+        super().__init__()
+        self.docs: Dict[str, List[Dict]] = {}
+        self.writing = 0
+        self.peak_writes = 0
+
+    async def get_conversation(self, channel_id, user_id):
+        await asyncio.sleep(ROUND_TRIP)
+        doc_id = self._get_doc_id(channel_id, user_id)
+        return {"messages": list(self.docs.get(doc_id, [])), "summary": ""}
+
+    async def append_messages(self, channel_id, user_id, new_messages):
+        self.writing += 1
+        self.peak_writes = max(self.peak_writes, self.writing)
+        try:
+            await asyncio.sleep(ROUND_TRIP)
+            doc_id = self._get_doc_id(channel_id, user_id)
+            self.docs.setdefault(doc_id, []).extend(new_messages)
+        finally:
+            self.writing -= 1
+
+    async def compact_history(self, channel_id, user_id, folded, summary):
+        return False
+
+    async def clear_history(self, channel_id, user_id):
+        return self.docs.pop(self._get_doc_id(channel_id, user_id), None) is not None
+
+    async def delete_idle(self, cutoff, batch_size):
+        return 0
+
+    async def iter_conversations(self):
+        return
+        yield
+
+    async def import_conversation(self, conversation):
+        pass
+
+
+def test_flush_writes_documents_concurrently_within_limit():
+    backend = SlowBackend()
+    history = CachedConversationHistory(backend, flush_concurrency=4)
+
+    async def main():
+        for user in range(8):
+            await history.add_conversation(1, user, f"q{user}", f"a{user}")
+        start = time.perf_counter()
+        await history.close()
+        return time.perf_counter() - start
+
+    elapsed = asyncio.run(main())
+    assert len(backend.docs) == 8
+    assert backend.peak_writes == 4
+    # 順番に書くと8往復かかる。4件ずつなら2往復ちょっと
+    assert elapsed < ROUND_TRIP * 4
+
+
+def test_clear_during_flush_is_not_overwritten():
+    backend = SlowBackend()
+    history = CachedConversationHistory(backend)
+
+    async def main():
+        await history.add_conversation(1, 2, "q", "a")
+        flush = asyncio.create_task(history.flush())
+        await asyncio.sleep(ROUND_TRIP / 2)
+        # 書き込み中でもロックは空いていて、削除は書き込みの完了を待ってから行う
+        assert not history._flush_lock.locked()
+        await history.clear_history(1, 2)
+        await flush
+        return await history.get_history(1, 2)
+
+    assert asyncio.run(main()) == []
+    assert backend.docs == {}
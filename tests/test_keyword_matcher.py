@@ -0,0 +1,31 @@
+import json
+
+import pytest
+
+from ai.keyword_matcher import KeywordMatcher, SearchKeywordRouter
+
+
+def test_mixed_case_keywords_match_lowercased_text(tmp_path):
+    path = tmp_path / "keywords.json"
+    path.write_text(
+        json.dumps({"career": ["ES", "SPI", "IT業界"], "generation": ["Z世代"]}, ensure_ascii=False),
+        encoding="utf-8",
+    )
+    router = SearchKeywordRouter(str(path))
+
+    # 呼び出し側（OpenAIClient）はメッセージを小文字にしてから渡す
+    assert router.match("ESの書き方を教えて".lower()) == "career"
+    assert router.match("SPIの対策".lower()) == "career"
+    assert router.match("IT業界の動向".lower()) == "career"
+    assert router.match("Z世代の流行".lower()) == "generation"
+    assert router.match("こんにちは".lower()) is None
+
+
+@pytest.mark.parametrize("linear_threshold", [0, 1000])
+def test_linear_scan_and_aho_corasick_agree(linear_threshold):
+    pairs = [("転職", "career"), ("ニュース", "news"), ("職", "short")]
+    matcher = KeywordMatcher(pairs, linear_threshold=linear_threshold)
+
+    assert matcher.search("最新ニュース") == ("ニュース", "news")
+    assert matcher.search("天気") is None
+    assert matcher.search("転職したい") is not None
@@ -0,0 +1,25 @@
+import pytest
+
+from bot.outbound import MAX_MESSAGE_LENGTH, split_message, split_partial
+
+
+def _fences(chunk: str) -> int:
+    return sum(1 for line in chunk.split("\n") if line.lstrip().startswith("```"))
+
+
+@pytest.mark.parametrize("n", range(1985, 2001))
+def test_fence_right_after_boundary(n):
+    # コードブロックの開始行が上限ぎりぎりに来ても、閉じる分を含めて上限に収まる
+    text = "x" * n + "\n```py\nprint(1)\n```\nafter"
+    chunks = split_message(text)
+    assert all(len(chunk) <= MAX_MESSAGE_LENGTH for chunk in chunks)
+    assert all(_fences(chunk) % 2 == 0 for chunk in chunks)
+    # 開き直しただけの空のコードブロックは送らない
+    assert "```py\n```" not in chunks
+    assert "print(1)" in "".join(chunks)
+
+
+def test_partial_keeps_open_fence_for_streaming():
+    heads, rest = split_partial("x" * 1995 + "\n```py\nprint(1)")
+    assert heads == ["x" * 1995]
+    assert rest == "```py\nprint(1)"
@@ -0,0 +1,71 @@
+import asyncio
+from types import SimpleNamespace
+
+from ai.retry import OpenAIRetrier
+
+
+class FakeStream:
+    """読み終えるまで時間がかかるストリーム（同時に読んでいる数を数える）"""
+
+    def __init__(self, counter):
+        self.counter = counter
+        counter.open += 1
+        counter.peak = max(counter.peak, counter.open)
+        self.closed = False
+
+    async def __aiter__(self):
+        for i in range(3):
+            await asyncio.sleep(0.01)
+            yield i
+
+    async def close(self):
+        if not self.closed:
+            self.closed = True
+            self.counter.open -= 1
+
+
+def make_retrier(limit: int):
+    counter = SimpleNamespace(open=0, peak=0)
+
+    async def create(**request):
+        # ヘッダーはすぐ返り、本文はストリームで後から届く
+        return SimpleNamespace(headers={}, parse=lambda: FakeStream(counter))
+
+    client = SimpleNamespace(
+        chat=SimpleNamespace(completions=SimpleNamespace(with_raw_response=SimpleNamespace(create=create)))
+    )
+    retrier = OpenAIRetrier(lambda: client)
+    retrier.limiter.limit = retrier.limiter.maximum = float(limit)
+    return retrier, counter
+
+
+def test_concurrent_streams_stay_within_limit():
+    retrier, counter = make_retrier(limit=2)
+
+    async def consume(close_early: bool):
+        stream = await retrier.create(stream=True, model="m")
+        async for _ in stream:
+            if close_early:
+                break
+        await stream.close()
+
+    async def main():
+        await asyncio.gather(*(consume(i % 3 == 0) for i in range(12)))
+
+    asyncio.run(main())
+    assert counter.peak == 2
+    assert counter.open == 0
+    assert retrier.limiter._active == 0
+
+
+def test_stream_read_to_the_end_releases_slot():
+    retrier, counter = make_retrier(limit=1)
+
+    async def main():
+        for _ in range(3):
+            # close() を呼ばなくても、読み終えれば枠を返す
+            stream = await retrier.create(stream=True, model="m")
+            assert [chunk async for chunk in stream] == [0, 1, 2]
+
+    asyncio.run(asyncio.wait_for(main(), 2))
+    assert retrier.limiter._active == 0
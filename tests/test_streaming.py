@@ -0,0 +1,37 @@
+import asyncio
+from types import SimpleNamespace
+
+from bot.outbound import OutboundDispatcher
+from bot.streaming import EMPTY_RESPONSE_MESSAGE, StreamingReply
+
+
+def _run(deltas):
+    sent = []
+
+    async def edit(content):
+        sent[-1] = content
+
+    async def send(content):
+        sent.append(content)
+        return SimpleNamespace(edit=edit)
+
+    async def main():
+        reply = StreamingReply(send, send, OutboundDispatcher(), channel_id=1, edit_interval=0)
+        for delta in deltas:
+            await reply.feed(delta)
+        return await reply.finish()
+
+    return asyncio.run(main()), sent
+
+
+def test_empty_response_sends_fallback():
+    # 空の応答でも何か返し、呼び出し側には空文字列を返して履歴に残させない
+    response, sent = _run(["", "  \n"])
+    assert response == ""
+    assert sent == [EMPTY_RESPONSE_MESSAGE]
+
+
+def test_non_empty_response_is_returned_as_is():
+    response, sent = _run(["こんにちは", "！"])
+    assert response == "こんにちは！"
+    assert sent == ["こんにちは！"]
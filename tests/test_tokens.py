@@ -0,0 +1,37 @@
+import asyncio
+import subprocess
+import sys
+import threading
+
+from ai import tokens
+
+
+def test_import_does_not_load_tiktoken():
+    code = "import sys, ai.openai_client, ai.tokens; print('tiktoken' in sys.modules)"
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    assert result.stdout.strip() == "False"
+
+
+def test_first_load_runs_off_the_event_loop(monkeypatch):
+    threads = []
+
+    def fake_load(model):
+        threads.append(threading.current_thread())
+        return None
+
+    monkeypatch.setattr(tokens, "_load_encoding", fake_load)
+    monkeypatch.setattr(tokens, "_encodings", {})
+
+    async def main():
+        await tokens.ensure_encoding("test-model")
+        await tokens.ensure_encoding("test-model")
+        return threading.current_thread()
+
+    loop_thread = asyncio.run(main())
+    # 読み込みは1回だけ、イベントループとは別のスレッドで行う
+    assert len(threads) == 1
+    assert threads[0] is not loop_thread
+    # 読み込めなければ文字数で見積もる
+    assert tokens.count_tokens("こんにちは", "test-model") == 5